@@ -1,41 +1,215 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException, Form
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel
-from ..db import get_db_session
-from ..models import Event, Face
-import io
-from ..utils.embeddings import get_embedding_from_image_bytes
-from ..faiss_index import EventFaissIndex
+from typing import List, Optional
+from collections import namedtuple
+from ..db import SessionLocal
+from ..models import Face
+from ..inference import selfie_executor, InferenceOverloaded
+from ..index_cache import index_registry
+from ..event_cache import event_tokens
+from ..path_index import image_ids
+from ..clusters import ALBUM_MIN_SCORE
+from ..query_cache import selfie_cache, result_cache, selfie_key
+from ..metrics import stage
 import numpy as np
+import os
+
+# photos hold several faces, so fetch extra face hits before collapsing to images
+MATCH_OVERSAMPLE = int(os.getenv("MATCH_OVERSAMPLE", "4"))
+# limits for /match/batch (each file is one model call, each token one index search)
+MATCH_BATCH_MAX_FILES = int(os.getenv("MATCH_BATCH_MAX_FILES", "8"))
+MATCH_BATCH_MAX_EVENTS = int(os.getenv("MATCH_BATCH_MAX_EVENTS", "8"))
+FUSION_MODES = ("max", "mean")
+# /match/album page size (default and cap)
+ALBUM_PAGE_SIZE = int(os.getenv("ALBUM_PAGE_SIZE", "60"))
+ALBUM_PAGE_MAX = int(os.getenv("ALBUM_PAGE_MAX", "200"))
+# cosine similarity below which a face hit is not a match (pushed down into the index search);
+# the default keeps every hit
+MATCH_MIN_SCORE = float(os.getenv("MATCH_MIN_SCORE", "-1"))
 
 router = APIRouter()
 
+# what the result builders need of a face: from the index's segment metadata, or a Face row
+FaceRef = namedtuple("FaceRef", ["id", "image_path", "bbox"])
+
 class MatchResponse(BaseModel):
     results: list
 
-@router.post("/match", response_model = MatchResponse)
-async def match(token: str = Form(...), file: UploadFile = File(...), k: int = Form(5)):
-    # validate token
-    from ..db import SessionLocal
+class AlbumResponse(BaseModel):
+    album: Optional[str] # cursor for GET /match/album; None when no identity matched
+    clusters: list # [{"cluster", "score", "faces"}]
+    total: int # photos in the album
+    offset: int
+    next_offset: Optional[int]
+    results: list
+
+class BatchMatchResponse(BaseModel):
+    results: list # one entry per event, in token order
+    no_face: list # indexes of uploaded files in which no face was found
+
+def _hit_rank(m: dict) -> float:
+    # cosine similarity, the same scale from the numpy and the faiss backends
+    return float(m.get("score", -1.0))
+
+def _min_score(requested):
+    # -1 is the lowest cosine, i.e. no threshold
+    value = MATCH_MIN_SCORE if requested is None else float(requested)
+    return value if value > -1.0 else None
+
+def collapse_by_image(hits: list, faces: dict, k: int) -> list:
+    """Keeps the best-scoring face hit per image; faces maps face_db_id -> FaceRef (or Face row).
+    Returns at most k result dicts, best image first."""
+    best = {}
+    for m in hits:
+        f = faces.get(m.get("face_db_id"))
+        if f is None:
+            continue
+        cur = best.get(f.image_path)
+        if cur is None or _hit_rank(m) > _hit_rank(cur[0]):
+            best[f.image_path] = (m, f)
+    ranked = sorted(best.values(), key = lambda mf: _hit_rank(mf[0]), reverse = True)[:k]
+    return [
+        {
+            "image_path": f.image_path,
+            "face_id": f.id,
+            "bbox": f.bbox,
+            "distance": 1.0 - _hit_rank(m), # cosine distance
+            "score": _hit_rank(m),
+        }
+        for m, f in ranked
+    ]
+
+def fuse_by_image(rows: list, faces: dict, k: int, fusion: str = "max") -> list:
+    """Fuses per-query hit rows (as returned by EventFaissIndex.search) into one image ranking.
+
+    Each image first gets its best face score per query; those are then combined across queries
+    by max (any query matches well) or mean (every query should match; a query that did not hit
+    the image counts as 0). Returns at most k result dicts, best image first."""
+    per_image = {} # image_path -> {query: (hit, Face)}
+    for q, hits in enumerate(rows):
+        for m in hits:
+            f = faces.get(m.get("face_db_id"))
+            if f is None:
+                continue
+            by_query = per_image.setdefault(f.image_path, {})
+            cur = by_query.get(q)
+            if cur is None or _hit_rank(m) > _hit_rank(cur[0]):
+                by_query[q] = (m, f)
+
+    n_queries = max(len(rows), 1)
+    ranked = []
+    for path, by_query in per_image.items():
+        m, f = max(by_query.values(), key = lambda mf: _hit_rank(mf[0]))
+        scores = [float(hit.get("score", 0.0)) for hit, _ in by_query.values()]
+        fused = max(scores) if fusion == "max" else sum(scores) / n_queries
+        ranked.append((fused, m, f, len(by_query)))
+    ranked.sort(key = lambda r: r[0], reverse = True)
+    return [
+        {
+            "image_path": f.image_path,
+            "face_id": f.id,
+            "bbox": f.bbox,
+            "distance": 1.0 - _hit_rank(m),
+            "score": fused,
+            "matched_queries": matched,
+        }
+        for fused, m, f, matched in ranked[:k]
+    ]
+
+def _respond(payload: dict) -> JSONResponse:
+    # encoded here rather than by FastAPI after the handler returns, so the serialize stage
+    # covers it (the payload is plain lists / dicts / numbers already)
+    with stage("serialize"):
+        return JSONResponse(payload)
+
+async def _resolve_tokens(tokens: list) -> dict:
+    """{token: EventRef or None}; the database is only asked about tokens not cached yet."""
+    found, missing = event_tokens.cached(tokens)
+    if missing:
+        with stage("db"):
+            found.update(await run_in_threadpool(event_tokens.load, missing))
+    return found
+
+async def _embed(img_bytes: bytes) -> np.ndarray:
+    """Embedding of a selfie (zeros: no face). A selfie seen within the cache TTL skips the model;
+    new ones are micro-batched with concurrent selfies off the event loop."""
+    return (await _embed_many([img_bytes]))[0]
+
+async def _embed_many(images: list) -> list:
+    keys = [selfie_key(b) for b in images]
+    vecs = [selfie_cache.get(key) for key in keys]
+    # one model call per distinct selfie (a batch may repeat one)
+    todo = {keys[i]: i for i, v in enumerate(vecs) if v is None}
+    if todo:
+        try:
+            with stage("inference"):
+                fresh = await selfie_executor.submit_many([images[i] for i in todo.values()])
+        except InferenceOverloaded:
+            raise HTTPException(status_code = 503, detail = "Too many selfies in flight, please retry", headers = {"Retry-After": "1"})
+        done = {key: selfie_cache.put(key, v) for key, v in zip(todo, fresh)}
+        vecs = [v if v is not None else done[key] for key, v in zip(keys, vecs)]
+    return vecs
+
+def _load_faces(face_ids: list) -> dict:
     db = SessionLocal()
-    ev = db.query(Event).filter(Event.token == token).first()
-    
-    if not ev:
+    try:
+        return {f.id: FaceRef(f.id, f.image_path, f.bbox) for f in db.query(Face).filter(Face.id.in_(face_ids)).all()}
+    finally:
         db.close()
+
+async def _face_refs(idx, face_ids) -> dict:
+    """face_db_id -> FaceRef, from the index metadata; only faces indexed without metadata
+    (older index files) cost a query. Faces of an image that has since been grouped as a
+    near-duplicate count for its group leader, so the group collapses to one result."""
+    with stage("face_meta"):
+        faces = {fid: FaceRef(fid, path, bbox) for fid, (path, bbox) in idx.face_refs(face_ids).items()}
+    missing = [fid for fid in set(face_ids) if fid not in faces]
+    if missing:
+        with stage("db"):
+            faces.update(await run_in_threadpool(_load_faces, missing))
+    if idx.duplicates:
+        for fid, f in faces.items():
+            leader = idx.leader_of(f.image_path)
+            if leader != f.image_path:
+                faces[fid] = FaceRef(f.id, leader, None) # the box was measured on the duplicate
+    return faces
+
+def _link_images(ev, idx, results: list):
+    """Adds the signed image_id of every result, and its near-duplicates (burst frames,
+    re-exported copies) that were indexed through it."""
+    for r in results:
+        # opaque, signed handle for GET /images?id=... (no path check or DB lookup there)
+        r["image_id"] = image_ids.sign(ev.id, r["image_path"])
+        r["duplicates"] = [{"image_path": d, "image_id": image_ids.sign(ev.id, d)} for d in idx.duplicates.get(r["image_path"], [])]
+
+@router.post("/match", response_model = MatchResponse)
+async def match(token: str = Form(...), file: UploadFile = File(...), k: int = Form(5), min_score: float = Form(None)):
+    # validate token (cached per process; at most one query per cold token)
+    ev = (await _resolve_tokens([token]))[token]
+    if not ev:
         raise HTTPException(status_code = 401, detail = "Invalid or expired token")
     
     # read file bytes
     img_bytes = await file.read()
-    # convert to embedding
-    query_vec = get_embedding_from_image_bytes(img_bytes) # np.array float32
+    # convert to embedding (np.array float32; cached by the selfie's hash)
+    query_vec = await _embed(img_bytes)
 
     # check if face detected
     if np.all(query_vec == 0):
-         db.close()
          raise HTTPException(status_code = 400, detail = "No face detected in the selfie")
 
-    # load faiss index for event (EventFaissIndex handles lazy loads)
-    idx = EventFaissIndex(ev.id, dim = len(query_vec))
-    results = idx.search(query_vec.reshape(1, -1), k = k)
+    # shared, process-wide index cache (reloads when the indexer rewrites the files)
+    with stage("index_load"):
+        idx = index_registry.get(ev.id, dim = len(query_vec))
+    # the same query against the same load of the index: the results of last time
+    cache_key = result_cache.key(ev.id, idx.generation, query_vec, "match", k, _min_score(min_score))
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        return _respond({"results": cached})
+    with stage("search"):
+        results = idx.search(query_vec.reshape(1, -1), k = k * MATCH_OVERSAMPLE, min_score = _min_score(min_score))
     
     # results is list of lists (one per query vector)
     # we only have 1 query vector
@@ -44,20 +218,152 @@ async def match(token: str = Form(...), file: UploadFile = File(...), k: int = F
     # Extract face_db_ids
     face_ids = [m["face_db_id"] for m in top_matches if m.get("face_db_id") is not None]
     
-    # Fetch image paths from DB
+    # Resolve image paths and collapse face hits to unique images
     final_results = []
     if face_ids:
-        faces = db.query(Face).filter(Face.id.in_(face_ids)).all()
-        face_map = {f.id: f.image_path for f in faces}
-        
-        for m in top_matches:
-            fid = m.get("face_db_id")
-            if fid and fid in face_map:
-                final_results.append({
-                    "image_path": face_map[fid],
-                    "distance": m.get("distance", 0.0),
-                    "score": m.get("score", 0.0)
-                })
+        faces = await _face_refs(idx, face_ids)
+        with stage("serialize"):
+            final_results = collapse_by_image(top_matches, faces, k)
+            _link_images(ev, idx, final_results)
     
-    db.close()
-    return {"results": final_results}
\ No newline at end of file
+    return _respond({"results": result_cache.put(cache_key, final_results)})
+
+@router.post("/match/batch", response_model = BatchMatchResponse)
+async def match_batch(tokens: List[str] = Form(...), files: List[UploadFile] = File(...), k: int = Form(5),
+                      fusion: str = Form("max"), min_score: float = Form(None)):
+    """Several selfies (angles of one guest, or a family) against one or more events.
+    All selfies go through the model together, each event index is searched once with the
+    whole query matrix, and face paths come from each index's metadata."""
+    if fusion not in FUSION_MODES:
+        raise HTTPException(status_code = 400, detail = f"fusion must be one of {', '.join(FUSION_MODES)}")
+    tokens = list(dict.fromkeys(tokens)) # de-duplicate, keep order
+    if len(files) > MATCH_BATCH_MAX_FILES or len(tokens) > MATCH_BATCH_MAX_EVENTS:
+        raise HTTPException(status_code = 400, detail = f"At most {MATCH_BATCH_MAX_FILES} selfies and {MATCH_BATCH_MAX_EVENTS} tokens per request")
+
+    events = await _resolve_tokens(tokens)
+    if not all(events.values()):
+        raise HTTPException(status_code = 401, detail = "Invalid or expired token")
+
+    # the executor groups these into as few model calls as its batch size allows
+    images = [await f.read() for f in files]
+    vecs = await _embed_many(images)
+
+    no_face = [i for i, v in enumerate(vecs) if np.all(v == 0)]
+    queries = [v for v in vecs if not np.all(v == 0)]
+    if not queries:
+        raise HTTPException(status_code = 400, detail = "No face detected in any selfie")
+    Q = np.stack(queries).astype("float32")
+
+    results = []
+    for token in tokens:
+        ev = events[token]
+        # one vectorized search per event
+        with stage("index_load"):
+            idx = index_registry.get(ev.id, dim = Q.shape[1])
+        cache_key = result_cache.key(ev.id, idx.generation, Q, "batch", k, fusion, _min_score(min_score))
+        fused = result_cache.get(cache_key)
+        if fused is None:
+            with stage("search"):
+                rows = idx.search(Q, k = k * MATCH_OVERSAMPLE, min_score = _min_score(min_score))
+            face_ids = [m["face_db_id"] for hits in rows for m in hits if m.get("face_db_id") is not None]
+            faces = await _face_refs(idx, face_ids) if face_ids else {}
+            with stage("serialize"):
+                fused = fuse_by_image(rows, faces, k, fusion)
+                _link_images(ev, idx, fused)
+            result_cache.put(cache_key, fused)
+        results.append({"event_code": ev.event_code, "results": fused})
+    return _respond({"results": results, "no_face": no_face})
+
+def _album_page(ev, idx, matched: list, offset: int, limit: int) -> dict:
+    """One page of the photos of the matched identities: every member face resolved to its
+    image, best identity first and most central face first within it, one entry per image."""
+    clusters = idx.clusters
+    members = [(c, score, clusters.members(c)) for c, score in matched]
+    with stage("face_meta"):
+        refs = idx.face_refs([int(fid) for _, _, ids in members for fid in ids])
+    with stage("serialize"):
+        seen, album = set(), []
+        for c, score, ids in members:
+            for fid in ids.tolist():
+                ref = refs.get(fid)
+                if ref is None:
+                    continue
+                path = idx.leader_of(ref[0])
+                if path in seen:
+                    continue
+                seen.add(path)
+                album.append((c, score, fid, (path, ref[1] if path == ref[0] else None)))
+        page = album[offset:offset + limit]
+        results = [
+            {
+                "image_path": path,
+                "face_id": fid,
+                "bbox": bbox,
+                "distance": 1.0 - score,
+                "score": score, # the identity's match, the same for every photo of it
+                "cluster": c,
+            }
+            for c, score, fid, (path, bbox) in page
+        ]
+        _link_images(ev, idx, results)
+        return {
+            "album": image_ids.sign(ev.id, ",".join(f"{c}:{score:.6f}" for c, score in matched), kind = "album") if matched else None,
+            "clusters": [{"cluster": c, "score": score, "faces": len(ids)} for c, score, ids in members],
+            "total": len(album),
+            "offset": offset,
+            "next_offset": offset + limit if offset + limit < len(album) else None,
+            "results": results,
+        }
+
+def _page_args(offset: int, limit: int) -> tuple:
+    if offset < 0 or limit < 1:
+        raise HTTPException(status_code = 400, detail = "offset must be >= 0 and limit >= 1")
+    return offset, min(limit, ALBUM_PAGE_MAX)
+
+@router.post("/match/album", response_model = AlbumResponse)
+async def match_album(token: str = Form(...), file: UploadFile = File(...), limit: int = Form(ALBUM_PAGE_SIZE),
+                      min_score: float = Form(None)):
+    """Every photo of the guest, not just the top k faces: the selfie is matched against the
+    event's identity centroids (a few thousand at most), and the matching identities expand to
+    their member photos. Further pages come from GET /match/album with the returned cursor."""
+    offset, limit = _page_args(0, limit)
+    ev = (await _resolve_tokens([token]))[token]
+    if not ev:
+        raise HTTPException(status_code = 401, detail = "Invalid or expired token")
+    img_bytes = await file.read()
+    query_vec = await _embed(img_bytes)
+    if np.all(query_vec == 0):
+        raise HTTPException(status_code = 400, detail = "No face detected in the selfie")
+
+    with stage("index_load"):
+        idx = index_registry.get(ev.id, dim = len(query_vec))
+    with stage("search"):
+        matched = idx.clusters.match(query_vec.reshape(1, -1), min_score = ALBUM_MIN_SCORE if min_score is None else float(min_score))
+    # rounded as in the cursor, so every page reports the same scores
+    matched = [(c, round(score, 6)) for c, score in matched]
+    return _respond(_album_page(ev, idx, matched, offset, limit))
+
+@router.get("/match/album", response_model = AlbumResponse)
+async def match_album_page(token: str, album: str, offset: int = 0, limit: int = ALBUM_PAGE_SIZE):
+    offset, limit = _page_args(offset, limit)
+    ev = (await _resolve_tokens([token]))[token]
+    if not ev:
+        raise HTTPException(status_code = 401, detail = "Invalid or expired token")
+    resolved = image_ids.verify(album, kind = "album")
+    if resolved is None or resolved[0] != ev.id:
+        raise HTTPException(status_code = 403, detail = "Invalid album cursor")
+    matched = []
+    for part in resolved[1].split(","):
+        c, _, score = part.partition(":")
+        matched.append((int(c), float(score)))
+    with stage("index_load"):
+        idx = index_registry.get(ev.id)
+    return _respond(_album_page(ev, idx, matched, offset, limit))
+
+@router.get("/match/cache-stats")
+def match_cache_stats():
+    return {**index_registry.stats(), "tokens": event_tokens.stats(), "selfies": selfie_cache.stats(), "results": result_cache.stats()}
+
+@router.get("/match/inference-stats")
+def match_inference_stats():
+    return selfie_executor.stats()
\ No newline at end of file
@@ -1,28 +1,41 @@
-from fastapi import APIRouter, HTTPException, BackgroundTasks
+from fastapi import APIRouter, HTTPException
 from pydantic import BaseModel
+from typing import Optional
 import secrets
 from ..db import get_db_session
 from ..models import Event
+from ..path_index import event_paths
+from ..event_cache import event_tokens, EventRef
+from ..jobs import job_queue, JOB_PRIORITY_REINDEX
+from ..sources import source_for
 from sqlalchemy.orm import Session
 import sqlalchemy
-import sys
-from pathlib import Path
-import subprocess
-import os
 
 router = APIRouter()
 
 class RegisterRequest(BaseModel):
     storage_path: str
+    tenant: str = "default"
+    priority: Optional[int] = None # indexing priority, lower runs first
 
 class RegisterResponse(BaseModel):
     event_code: str
     token: str
     qr_link: str
     id: int
+    job_id: int
+
+class ReindexRequest(BaseModel):
+    full: bool = False # rebuild instead of only picking up new / changed / deleted files
+    priority: Optional[int] = None
 
 @router.post("/register", response_model = RegisterResponse)
-def register_event(payload: RegisterRequest, background_tasks: BackgroundTasks):
+def register_event(payload: RegisterRequest):
+    # a local folder or a remote one (gdrive://<folder id>); see app/sources.py
+    try:
+        source_for(payload.storage_path)
+    except ValueError as e:
+        raise HTTPException(status_code = 400, detail = str(e))
     token = secrets.token_urlsafe(16)
     event_code = "EV_" + secrets.token_hex(4)
     # insert into db
@@ -40,25 +53,40 @@ def register_event(payload: RegisterRequest, background_tasks: BackgroundTasks):
         db.close()
 
     qr_link = f"https://app.example.com/e/{event_code}/{token}"
+    # images under the new root are servable right away, and the token resolves without a query
+    event_paths.add(ev.id, payload.storage_path)
+    event_tokens.put(token, EventRef(ev.id, event_code, payload.storage_path))
     
-    # Trigger background indexing
-    background_tasks.add_task(run_indexer, ev.id, payload.storage_path)
+    # indexed by a worker process (worker/job_worker.py), not in this one
+    job_id = job_queue.enqueue(ev.id, payload.storage_path, tenant = payload.tenant, priority = payload.priority)
 
-    return {"event_code": event_code, "token": token, "qr_link": qr_link, "id": ev.id}
+    return {"event_code": event_code, "token": token, "qr_link": qr_link, "id": ev.id, "job_id": job_id}
 
-def run_indexer(event_id: int, folder_path: str):
-    # This runs in background
-    
-    worker_script = Path(__file__).resolve().parents[3] / "worker" / "indexer.py"
-    
-    # We can also just import the function if we add worker to sys.path
-    worker_dir = Path(__file__).resolve().parents[3] / "worker"
-    if str(worker_dir) not in sys.path:
-        sys.path.insert(0, str(worker_dir))
-        
+@router.post("/events/{event_id}/reindex")
+def reindex_event(event_id: int, payload: ReindexRequest = ReindexRequest()):
+    from ..db import SessionLocal
+    db: Session = SessionLocal()
+    try:
+        ev = db.query(Event).filter(Event.id == event_id).first()
+        if not ev:
+            raise HTTPException(status_code = 404, detail = "Event not found")
+        last = job_queue.status(db, event_id)
+    finally:
+        db.close()
+    tenant = last["tenant"] if last else "default"
+    priority = JOB_PRIORITY_REINDEX if payload.priority is None else payload.priority
+    job_id = job_queue.enqueue(event_id, ev.storage_path, tenant = tenant, priority = priority, incremental = not payload.full)
+    return {"id": event_id, "job_id": job_id}
+
+@router.get("/events/{event_id}/status")
+def event_status(event_id: int):
+    """Indexing progress: files done / total, faces found, ETA, or the queue position."""
+    from ..db import SessionLocal
+    db: Session = SessionLocal()
     try:
-        from indexer import index_local_folder
-        index_local_folder(event_id, folder_path)
-    except ImportError:
-        print("Could not import indexer. Running as subprocess...")
-        subprocess.Popen([sys.executable, str(worker_script)], env={**os.environ, "EVENT_ID": str(event_id), "FOLDER": folder_path})
\ No newline at end of file
+        ev = db.query(Event).filter(Event.id == event_id).first()
+        if not ev:
+            raise HTTPException(status_code = 404, detail = "Event not found")
+        return {"id": ev.id, "event_code": ev.event_code, "indexed": bool(ev.indexed), "job": job_queue.status(db, event_id)}
+    finally:
+        db.close()
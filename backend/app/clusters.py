@@ -0,0 +1,188 @@
+import os
+import numpy as np
+from pathlib import Path
+from .segments import l2_normalize
+
+# a face joins the nearest identity when its cosine to that identity's centroid is at least this
+# (buffalo_l: same person is typically 0.4-0.8 face to face, and closer to a centroid)
+CLUSTER_THRESHOLD = float(os.getenv("CLUSTER_THRESHOLD", "0.5"))
+# new faces assigned per matrix product against the centroids
+CLUSTER_BLOCK_ROWS = int(os.getenv("CLUSTER_BLOCK_ROWS", "4096"))
+# /match/album: identities whose centroid scores at least this against the selfie ...
+ALBUM_MIN_SCORE = float(os.getenv("ALBUM_MIN_SCORE", "0.4"))
+# ... at most this many of them (one guest split over a few clusters, e.g. with / without glasses)
+ALBUM_MAX_CLUSTERS = int(os.getenv("ALBUM_MAX_CLUSTERS", "3"))
+
+CLUSTERS_FORMAT = 1
+
+def clusters_path(index_dir, event_id: int) -> Path:
+    # next to the index, not inside the segment store (its gc deletes unknown files)
+    return Path(index_dir) / f"event_{int(event_id)}_clusters.npz"
+
+class EventClusters:
+    """Identities of one event: a centroid per cluster of face embeddings, and each face's cluster.
+
+    Built incrementally by the indexer (update()): faces that left the index are dropped from
+    their cluster, new faces join the nearest centroid at or above CLUSTER_THRESHOLD or start a
+    cluster of their own (online leader clustering). Centroids are kept as running sums, so an
+    update costs O(new faces x clusters), not a re-clustering of the event. Cluster ids are never
+    reused (an emptied cluster keeps its slot with a zero centroid, which matches nothing), so
+    album cursors stay valid across runs. The file is replaced atomically."""
+
+    def __init__(self, path: Path, dim: int = 512):
+        self.path = Path(path)
+        self.version = 0
+        self.sums = np.zeros((0, dim), dtype = np.float32) # unnormalized per-cluster sums
+        self.counts = np.zeros(0, dtype = np.int64)
+        self.face_ids = np.zeros(0, dtype = np.int64) # members, sorted by (label, -sim)
+        self.labels = np.zeros(0, dtype = np.int32)
+        self.sims = np.zeros(0, dtype = np.float32) # member's cosine to its centroid when it joined
+        self.centroids = np.zeros((0, dim), dtype = np.float32)
+
+    @classmethod
+    def load(cls, path: Path, dim: int = 512):
+        clusters = cls(path, dim)
+        if not clusters.path.exists():
+            return clusters
+        try:
+            with np.load(str(clusters.path)) as data:
+                if int(data["format"]) != CLUSTERS_FORMAT or data["sums"].shape[1] != dim:
+                    return clusters
+                clusters.version = int(data["version"])
+                for name in ("sums", "counts", "face_ids", "labels", "sims"):
+                    setattr(clusters, name, data[name])
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[WARNING] Unreadable clusters {clusters.path} ({e}); re-clustering.")
+            return cls(path, dim)
+        clusters.centroids = l2_normalize(clusters.sums) if len(clusters.sums) else clusters.centroids
+        return clusters
+
+    def __len__(self):
+        return len(self.counts)
+
+    def save(self):
+        self.version += 1
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as fh:
+            np.savez(fh, format = CLUSTERS_FORMAT, version = self.version, sums = self.sums, counts = self.counts,
+                     face_ids = self.face_ids, labels = self.labels, sims = self.sims)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, self.path)
+
+    def nbytes(self) -> int:
+        return int(self.centroids.nbytes + self.counts.nbytes + self.face_ids.nbytes + self.labels.nbytes + self.sims.nbytes)
+
+    # ---------- indexer side ----------
+
+    def update(self, store) -> dict:
+        """Brings membership in line with the live rows of a SegmentStore and saves if anything
+        changed. Returns {"clusters", "added", "removed", "new_clusters"}."""
+        live = store.live_ids()
+        keep = np.isin(self.face_ids, live)
+        removed = int((~keep).sum())
+        if removed:
+            # departed faces: subtract their share by recomputing the affected sums from the live members
+            dirty = np.unique(self.labels[~keep])
+            self.face_ids, self.labels, self.sims = self.face_ids[keep], self.labels[keep], self.sims[keep]
+            self._recompute(store, dirty)
+        new_ids = np.setdiff1d(live, self.face_ids, assume_unique = True)
+        n_before = len(self)
+        if len(new_ids):
+            self._assign(store, new_ids)
+        if removed or len(new_ids):
+            order = np.lexsort((-self.sims, self.labels))
+            self.face_ids, self.labels, self.sims = self.face_ids[order], self.labels[order], self.sims[order]
+            self.save()
+        return {"clusters": len(self), "added": int(len(new_ids)), "removed": removed,
+                "new_clusters": max(len(self) - n_before, 0)}
+
+    @staticmethod
+    def _vectors(store, face_ids: np.ndarray):
+        """(ids, vectors) of the live rows among face_ids, segment by segment."""
+        for seg in store.segments:
+            mask = np.isin(seg.ids, face_ids)
+            if seg.alive is not None:
+                mask &= seg.alive
+            if mask.any():
+                rows = np.flatnonzero(mask)
+                yield seg.ids[rows], np.asarray(seg.vectors[rows], dtype = np.float32)
+
+    def _recompute(self, store, dirty: np.ndarray):
+        self.sums[dirty] = 0.0
+        self.counts[dirty] = 0
+        in_dirty = np.isin(self.labels, dirty)
+        label_of = dict(zip(self.face_ids[in_dirty].tolist(), self.labels[in_dirty].tolist()))
+        for ids, vecs in self._vectors(store, self.face_ids[in_dirty]):
+            labels = np.fromiter((label_of[i] for i in ids.tolist()), dtype = np.int64, count = len(ids))
+            np.add.at(self.sums, labels, vecs)
+            np.add.at(self.counts, labels, 1)
+        self.centroids = l2_normalize(self.sums) if len(self.sums) else self.centroids
+
+    def _assign(self, store, new_ids: np.ndarray):
+        dim = self.sums.shape[1]
+        n = len(self.counts)
+        # growable copies (capacity doubles); rows [0, n) are live
+        cap = max(16, 2 * n)
+        sums = np.zeros((cap, dim), dtype = np.float32)
+        counts = np.zeros(cap, dtype = np.int64)
+        cent = np.zeros((cap, dim), dtype = np.float32)
+        sums[:n], counts[:n], cent[:n] = self.sums, self.counts, self.centroids
+        new_labels, new_sims, assigned_ids = [], [], []
+        for ids, vecs in self._vectors(store, new_ids):
+            for start in range(0, len(ids), CLUSTER_BLOCK_ROWS):
+                block_ids, block = ids[start:start + CLUSTER_BLOCK_ROWS], vecs[start:start + CLUSTER_BLOCK_ROWS]
+                labels = np.full(len(block), -1, dtype = np.int64)
+                sims = np.zeros(len(block), dtype = np.float32)
+                if n:
+                    s = block @ cent[:n].T
+                    best = s.argmax(axis = 1)
+                    best_s = s[np.arange(len(block)), best]
+                    ok = best_s >= CLUSTER_THRESHOLD
+                    labels[ok], sims[ok] = best[ok], best_s[ok]
+                    np.add.at(sums, labels[ok], block[ok])
+                    np.add.at(counts, labels[ok], 1)
+                # the rest one by one, against the clusters started since the block's product
+                first_new = n
+                for i in np.flatnonzero(labels < 0):
+                    v = block[i]
+                    if n > first_new:
+                        fs = cent[first_new:n] @ v
+                        j = int(fs.argmax())
+                        if fs[j] >= CLUSTER_THRESHOLD:
+                            c = first_new + j
+                            labels[i], sims[i] = c, fs[j]
+                            sums[c] += v
+                            counts[c] += 1
+                            cent[c] = l2_normalize(sums[c])[0]
+                            continue
+                    if n == cap:
+                        cap *= 2
+                        sums, counts, cent = (np.resize(a, (cap,) + a.shape[1:]) for a in (sums, counts, cent))
+                    sums[n], counts[n], cent[n] = v, 1, v
+                    labels[i], sims[i] = n, 1.0
+                    n += 1
+                touched = np.unique(labels)
+                cent[touched] = l2_normalize(sums[touched])
+                new_labels.append(labels.astype(np.int32))
+                new_sims.append(sims)
+                assigned_ids.append(block_ids)
+        self.sums, self.counts, self.centroids = sums[:n].copy(), counts[:n].copy(), cent[:n].copy()
+        self.face_ids = np.concatenate([self.face_ids] + assigned_ids)
+        self.labels = np.concatenate([self.labels] + new_labels)
+        self.sims = np.concatenate([self.sims] + new_sims)
+
+    # ---------- query side ----------
+
+    def match(self, q: np.ndarray, min_score: float = ALBUM_MIN_SCORE, max_clusters: int = ALBUM_MAX_CLUSTERS) -> list:
+        """[(cluster, cosine)] best first: the identities the selfie q belongs to."""
+        if len(self.centroids) == 0:
+            return []
+        scores = self.centroids @ l2_normalize(q)[0]
+        order = np.argsort(-scores, kind = "stable")[:max(1, int(max_clusters))]
+        return [(int(c), float(scores[c])) for c in order if scores[c] >= min_score]
+
+    def members(self, cluster: int) -> np.ndarray:
+        """Face ids of a cluster, most central first."""
+        lo, hi = np.searchsorted(self.labels, [cluster, cluster + 1])
+        return self.face_ids[lo:hi]
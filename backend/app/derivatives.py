@@ -0,0 +1,115 @@
+import os
+import hashlib
+import threading
+import cv2
+from pathlib import Path
+from .utils.images import decode_image, DecodedImage
+from .sources import source_for, SourceFile
+
+# resized, re-encoded copies of event photos served by GET /api/v1/images?size=...
+DERIVATIVE_CACHE_DIR = Path(os.getenv("DERIVATIVE_CACHE_DIR", str(Path(__file__).resolve().parents[0] / "cache" / "derivatives")))
+DERIVATIVE_CACHE_MAX_MB = int(os.getenv("DERIVATIVE_CACHE_MAX_MB", "2048"))
+DERIVATIVE_JPEG_QUALITY = int(os.getenv("DERIVATIVE_JPEG_QUALITY", "82"))
+# long edge per size; "full" is the original file
+DERIVATIVE_SIZES = {"thumb": 320, "medium": 1280}
+
+def source_fingerprint(st: SourceFile) -> str:
+    """Identity of one version of a source photo: a new upload or an edit changes it."""
+    path = st.path if "://" in st.path else os.path.abspath(st.path)
+    key = f"{path}|{st.size}|{st.mtime_ns}"
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+class DerivativeCache:
+    """On-disk cache of derivatives addressed by source fingerprint + size name
+    (<root>/<fp[:2]>/<fp>_<size>.jpg), pruned least-recently-used past max_bytes.
+    A hit touches the file's mtime, which is what LRU pruning orders by."""
+
+    def __init__(self, root: Path = DERIVATIVE_CACHE_DIR, max_bytes: int = DERIVATIVE_CACHE_MAX_MB * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._bytes = None # lazily measured on first write
+
+    def path_for(self, fingerprint: str, size: str) -> Path:
+        return self.root / fingerprint[:2] / f"{fingerprint}_{size}.jpg"
+
+    def get(self, source_path: str, size: str, st: SourceFile = None) -> Path: # type: ignore
+        """Path of the derivative, generating it on a miss. Raises ValueError on an unknown size
+        and OSError if the source cannot be read. st is the source's current version, if known."""
+        if size not in DERIVATIVE_SIZES:
+            raise ValueError(f"unknown size {size!r}")
+        source = source_for(source_path)
+        st = st or source.stat(source_path)
+        out = self.path_for(source_fingerprint(st), size)
+        if out.exists():
+            try:
+                os.utime(out)
+            except OSError:
+                pass
+            return out
+        data, _ = source.read(source_path, st)
+        dec = decode_image(data, long_edge = DERIVATIVE_SIZES[size])
+        if dec is None:
+            raise OSError(f"cannot decode {source_path}")
+        self._write(out, dec.img, DERIVATIVE_SIZES[size])
+        return out
+
+    def store_from_decoded(self, st: SourceFile, dec: DecodedImage, sizes = ("thumb",)):
+        """Pre-generates derivatives from an image the caller already decoded (the indexer does
+        this in its decode pass). Sizes larger than the decoded image are left for on-demand."""
+        fp = source_fingerprint(st)
+        for size in sizes:
+            long_edge = DERIVATIVE_SIZES[size]
+            out = self.path_for(fp, size)
+            if out.exists() or (max(dec.img.shape[:2]) < long_edge and dec.scale > 1.0):
+                continue
+            self._write(out, dec.img, long_edge)
+
+    def _write(self, out: Path, img, long_edge: int):
+        cur = max(img.shape[:2])
+        if cur > long_edge:
+            f = long_edge / float(cur)
+            img = cv2.resize(img, (max(1, round(img.shape[1] * f)), max(1, round(img.shape[0] * f))), interpolation = cv2.INTER_AREA)
+        ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, DERIVATIVE_JPEG_QUALITY, cv2.IMWRITE_JPEG_PROGRESSIVE, 1])
+        if not ok:
+            raise OSError(f"cannot encode derivative {out.name}")
+        out.parent.mkdir(parents = True, exist_ok = True)
+        tmp = out.with_name(out.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as fh:
+            fh.write(buf.tobytes())
+        os.replace(tmp, out)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._measure()
+            else:
+                self._bytes += len(buf)
+            over = self._bytes > self.max_bytes
+        if over:
+            self.prune()
+
+    def _measure(self) -> int:
+        return sum(p.stat().st_size for p in self.root.rglob("*.jpg")) if self.root.exists() else 0
+
+    def prune(self, target_ratio: float = 0.9):
+        """Deletes least-recently-used derivatives until the cache is under target_ratio * max_bytes."""
+        with self._lock:
+            files = []
+            for p in self.root.rglob("*.jpg"):
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            for _, size, p in files:
+                if total <= self.max_bytes * target_ratio:
+                    break
+                try:
+                    p.unlink()
+                    total -= size
+                except OSError:
+                    pass
+            self._bytes = total
+
+derivative_cache = DerivativeCache()
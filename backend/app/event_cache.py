@@ -0,0 +1,100 @@
+import os
+import time
+import threading
+from collections import OrderedDict, namedtuple
+from .db import SessionLocal
+from .models import Event
+from .metrics import registry
+
+# how long a guest token stays resolved in this process without asking the database
+EVENT_CACHE_TTL_S = float(os.getenv("EVENT_CACHE_TTL_S", "60"))
+# unknown tokens are remembered for less, so a just-registered event is found quickly
+EVENT_CACHE_NEGATIVE_TTL_S = float(os.getenv("EVENT_CACHE_NEGATIVE_TTL_S", "5"))
+EVENT_CACHE_MAX_ENTRIES = int(os.getenv("EVENT_CACHE_MAX_ENTRIES", "10000"))
+
+EventRef = namedtuple("EventRef", ["id", "event_code", "storage_path"])
+
+class EventTokenCache:
+    """Process-wide token -> EventRef cache with a TTL, bounded LRU.
+
+    cached() answers from memory only (safe on the event loop); load() fetches the misses with
+    one IN query and is meant for a thread pool. Changes made through this process call put() /
+    invalidate(); other processes see them after at most the TTL."""
+
+    def __init__(self, ttl: float = EVENT_CACHE_TTL_S, negative_ttl: float = EVENT_CACHE_NEGATIVE_TTL_S,
+                 max_entries: int = EVENT_CACHE_MAX_ENTRIES):
+        self.ttl = float(ttl)
+        self.negative_ttl = float(negative_ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict() # token -> (expires, EventRef or None)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def cached(self, tokens) -> tuple:
+        """({token: EventRef or None}, [tokens to load]). None means known not to exist."""
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for token in tokens:
+                entry = self._entries.get(token)
+                if entry is None or entry[0] < now:
+                    missing.append(token)
+                    continue
+                self._entries.move_to_end(token)
+                found[token] = entry[1]
+            self.hits += len(found)
+            self.misses += len(missing)
+        return found, missing
+
+    def load(self, tokens) -> dict:
+        """Fetches tokens from the database, caches and returns {token: EventRef or None}."""
+        tokens = list(tokens)
+        if not tokens:
+            return {}
+        db = SessionLocal()
+        try:
+            rows = db.query(Event.id, Event.event_code, Event.storage_path, Event.token).filter(Event.token.in_(tokens)).all()
+        finally:
+            db.close()
+        refs = {token: EventRef(int(eid), code, path) for eid, code, path, token in rows}
+        out = {token: refs.get(token) for token in tokens}
+        for token, ref in out.items():
+            self._store(token, ref)
+        return out
+
+    def get(self, token: str):
+        """EventRef for the token or None (blocking on a miss)."""
+        found, missing = self.cached([token])
+        if missing:
+            found.update(self.load(missing))
+        return found[token]
+
+    def put(self, token: str, ref: EventRef):
+        self._store(token, ref)
+
+    def _store(self, token: str, ref):
+        expires = time.monotonic() + (self.ttl if ref is not None else self.negative_ttl)
+        with self._lock:
+            self._entries[token] = (expires, ref)
+            self._entries.move_to_end(token)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last = False)
+
+    def invalidate(self, token: str = None, event_id: int = None): # type: ignore
+        with self._lock:
+            if token is not None:
+                self._entries.pop(token, None)
+            if event_id is not None:
+                for t in [t for t, (_, ref) in self._entries.items() if ref is not None and ref.id == int(event_id)]:
+                    del self._entries[t]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+# shared by all requests in this process
+event_tokens = EventTokenCache()
+
+registry.counter_fn("vision_event_cache_hits_total", "Guest tokens resolved from memory.", lambda: event_tokens.hits)
+registry.counter_fn("vision_event_cache_misses_total", "Guest tokens looked up in the database.", lambda: event_tokens.misses)
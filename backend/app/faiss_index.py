@@ -1,7 +1,13 @@
 import os
 import json
+import heapq
+import threading
+import itertools
 import numpy as np
 from pathlib import Path
+from .segments import SegmentStore, l2_normalize, atomic_write_json, atomic_save_npy
+from .clusters import EventClusters, clusters_path
+from concurrent.futures import ThreadPoolExecutor
 
 # Try to import faiss; if not available, fallback to numpy search
 try:
@@ -10,132 +16,551 @@ try:
 except Exception:
     FAISS_AVAILABLE = False
 
+# every hit's "score", from either backend, is the cosine of the L2-normalized vectors:
+# ANN indexes are built with the inner-product metric over the same normalized vectors
+ANN_METRIC = "ip"
+
+# index type per event, applied by compact(): "auto" picks by live rows (see choose_index_type),
+# anything else forces one of INDEX_TYPES
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+# auto: from this many live vectors on, 8-bit scalar quantization (numpy path: int8) ...
+INDEX_SQ_MIN_ROWS = int(os.getenv("INDEX_SQ_MIN_ROWS", "500000"))
+# ... and from this many, IVF-PQ
+INDEX_PQ_MIN_ROWS = int(os.getenv("INDEX_PQ_MIN_ROWS", "2000000"))
+# PQ sub-quantizers = bytes per vector (must divide the dimension), IVF lists probed per query
+INDEX_PQ_M = int(os.getenv("INDEX_PQ_M", "64"))
+INDEX_IVF_NPROBE = int(os.getenv("INDEX_IVF_NPROBE", "32"))
+# quantized types fetch k * INDEX_RERANK candidates and re-score them exactly against the
+# float32 vectors on disk (0 = return the approximate scores)
+INDEX_RERANK = int(os.getenv("INDEX_RERANK", "4"))
+# rows dequantized per matmul on the numpy path (bounds temporary memory)
+SEARCH_BLOCK_ROWS = int(os.getenv("SEARCH_BLOCK_ROWS", "65536"))
+# parallel search: the rows scanned brute-force are cut into up to SEARCH_SHARDS row ranges
+# (0 = one per search thread), searched concurrently with the ANN index on a pool of
+# SEARCH_THREADS threads shared by all requests of the process (numpy matmul / partition and
+# faiss release the GIL). Keep SEARCH_THREADS x uvicorn workers near the core count and BLAS
+# single-threaded (OPENBLAS_NUM_THREADS=1), or the two oversubscribe the cores
+SEARCH_THREADS = int(os.getenv("SEARCH_THREADS", "4"))
+SEARCH_SHARDS = int(os.getenv("SEARCH_SHARDS", "0"))
+# ... but no shard smaller than this; smaller events are searched on the caller's thread
+SEARCH_SHARD_MIN_ROWS = int(os.getenv("SEARCH_SHARD_MIN_ROWS", "50000"))
+# HNSW graph degree and build / search beam widths (efSearch is applied at load, no rebuild needed)
+HNSW_M = int(os.getenv("HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "40"))
+HNSW_EF_SEARCH = int(os.getenv("HNSW_EF_SEARCH", "64"))
+# faiss (OpenMP) threads while building an ANN index, and for searches (0 = faiss default)
+ANN_BUILD_THREADS = int(os.getenv("ANN_BUILD_THREADS", "0"))
+ANN_SEARCH_THREADS = int(os.getenv("ANN_SEARCH_THREADS", "0"))
+# vectors sampled to train IVF-PQ / SQ; IVF-PQ needs about this many rows to train at all
+ANN_TRAIN_ROWS = int(os.getenv("ANN_TRAIN_ROWS", "200000"))
+ANN_PQ_MIN_TRAIN = 10000
+# segments appended after the ANN index was built are searched brute-force until they hold this
+# many rows together, then added to it (never a rebuild; meanwhile the store merges them)
+ANN_EXTEND_MIN_ROWS = int(os.getenv("ANN_EXTEND_MIN_ROWS", "10000"))
+
+# name -> (faiss index kind or None, dtype of the numpy scan copy)
+#
+# Resident memory per face at dim 512 (ids included; the float32 vectors of ANN-covered or
+# quantized segments stay on disk and are only read for re-ranking), recall and single-query
+# latency from benchmarks/bench.py --sizes 100000 --index-types ... (k = 10, INDEX_RERANK = 4).
+# The data is uniform random 512-d vectors, a worst case for ANN recall@10 since the
+# true neighbours after the first are barely closer than any other vector; recall@1 (finding
+# the row a query was made from) is the number that matters for face matching.
+#
+#   type       bytes/face   recall@1   recall@10   p50 ms   notes
+#   flat           2056       1.000      1.000      20.4    exact brute force
+#   flat_f16       1032       1.000      1.000     185      numpy float16 -> float32 is slow
+#   flat_i8         524       1.000      1.000      84      numpy path default for big events
+#   hnsw           2320       0.915      0.26        1.2    HNSW_M=32, efSearch=64
+#   hnsw_sq8        784       0.905      0.25        1.2    re-ranked
+#   ivfpq           114       1.000      0.20        0.7    nlist~4*sqrt(n), nprobe=32, m=64, re-ranked
+#
+# ivfpq's fixed part (the nlist coarse centroids, ~2.6 MB at 100k) shrinks per face as events
+# grow: about 80 bytes/face at millions of faces.
+INDEX_TYPES = {
+    "flat": (None, "float32"),
+    "flat_f16": (None, "float16"),
+    "flat_i8": (None, "int8"),
+    "hnsw": ("hnsw", "float32"),
+    "hnsw_sq8": ("hnsw_sq8", "float32"),
+    "ivfpq": ("ivfpq", "float32"),
+}
+
+def choose_index_type(rows: int, requested: str = None) -> str: # type: ignore
+    """Index type for an event of `rows` live vectors: INDEX_TYPE unless "auto", otherwise
+    bigger events get more compact types. ANN types fall back to numpy ones without faiss."""
+    requested = requested or INDEX_TYPE
+    if requested != "auto":
+        if requested not in INDEX_TYPES:
+            print(f"[WARNING] Unknown INDEX_TYPE {requested!r}; choosing by size.")
+        elif INDEX_TYPES[requested][0] is None or FAISS_AVAILABLE:
+            return requested
+    if FAISS_AVAILABLE:
+        if rows >= INDEX_PQ_MIN_ROWS:
+            return "ivfpq"
+        return "hnsw_sq8" if rows >= INDEX_SQ_MIN_ROWS else "hnsw"
+    return "flat_i8" if rows >= INDEX_SQ_MIN_ROWS else "flat"
+
+def top_k(sims: np.ndarray, k: int):
+    """Top-k columns of each row of sims, best first.
+    argpartition is O(n) per row; only the k survivors get sorted."""
+    n = sims.shape[1]
+    k = min(int(k), n)
+    if k <= 0:
+        return np.empty((sims.shape[0], 0), dtype = np.int64)
+    if k < n:
+        idxs = np.argpartition(-sims, k - 1, axis = 1)[:, :k]
+    else:
+        idxs = np.tile(np.arange(n), (sims.shape[0], 1))
+    part = np.take_along_axis(sims, idxs, axis = 1)
+    order = np.argsort(-part, axis = 1, kind = "stable")
+    return np.take_along_axis(idxs, order, axis = 1)
+
+def merge_top_k(parts: list, k: int) -> list:
+    """k-way merge of partial results, each a (scores, ids) pair sorted best first:
+    [(score, id)] of the overall top k. Ties keep the order of parts."""
+    streams = [zip(scores.tolist(), ids.tolist()) for scores, ids in parts if len(scores)]
+    return list(itertools.islice(heapq.merge(*streams, key = lambda hit: -hit[0]), max(int(k), 0)))
+
+# every EventFaissIndex object gets the next one (see EventFaissIndex.generation)
+_generations = itertools.count(1)
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+def search_pool() -> ThreadPoolExecutor:
+    """The process-wide shard search pool, started on first use (after any fork)."""
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers = max(1, SEARCH_THREADS), thread_name_prefix = "search")
+        return _search_pool
+
+def default_index_dir() -> Path:
+    # INDEX_DIR, or default to backend/app/indices
+    if os.getenv("INDEX_DIR"):
+        return Path(os.environ["INDEX_DIR"])
+    return Path(__file__).resolve().parents[0] / "indices"
+
+def index_version_path(event_id: int, index_dir: str = None) -> Path: # type: ignore
+    index_dir = Path(index_dir) if index_dir is not None else default_index_dir()
+    return index_dir / f"event_{int(event_id)}.version"
+
+def duplicates_path(event_id: int, index_dir: str = None) -> Path: # type: ignore
+    index_dir = Path(index_dir) if index_dir is not None else default_index_dir()
+    return index_dir / f"event_{int(event_id)}_duplicates.json"
+
+def read_index_version(event_id: int, index_dir: str = None) -> int: # type: ignore
+    """Returns the version stamp written by the indexer (0 if the event was never stamped)."""
+    try:
+        return int(index_version_path(event_id, index_dir).read_text().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+def bump_index_version(event_id: int, index_dir: str = None) -> int: # type: ignore
+    """Increments the event's version stamp so cached readers (see index_cache) reload it."""
+    path = index_version_path(event_id, index_dir)
+    path.parent.mkdir(parents = True, exist_ok = True)
+    version = read_index_version(event_id, index_dir) + 1
+    tmp = path.with_suffix(".version.tmp")
+    tmp.write_text(str(version))
+    os.replace(tmp, path)
+    return version
+
 class EventFaissIndex:
-    """Unified index interface.
-    If faiss is installed, uses a persistetn HNSW index file.
-    Otherwise falls back to numpy-based search using saved embeddings (.npy) + meta (.json)."""
+    """Unified index interface over the event's SegmentStore (see segments.py).
+    Vectors live in immutable, L2-normalized float32 segments opened with mmap_mode, so several
+    uvicorn workers share the OS page cache instead of private copies. add() writes one new
+    segment; compact() merges small segments and, if faiss is installed, rebuilds a persistent
+    ANN index over them (HNSW, or a quantized one for big events; see INDEX_TYPES). Segments not
+    covered by the ANN index are searched brute-force, over a float16 / int8 copy when the event
+    is big enough; quantized results are re-ranked exactly against the float32 vectors. Big
+    searches fan out over row-range shards on a thread pool (see search())."""
 
     def __init__(self, event_id: int, dim: int = 512, index_dir: str = None): # type: ignore
         self.event_id = int(event_id)
         self.dim = dim
+        # unique per load in this process: IndexRegistry loads a new object whenever the files
+        # change, so (event_id, generation) identifies what a search ran against (query_cache.py)
+        self.generation = next(_generations)
         if index_dir is None:
-            # default to backend/app/indices
-            root = Path(__file__).resolve().parents[0]
-            index_dir = root / "indices"
+            index_dir = default_index_dir()
         self.index_dir = Path(index_dir)
         self.index_dir.mkdir(parents = True, exist_ok = True)
-        self.faiss_index_path = self.index_dir / f"event_{self.event_id}.index"
+        # legacy single-file layout, read (and migrated) by the store
         self.emb_path = self.index_dir / f"event_{self.event_id}_embeddings.npy"
         self.meta_path = self.index_dir / f"event_{self.event_id}_meta.json"
+        self.version_path = index_version_path(self.event_id, self.index_dir)
+        self.clusters_path = clusters_path(self.index_dir, self.event_id)
+        self._clusters = None
+        self.duplicates_path = duplicates_path(self.event_id, self.index_dir)
+        self._duplicates = None
+        self._leader_of = None
+        self.store = SegmentStore(self.index_dir / f"event_{self.event_id}", legacy_emb = self.emb_path, legacy_meta = self.meta_path)
 
         # state
         self.index = None
-        self.id_map = [] # face_db_id_order
+        self.ann_type = None
+        self.ann_ids = np.empty(0, dtype = np.int64) # face_db_id per ANN row
+        self.ann_segments = set()
+        self.ann_covered = [] # covered segments in ANN row order
+        self.ann_offsets = np.zeros(1, dtype = np.int64) # first ANN row of each covered segment
+        self._load_ann()
 
-        # load whichever is available
-        if FAISS_AVAILABLE and self.faiss_index_path.exists():
-            try:
-                self.index = faiss.read_index(str(self.faiss_index_path)) # type: ignore
-                with open(self.meta_path, "r", encoding = "utf-8") as fh:
-                    meta = json.load(fh)
-                    self.id_map = [int(m["face_db_id"]) for m in meta]
-            except Exception:
-                # fallback to numpy
-                FAISS_AVAILABLE_LOCAL = False
-                print(f"Faiss index load failed; falling back to numpy.")
-
-        elif self.emb_path.exists():
-            # no faiss, but embeddings exist - use numpy falback
-            pass
+    def _load_ann(self):
+        ann = self.store.ann
+        if not (FAISS_AVAILABLE and ann):
+            return
+        if ann.get("metric") != ANN_METRIC:
+            # built with L2 by an older version: brute force until compact() rebuilds it
+            print(f"[INFO] Event {self.event_id} ANN index uses an old metric; searching brute-force until it is rebuilt.")
+            return
+        try:
+            index = faiss.read_index(str(self.store.root / ann["file"])) # type: ignore
+        except Exception:
+            # fallback to numpy
+            print(f"Faiss index load failed; falling back to numpy.")
+            return
+        by_name = {s.name: s for s in self.store.segments}
+        covered = [by_name[n] for n in ann["segments"] if n in by_name]
+        if len(covered) != len(ann["segments"]):
+            return
+        self.ann_type = ann.get("type", "hnsw")
+        if self.ann_type == "ivfpq":
+            index.nprobe = INDEX_IVF_NPROBE
         else:
-            # nothin exists yet - empty index
-            pass
-
-    # If faiss is availabale and index is loaded, we can add (only if faiss is installed)
-    def add(self, vectors: np.ndarray, face_ids: list):
-        vectors = vectors.astype("float32")
-        if FAISS_AVAILABLE:
-            # create index if not exists
-            if self.index is None:
-                # HNSW flat index
-                self.index = faiss.IndexHNSWFlat(self.dim, 32) # type: ignore
-                self.index.hnsw.efSearch = 64
-            self.index.add(vectors) # type: ignore
-            # append mapping
-            self.id_map.extend([int(x) for x in face_ids])
-            # save
-            faiss.write_index(self.index, str(self.faiss_index_path)) # type: ignore
-            with open(self.meta_path, "w", encoding = "utf-8") as fh:
-                json.dump([{"face_db_id": fid} for fid in self.id_map], fh)
-        else:
-            # numpy fallback: load old embeddings if exist, append and save
-            if self.emb_path.exists():
-                existing = np.load(str(self.emb_path))
-                new = np.vstack([existing, vectors])
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        self.index = index
+        self.ann_segments = set(ann["segments"])
+        self.ann_covered = covered
+        self.ann_offsets = np.cumsum([0] + [len(s) for s in covered]).astype(np.int64)
+        self.ann_ids = np.concatenate([s.ids for s in covered]) if covered else np.empty(0, dtype = np.int64)
+
+    @property
+    def id_map(self) -> np.ndarray:
+        """face_db_id of every live vector."""
+        return self.store.live_ids()
+
+    def files(self) -> list:
+        """On-disk files backing this index; their stat() is the cache fingerprint."""
+        return self.store.files() + [self.version_path, self.clusters_path, self.duplicates_path]
+
+    @property
+    def clusters(self) -> EventClusters:
+        """The event's identity clusters (written by the indexer), loaded on first use."""
+        if self._clusters is None:
+            self._clusters = EventClusters.load(self.clusters_path, self.dim)
+        return self._clusters
+
+    def memory_bytes(self) -> int:
+        """Rough resident size of this index, used for the cache memory budget. Float32 vectors
+        that are only read to re-rank a few candidates are not counted."""
+        total = 0
+        for seg in self.store.segments:
+            # ids, plus the face metadata face_refs() loads (about 64 bytes a row with shared paths)
+            total += int(seg.ids.nbytes) + len(seg) * 64
+            if self.index is None or seg.name not in self.ann_segments:
+                total += seg.scan_nbytes()
+        if self.index is not None:
+            n = int(self.index.ntotal) # type: ignore
+            links = HNSW_M * 2 * 4 # HNSW level-0 links
+            if self.ann_type == "ivfpq":
+                nlist = int((self.store.ann or {}).get("nlist", 0))
+                total += n * (INDEX_PQ_M + 8) + nlist * self.dim * 4
+            elif self.ann_type == "hnsw_sq8":
+                total += n * (self.dim + links)
             else:
-                new = vectors
-            np.save(str(self.emb_path), new)
-            # append meta mapping
-            if self.meta_path.exists():
-                with open(self.meta_path, "r", encoding = "utf-8") as fh:
-                    meta = json.load(fh)
+                total += n * (self.dim * 4 + links)
+            total += self.ann_ids.nbytes
+        if self.clusters_path.exists():
+            # centroids + memberships, about the size of the file
+            total += os.path.getsize(self.clusters_path)
+        return total
+
+    @property
+    def duplicates(self) -> dict:
+        """Near-duplicate groups found by the indexer: leader image path -> [duplicate paths].
+        Only leaders have faces in the index."""
+        if self._duplicates is None:
+            try:
+                with open(self.duplicates_path, "r", encoding = "utf-8") as fh:
+                    self._duplicates = json.load(fh).get("groups", {})
+            except (OSError, ValueError):
+                self._duplicates = {}
+        return self._duplicates
+
+    def leader_of(self, image_path: str) -> str:
+        """The group leader standing in for image_path (itself when it is in no group)."""
+        if self._leader_of is None:
+            self._leader_of = {d: leader for leader, dups in self.duplicates.items() for d in dups}
+        return self._leader_of.get(image_path, image_path)
+
+    def face_refs(self, face_ids) -> dict:
+        """{face_db_id: (image_path, bbox)} from the segments' metadata, so matching does not need
+        the faces table. Ids without stored metadata are left out for the caller to look up."""
+        wanted = np.unique(np.fromiter((int(x) for x in face_ids), dtype = np.int64))
+        out = {}
+        for seg in self.store.segments:
+            if len(wanted) == 0:
+                break
+            if len(seg) == 0:
+                continue
+            found = self.store.meta_index(seg.name).lookup(wanted)
+            if found:
+                out.update(found)
+                wanted = wanted[~np.isin(wanted, np.fromiter(found, dtype = np.int64))]
+        return out
+
+    def add(self, vectors: np.ndarray, face_ids: list, meta: list = None): # type: ignore
+        """Appends vectors as one new segment (O(batch) I/O, whatever the history size)."""
+        self.store.append(vectors, face_ids, meta)
+        bump_index_version(self.event_id, self.index_dir)
+
+    def remove(self, face_ids):
+        """Tombstones vectors; they stop matching at once and are dropped by the next compact()."""
+        self.store.retire(face_ids)
+        bump_index_version(self.event_id, self.index_dir)
+
+    def compact(self, force: bool = False) -> bool:
+        """Merges small segments, then brings the event to the index type its size calls for
+        (choose_index_type): quantized scan copies for the numpy path and/or an ANN index over
+        every segment. Segments appended since the ANN index was built are added to it once they
+        reach ANN_EXTEND_MIN_ROWS (cost of the batch, not the event); it is only rebuilt from
+        scratch when missing, merged away or of another type.
+        Meant for the indexer after a run, never the request path."""
+        changed = self.store.compact(force = force)
+        ann_type, store_dtype = INDEX_TYPES[choose_index_type(self.store.live_rows())]
+        if ann_type == "ivfpq" and self.store.total_rows() < ANN_PQ_MIN_TRAIN:
+            # too few vectors to train the product quantizer
+            ann_type = "hnsw_sq8"
+        if self.store.quantize(store_dtype):
+            changed = True
+        if ann_type is None:
+            if self.store.ann:
+                self.store.set_ann(None, []) # type: ignore
+                changed = True
+        elif self.store.segments:
+            ann = self.store.ann
+            if (self.index is not None and self.ann_type == ann_type and ann
+                    and set(ann["segments"]) == self.ann_segments):
+                new = [s for s in self.store.segments if s.name not in self.ann_segments]
+                if new and sum(len(s) for s in new) >= ANN_EXTEND_MIN_ROWS:
+                    self._extend_ann(new)
+                    changed = True
             else:
-                meta = []
-            for fid in face_ids:
-                meta.append({"face_db_id": int(fid)})
-            with open(self.meta_path, "w", encoding = 'utf-8') as fh:
-                json.dump(meta, fh, indent = 2)
-            self.id_map = [int(m["face_db_id"]) for m in meta]
-    
-    def search(self, query_vec:np.ndarray, k: int = 5):
+                self._build_ann(ann_type)
+                changed = True
+        if changed:
+            bump_index_version(self.event_id, self.index_dir)
+            self.index = None
+            self.ann_type = None
+            self.ann_segments = set()
+            self._load_ann()
+        return changed
+
+    def _train_sample(self, segments: list) -> np.ndarray:
+        total = sum(len(s) for s in segments)
+        rng = np.random.default_rng(self.event_id)
+        parts = []
+        for seg in segments:
+            n = len(seg) if total <= ANN_TRAIN_ROWS else int(round(ANN_TRAIN_ROWS * len(seg) / total))
+            rows = np.sort(rng.choice(len(seg), min(n, len(seg)), replace = False))
+            parts.append(np.asarray(seg.vectors[rows], dtype = "float32"))
+        return np.ascontiguousarray(np.concatenate(parts))
+
+    def _add_to_ann(self, index, segments: list):
+        # bulk adds: faiss inserts each block on all build threads
+        if ANN_BUILD_THREADS > 0:
+            faiss.omp_set_num_threads(ANN_BUILD_THREADS) # type: ignore
+        try:
+            for seg in segments:
+                for start in range(0, len(seg), SEARCH_BLOCK_ROWS):
+                    index.add(np.ascontiguousarray(seg.vectors[start:start + SEARCH_BLOCK_ROWS], dtype = "float32"))
+        finally:
+            if ANN_BUILD_THREADS > 0:
+                faiss.omp_set_num_threads(ANN_SEARCH_THREADS or os.cpu_count() or 1) # type: ignore
+
+    def _save_ann(self, index, covered: list, params: dict):
+        file_name = f"ann_{self.store.version + 1:06d}.index"
+        tmp = self.store.root / (file_name + ".tmp")
+        faiss.write_index(index, str(tmp)) # type: ignore
+        os.replace(tmp, self.store.root / file_name)
+        self.store.set_ann(file_name, covered, params)
+
+    def _extend_ann(self, segments: list):
+        """Appends segments to the current ANN index: their rows follow the covered ones, so the
+        row -> face_db_id map stays the covered segments' ids in order."""
+        ann = self.store.ann
+        # a fresh copy from disk: searches of this process keep using the loaded one meanwhile
+        index = faiss.read_index(str(self.store.root / ann["file"])) # type: ignore
+        self._add_to_ann(index, segments)
+        params = {k: v for k, v in ann.items() if k not in ("file", "segments")}
+        self._save_ann(index, list(ann["segments"]) + [s.name for s in segments], params)
+
+    def _build_ann(self, kind: str = "hnsw"):
+        segments = list(self.store.segments)
+        total = sum(len(s) for s in segments)
+        params = {"type": kind, "metric": ANN_METRIC}
+        if ANN_BUILD_THREADS > 0:
+            faiss.omp_set_num_threads(ANN_BUILD_THREADS) # type: ignore
+        try:
+            # inner product on normalized vectors = cosine, the numpy path's scale
+            if kind == "ivfpq":
+                # ~4 * sqrt(n) lists, with the >= 39 training points per list k-means asks for
+                nlist = int(max(16, min(65536, 4 * np.sqrt(total), min(total, ANN_TRAIN_ROWS) // 39)))
+                quantizer = faiss.IndexFlatIP(self.dim) # type: ignore
+                index = faiss.IndexIVFPQ(quantizer, self.dim, nlist, INDEX_PQ_M, 8, faiss.METRIC_INNER_PRODUCT) # type: ignore
+                index.train(self._train_sample(segments))
+                params["nlist"] = nlist
+            else:
+                if kind == "hnsw_sq8":
+                    index = faiss.IndexHNSWSQ(self.dim, faiss.ScalarQuantizer.QT_8bit, HNSW_M, faiss.METRIC_INNER_PRODUCT) # type: ignore
+                    index.train(self._train_sample(segments))
+                else:
+                    index = faiss.IndexHNSWFlat(self.dim, HNSW_M, faiss.METRIC_INNER_PRODUCT) # type: ignore
+                index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+                index.hnsw.efSearch = HNSW_EF_SEARCH
+                params.update({"M": HNSW_M, "efConstruction": HNSW_EF_CONSTRUCTION})
+        finally:
+            if ANN_BUILD_THREADS > 0:
+                faiss.omp_set_num_threads(ANN_SEARCH_THREADS or os.cpu_count() or 1) # type: ignore
+        self._add_to_ann(index, segments)
+        self._save_ann(index, [s.name for s in segments], params)
+
+    def _exact_ann_scores(self, q: np.ndarray, rows: np.ndarray) -> np.ndarray:
+        """Cosine of one query against ANN rows, from the float32 vectors of the covered segments."""
+        scores = np.empty(len(rows), dtype = np.float32)
+        seg_of = np.searchsorted(self.ann_offsets, rows, side = "right") - 1
+        for j in np.unique(seg_of):
+            sel = seg_of == j
+            local = rows[sel] - self.ann_offsets[j]
+            order = np.argsort(local)
+            vecs = np.asarray(self.ann_covered[j].vectors[local[order]], dtype = "float32")
+            out = np.empty(len(local), dtype = np.float32)
+            out[order] = vecs @ q
+            scores[sel] = out
+        return scores
+
+    def _scan_range(self, q: np.ndarray, seg, start: int, end: int, k: int):
+        """(row indexes, scores) of the top-k rows start..end of a segment per query; tombstoned rows
+        score -inf. Quantized segments are scanned block by block and their top k * INDEX_RERANK
+        re-scored exactly."""
+        if seg.codes is None:
+            # cosine similarity = dot product on normalized vectors; one matmul for the whole batch
+            sims = seg.scores(q, start, end)
+            if seg.alive is not None:
+                sims[:, ~seg.alive[start:end]] = -np.inf
+            idxs = top_k(sims, k)
+            return idxs + start, np.take_along_axis(sims, idxs, axis = 1)
+
+        fetch = k * INDEX_RERANK if INDEX_RERANK > 0 else k
+        part_idx, part_scores = [], []
+        for block in range(start, end, SEARCH_BLOCK_ROWS):
+            block_end = min(block + SEARCH_BLOCK_ROWS, end)
+            sims = seg.scores(q, block, block_end)
+            if seg.alive is not None:
+                sims[:, ~seg.alive[block:block_end]] = -np.inf
+            idxs = top_k(sims, fetch)
+            part_idx.append(idxs + block)
+            part_scores.append(np.take_along_axis(sims, idxs, axis = 1))
+        idxs = np.concatenate(part_idx, axis = 1)
+        scores = np.concatenate(part_scores, axis = 1)
+        order = top_k(scores, fetch)
+        idxs = np.take_along_axis(idxs, order, axis = 1)
+        scores = np.take_along_axis(scores, order, axis = 1)
+        live = np.isfinite(scores)
+        if INDEX_RERANK <= 0 or not live.any():
+            return idxs[:, :k], scores[:, :k]
+
+        # exact re-rank: read only the candidate rows of the float32 file
+        rows = np.unique(idxs[live])
+        exact_vecs = np.asarray(seg.vectors[rows], dtype = "float32")
+        pos = np.minimum(np.searchsorted(rows, idxs), len(rows) - 1)
+        exact = np.einsum("qd,qkd->qk", q, exact_vecs[pos])
+        exact[~live] = -np.inf
+        order = top_k(exact, k)
+        return np.take_along_axis(idxs, order, axis = 1), np.take_along_axis(exact, order, axis = 1)
+
+    def _search_shard(self, q: np.ndarray, seg, start: int, end: int, k: int, min_score):
+        """Per query (scores, ids) best first, over rows start..end of a segment."""
+        idxs, scores = self._scan_range(q, seg, start, end, k)
+        if min_score is not None:
+            scores[scores < min_score] = -np.inf
+        out = []
+        for r in range(q.shape[0]):
+            live = np.isfinite(scores[r])
+            out.append((scores[r][live], seg.ids[idxs[r][live]]))
+        return out
+
+    def _search_ann(self, q: np.ndarray, k: int, min_score):
+        """Per query (scores, ids) best first, from the ANN index (tombstoned rows dropped)."""
+        # over-fetch so tombstoned rows can be dropped without starving the result,
+        # and quantized indexes fetch extra candidates for the exact re-rank
+        rerank = self.ann_type != "hnsw" and INDEX_RERANK > 0
+        n_dead = len(self.store.tombstones)
+        fetch = (k * INDEX_RERANK if rerank else k) + n_dead
+        D, I = self.index.search(q, min(fetch, int(self.index.ntotal))) # type: ignore
+        dead = np.fromiter(self.store.tombstones, dtype = np.int64) if n_dead else None
+        out = []
+        for r in range(q.shape[0]):
+            rows = I[r][I[r] >= 0]
+            ids = self.ann_ids[rows]
+            scores = D[r][I[r] >= 0]
+            if dead is not None:
+                live = ~np.isin(ids, dead)
+                rows, ids, scores = rows[live], ids[live], scores[live]
+            if rerank:
+                scores = self._exact_ann_scores(q[r], rows)
+            if min_score is not None:
+                keep = scores >= min_score
+                ids, scores = ids[keep], scores[keep]
+            order = np.argsort(-scores, kind = "stable")[:k]
+            out.append((scores[order], ids[order]))
+        return out
+
+    def shards(self) -> list:
+        """(segment, start, end) row ranges the brute-force part of a search is split into:
+        every segment the ANN index does not cover, cut into about equal ranges so that there
+        are at most SEARCH_SHARDS (or SEARCH_THREADS) of them of SEARCH_SHARD_MIN_ROWS or more."""
+        segs = [s for s in self.store.segments
+                if len(s) and not (self.index is not None and s.name in self.ann_segments)]
+        total = sum(len(s) for s in segs)
+        if total == 0:
+            return []
+        n = max(1, min(SEARCH_SHARDS or SEARCH_THREADS, total // max(SEARCH_SHARD_MIN_ROWS, 1)))
+        out = []
+        for seg in segs:
+            # a segment gets its share of the n shards (at least one), cut evenly
+            pieces = max(1, int(round(n * len(seg) / total)))
+            bounds = np.linspace(0, len(seg), pieces + 1).astype(np.int64)
+            out.extend((seg, int(a), int(b)) for a, b in zip(bounds[:-1], bounds[1:]))
+        return out
+
+    def search(self, query_vec:np.ndarray, k: int = 5, min_score: float = None): # type: ignore
         """Query_vec: shape (1, dim) or (N, dim)
-        Returns: list of rows: each row is list of dicts: {"face_db_id", "score"}
+        Returns: list of rows: each row is list of dicts: {"face_db_id", "score"}, where score is
+        the cosine similarity whichever backend served the hit. With min_score, hits below it are
+        dropped inside the index, before any result is built or merged.
+
+        The ANN index and each shard (see shards()) yield their own top k, searched concurrently
+        on search_pool() once the event is big enough; the partial lists are k-way merged.
         """
-        q = np.asarray(query_vec, dtype = "float32")
-        if q.ndim == 1:
-            q = q.reshape(1, -1)
-
-        if FAISS_AVAILABLE and self.index is not None:
-            D, I = self.index.search(q, k) # type: ignore
-            out = []
-            for dist_list, idx_list in zip(D, I):
-                row = []
-                for dist, idx in zip(dist_list, idx_list):
-                    if idx < 0:
-                        continue
-                    face_db_id = self.id_map[idx]
-                    row.append({"face_db_id": int(face_db_id), "distance": float(dist)})
-                out.append(row)
-            return out
-        
-        # numpy fallback
-        if not self.emb_path.exists():
-            return[[] for _ in range(q.shape[0])]
-        
-        emb = np.load(str(self.emb_path))
-        # ensure normalized
-        def l2norm(a):
-            a = a.astype('float32')
-            norms = np.linalg.norm(a, axis = 1, keepdims = True)
-            norms[norms == 0] = 1.0
-            return a / norms
-        emb_norm = l2norm(emb)
-        q_norm = l2norm(q)
-        # cosine similarity = dot product on normalized vectors
-        sims = np.dot(q_norm, emb_norm.T)
-        results = []
-        for row in sims:
-            # get top k indices (descending)
-            idxs = np.argsort(-row)[:k]
-            row_res = []
-            for idx in idxs:
-                score = float(row[idx])
-                face_db_id = None
-                if self.meta_path.exists():
-                    with open(self.meta_path, "r", encoding = "utf-8") as fh:
-                        meta = json.load(fh)
-                        if idx < len(meta):
-                            face_db_id = int(meta[idx]["face_db_id"])
-                row_res.append({"face_db_id": face_db_id, "score": score})
-            results.append(row_res)
-        return results
\ No newline at end of file
+        q = l2_normalize(query_vec)
+        n_q = q.shape[0]
+        tasks = []
+        if FAISS_AVAILABLE and self.index is not None and self.index.ntotal > 0:
+            tasks.append((self._search_ann, (q, k, min_score)))
+        shards = self.shards()
+        tasks.extend((self._search_shard, (q, seg, start, end, k, min_score)) for seg, start, end in shards)
+
+        scanned = sum(end - start for _, start, end in shards)
+        if len(tasks) > 1 and SEARCH_THREADS > 1 and scanned >= SEARCH_SHARD_MIN_ROWS:
+            # the caller's thread takes the first task instead of idling on the pool
+            futures = [search_pool().submit(fn, *args) for fn, args in tasks[1:]]
+            parts = [tasks[0][0](*tasks[0][1])]
+            parts.extend(f.result() for f in futures)
+        else:
+            parts = [fn(*args) for fn, args in tasks]
+
+        return [[{"face_db_id": int(fid), "score": float(score)} for score, fid in merge_top_k([p[r] for p in parts], k)]
+                for r in range(n_q)]
@@ -0,0 +1,91 @@
+import os
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from fastapi import Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+# results are access-controlled photos of people: cacheable by the guest's browser only
+IMAGE_CACHE_CONTROL = os.getenv("IMAGE_CACHE_CONTROL", "private, max-age=604800")
+CHUNK_SIZE = 256 * 1024
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    # weak comparison, as required for If-None-Match
+    return any(t.removeprefix("W/") == etag for t in tags)
+
+def _parse_range(header: str, size: int):
+    """(start, end) inclusive for a single 'bytes=' range, None to ignore the header
+    (multi-range or other units), or "invalid" when unsatisfiable."""
+    if not header.startswith("bytes=") or "," in header:
+        return None
+    spec = header[len("bytes="):].strip()
+    start_s, _, end_s = spec.partition("-")
+    try:
+        if start_s == "":
+            # suffix range: last N bytes
+            n = int(end_s)
+            if n <= 0:
+                return "invalid"
+            return max(0, size - n), size - 1
+        start = int(start_s)
+        end = int(end_s) if end_s else size - 1
+    except ValueError:
+        return None
+    if start >= size or end < start:
+        return "invalid"
+    return start, min(end, size - 1)
+
+def _iter_file(path: str, start: int, length: int):
+    with open(path, "rb") as fh:
+        fh.seek(start)
+        while length > 0:
+            chunk = fh.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def serve_file(request: Request, path: str, etag: str = None, media_type: str = None, # type: ignore
+               cache_control: str = IMAGE_CACHE_CONTROL, mtime: float = None): # type: ignore
+    """FileResponse with validators: ETag / Last-Modified, 304 for If-None-Match /
+    If-Modified-Since, and 206 / 416 for single byte ranges (honouring If-Range).
+    mtime overrides the file's own (derivatives report their source's)."""
+    st = os.stat(path)
+    etag = f'"{etag}"' if etag else f'"{st.st_mtime_ns:x}-{st.st_size:x}"'
+    mtime = st.st_mtime if mtime is None else mtime
+    last_modified = formatdate(mtime, usegmt = True)
+    media_type = media_type or mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": last_modified,
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+    }
+
+    inm = request.headers.get("if-none-match")
+    ims = request.headers.get("if-modified-since")
+    if inm is not None:
+        if _etag_matches(inm, etag):
+            return Response(status_code = 304, headers = headers)
+    elif ims is not None:
+        try:
+            if int(mtime) <= parsedate_to_datetime(ims).timestamp():
+                return Response(status_code = 304, headers = headers)
+        except (TypeError, ValueError):
+            pass
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range in (etag, last_modified)):
+        rng = _parse_range(range_header, st.st_size)
+        if rng == "invalid":
+            return Response(status_code = 416, headers = {**headers, "Content-Range": f"bytes */{st.st_size}"})
+        if rng is not None:
+            start, end = rng
+            length = end - start + 1
+            headers.update({"Content-Range": f"bytes {start}-{end}/{st.st_size}", "Content-Length": str(length)})
+            return StreamingResponse(_iter_file(path, start, length), status_code = 206, media_type = media_type, headers = headers)
+
+    return FileResponse(path, media_type = media_type, headers = headers, stat_result = st)
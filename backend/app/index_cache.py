@@ -0,0 +1,136 @@
+import os
+import threading
+from collections import OrderedDict
+from .faiss_index import EventFaissIndex
+from .metrics import registry
+
+# memory budget for all cached event indexes (MB)
+INDEX_CACHE_MAX_MB = int(os.getenv("INDEX_CACHE_MAX_MB", "1024"))
+
+def _fingerprint(idx: EventFaissIndex) -> tuple:
+    """(mtime_ns, size) of every file backing the index; missing files count as (0, 0).
+    Any write by worker/indexer.py (or a version stamp bump) changes the fingerprint."""
+    fp = []
+    for p in idx.files():
+        try:
+            st = os.stat(p)
+            fp.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            fp.append((0, 0))
+    return tuple(fp)
+
+class _Entry:
+    __slots__ = ("index", "fingerprint", "nbytes")
+
+    def __init__(self, index: EventFaissIndex, fingerprint: tuple, nbytes: int):
+        self.index = index
+        self.fingerprint = fingerprint
+        self.nbytes = nbytes
+
+class IndexRegistry:
+    """Process-wide LRU cache of loaded EventFaissIndex objects.
+    Entries are evicted least-recently-used first once the summed memory_bytes()
+    exceeds max_bytes, and reloaded when the event's index files change on disk."""
+
+    def __init__(self, max_bytes: int = INDEX_CACHE_MAX_MB * 1024 * 1024, index_dir: str = None): # type: ignore
+        self.max_bytes = int(max_bytes)
+        self.index_dir = index_dir
+        self._entries = OrderedDict() # (event_id, dim) -> _Entry
+        self._lock = threading.Lock()
+        # per-key load locks so concurrent misses for one event load it only once
+        self._load_locks = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, event_id: int, dim: int = 512) -> EventFaissIndex:
+        key = (int(event_id), int(dim))
+        with self._lock:
+            entry = self._entries.get(key)
+            load_lock = self._load_locks.setdefault(key, threading.Lock())
+
+        if entry is not None:
+            if _fingerprint(entry.index) == entry.fingerprint:
+                with self._lock:
+                    if self._entries.get(key) is entry:
+                        self._entries.move_to_end(key)
+                    self.hits += 1
+                return entry.index
+
+        with load_lock:
+            # another request may have reloaded it while we waited
+            with self._lock:
+                current = self._entries.get(key)
+            if current is not None and current is not entry and _fingerprint(current.index) == current.fingerprint:
+                with self._lock:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                return current.index
+
+            idx = EventFaissIndex(key[0], dim = key[1], index_dir = self.index_dir)
+            fp = _fingerprint(idx)
+            new_entry = _Entry(idx, fp, idx.memory_bytes())
+            with self._lock:
+                self.misses += 1
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self.total_bytes -= old.nbytes
+                    self.invalidations += 1
+                self._entries[key] = new_entry
+                self.total_bytes += new_entry.nbytes
+                self._evict_locked(keep = key)
+            return idx
+
+    def _evict_locked(self, keep: tuple):
+        while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+            key, entry = next(iter(self._entries.items()))
+            if key == keep:
+                # the newest entry alone exceeds the budget; keep it anyway
+                self._entries.move_to_end(key)
+                if len(self._entries) == 1:
+                    break
+                continue
+            self._entries.pop(key)
+            self.total_bytes -= entry.nbytes
+            self.evictions += 1
+
+    def invalidate(self, event_id: int):
+        """Drops every cached index of an event (e.g. after the API re-registers it)."""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == int(event_id)]:
+                entry = self._entries.pop(key)
+                self.total_bytes -= entry.nbytes
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+# shared by all requests in this process
+index_registry = IndexRegistry()
+
+def _stat(key: str):
+    return lambda: index_registry.stats()[key]
+
+registry.gauge("vision_index_cache_entries", "Event indexes held in memory.", fn = _stat("entries"))
+registry.gauge("vision_index_cache_bytes", "Bytes of event indexes held in memory.", fn = _stat("bytes"))
+registry.gauge("vision_index_cache_max_bytes", "Index cache memory budget.", fn = _stat("max_bytes"))
+registry.counter_fn("vision_index_cache_hits_total", "Index lookups served from memory.", _stat("hits"))
+registry.counter_fn("vision_index_cache_misses_total", "Index lookups that loaded from disk.", _stat("misses"))
+registry.counter_fn("vision_index_cache_evictions_total", "Indexes evicted to stay under budget.", _stat("evictions"))
+registry.counter_fn("vision_index_cache_invalidations_total", "Indexes dropped because their files changed.", _stat("invalidations"))
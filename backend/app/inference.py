@@ -0,0 +1,164 @@
+import os
+import asyncio
+import time
+import threading
+from collections import deque, Counter
+from concurrent.futures import ThreadPoolExecutor
+from .metrics import registry
+
+# largest batch handed to the model at once
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "8"))
+# how long the first request of a batch waits for company
+INFERENCE_MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+# queued requests beyond this are rejected (back-pressure) instead of piling up
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "64"))
+# batches running concurrently (each ONNX session call also uses intra-op threads)
+INFERENCE_THREADS = int(os.getenv("INFERENCE_THREADS", "2"))
+
+BATCH_SIZE = registry.histogram("vision_inference_batch_size", "Items per model call.", ("executor",), buckets = (1, 2, 4, 8, 16, 32))
+QUEUE_WAIT_SECONDS = registry.histogram("vision_inference_queue_wait_seconds", "Time from submit() to the start of the item's batch.", ("executor",))
+
+class InferenceOverloaded(Exception):
+    """Raised by submit() when the queue is full; callers should answer 503."""
+
+class BatchingExecutor:
+    """Dynamic micro-batching of CPU-heavy model calls, off the event loop.
+
+    Concurrent submit() calls are grouped into batches of up to max_batch items, waiting at most
+    max_wait_ms after the first item arrives. batch_fn(items) -> results runs on a thread pool,
+    and every caller gets its own result (or exception) back through its future."""
+
+    def __init__(self, batch_fn, max_batch: int = INFERENCE_MAX_BATCH, max_wait_ms: float = INFERENCE_MAX_WAIT_MS,
+                 max_queue: int = INFERENCE_MAX_QUEUE, threads: int = INFERENCE_THREADS, name: str = "inference"):
+        self.batch_fn = batch_fn
+        self.max_batch = max(1, int(max_batch))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue = max(1, int(max_queue))
+        self.threads = max(1, int(threads))
+        self.name = name
+        self._pool = ThreadPoolExecutor(max_workers = self.threads, thread_name_prefix = name)
+        self._queue = None
+        self._loop = None
+        self._collector = None
+        self._slots = None
+        self._lock = threading.Lock()
+        # metrics
+        self.submitted = 0
+        self.rejected = 0
+        self.failed = 0
+        self.batches = 0
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen = 2048) # seconds, submit -> result
+        self.queue_waits = deque(maxlen = 2048) # seconds, submit -> batch start
+
+    def _ensure_started(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._collector is None or self._collector.done():
+            self._loop = loop
+            self._queue = asyncio.Queue(maxsize = self.max_queue)
+            self._slots = asyncio.Semaphore(self.threads)
+            self._collector = loop.create_task(self._collect())
+
+    async def submit(self, item):
+        """Queues one item and returns its result once its batch has run."""
+        self._ensure_started()
+        fut = self._loop.create_future() # type: ignore
+        try:
+            self._queue.put_nowait((item, fut, time.perf_counter())) # type: ignore
+        except asyncio.QueueFull:
+            self.rejected += 1
+            raise InferenceOverloaded(f"{self.name} queue is full ({self.max_queue} waiting)")
+        self.submitted += 1
+        return await fut
+
+    async def submit_many(self, items: list) -> list:
+        return list(await asyncio.gather(*(self.submit(x) for x in items)))
+
+    async def _collect(self):
+        queue = self._queue
+        while True:
+            first = await queue.get() # type: ignore
+            batch = [first]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout)) # type: ignore
+                except asyncio.TimeoutError:
+                    break
+            # at most `threads` batches in flight; the rest keep accumulating in the queue
+            await self._slots.acquire() # type: ignore
+            self._loop.create_task(self._run(batch)) # type: ignore
+
+    async def _run(self, batch: list):
+        started = time.perf_counter()
+        try:
+            items = [item for item, _, _ in batch]
+            try:
+                results = await self._loop.run_in_executor(self._pool, self.batch_fn, items) # type: ignore
+                error = None
+            except Exception as e:
+                results, error = None, e
+            done = time.perf_counter()
+            with self._lock:
+                self.batches += 1
+                self.batch_sizes[len(batch)] += 1
+                for _, _, t_submit in batch:
+                    self.queue_waits.append(started - t_submit)
+                    self.latencies.append(done - t_submit)
+                if error is not None:
+                    self.failed += len(batch)
+            BATCH_SIZE.observe(len(batch), executor = self.name)
+            for _, _, t_submit in batch:
+                QUEUE_WAIT_SECONDS.observe(started - t_submit, executor = self.name)
+            for i, (_, fut, _) in enumerate(batch):
+                if fut.done():
+                    # caller went away (client disconnect / cancellation)
+                    continue
+                if error is not None:
+                    fut.set_exception(error)
+                else:
+                    fut.set_result(results[i]) # type: ignore
+        finally:
+            self._slots.release() # type: ignore
+
+    def stats(self) -> dict:
+        with self._lock:
+            lat = sorted(self.latencies)
+            waits = sorted(self.queue_waits)
+            sizes = dict(sorted(self.batch_sizes.items()))
+        def pct(values, p):
+            return round(values[min(len(values) - 1, int(p * len(values)))] * 1000, 2) if values else None
+        return {
+            "queue_depth": self._queue.qsize() if self._queue is not None else 0,
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "batches": self.batches,
+            "mean_batch_size": round(sum(k * v for k, v in sizes.items()) / max(self.batches, 1), 2),
+            "batch_sizes": sizes,
+            "latency_ms": {"p50": pct(lat, 0.5), "p95": pct(lat, 0.95), "p99": pct(lat, 0.99)},
+            "queue_wait_ms": {"p50": pct(waits, 0.5), "p99": pct(waits, 0.99)},
+        }
+
+def _embed_selfies(images: list) -> list:
+    # imported lazily so importing this module does not load the models
+    from .utils.embeddings import get_embeddings_from_image_bytes_batch
+    return get_embeddings_from_image_bytes_batch(images)
+
+# selfie bytes -> largest-face embedding (zero-vector when no face)
+selfie_executor = BatchingExecutor(_embed_selfies, name = "selfie-inference")
+
+def _executor_series(attr: str):
+    return lambda: [({"executor": ex.name}, getattr(ex, attr)) for ex in (selfie_executor,)]
+
+def _queue_depth(ex: BatchingExecutor) -> int:
+    return ex._queue.qsize() if ex._queue is not None else 0
+
+registry.gauge("vision_inference_queue_depth", "Items waiting for a batch.", ("executor",),
+               fn = lambda: [({"executor": ex.name}, _queue_depth(ex)) for ex in (selfie_executor,)])
+registry.counter_fn("vision_inference_submitted_total", "Items accepted by submit().", _executor_series("submitted"), ("executor",))
+registry.counter_fn("vision_inference_rejected_total", "Items refused because the queue was full.", _executor_series("rejected"), ("executor",))
+registry.counter_fn("vision_inference_failed_total", "Items whose batch raised.", _executor_series("failed"), ("executor",))
@@ -0,0 +1,177 @@
+import os
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import text
+from .db import SessionLocal
+from .models import IndexJob
+
+# indexing jobs running at once across every worker host
+JOB_MAX_RUNNING = int(os.getenv("JOB_MAX_RUNNING", "2"))
+# ... and per tenant, so one studio's bulk re-index cannot starve the others
+JOB_MAX_PER_TENANT = int(os.getenv("JOB_MAX_PER_TENANT", "1"))
+# default priorities (lower runs first): a freshly registered event beats a re-index
+JOB_PRIORITY_NEW = int(os.getenv("JOB_PRIORITY_NEW", "0"))
+JOB_PRIORITY_REINDEX = int(os.getenv("JOB_PRIORITY_REINDEX", "10"))
+# a running job whose worker has not reported for this long is requeued (worker crashed / host lost)
+JOB_STALE_S = float(os.getenv("JOB_STALE_S", "120"))
+# a job requeued this many times is marked failed instead
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# queued jobs examined per claim when the head of the queue is blocked by tenant limits
+JOB_CLAIM_SCAN = int(os.getenv("JOB_CLAIM_SCAN", "100"))
+# serializes claims on Postgres, so the running-job limits hold across worker hosts
+JOB_LOCK_KEY = 0x6A6F6273
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo = None)
+
+class JobQueue:
+    """Durable queue of indexing jobs in the index_jobs table.
+
+    The API enqueues, worker processes (worker/job_worker.py) claim, report progress and finish.
+    A claim picks the queued job with the lowest (priority, id) whose tenant and the whole queue
+    are under their running limits and whose event has no job running already. Crashed workers
+    stop heart-beating and their jobs go back to the queue; the indexer's manifest checkpoint
+    makes the rerun resume rather than restart."""
+
+    def __init__(self, session_factory = SessionLocal):
+        self.session_factory = session_factory
+
+    def enqueue(self, event_id: int, folder: str, tenant: str = "default", priority: int = None, # type: ignore
+                incremental: bool = True) -> int:
+        """Queues a run for the event and returns the job id. An event that already has a queued
+        job keeps that one (raised to the better priority, and to a full rebuild if asked)."""
+        priority = JOB_PRIORITY_NEW if priority is None else int(priority)
+        db = self.session_factory()
+        try:
+            job = db.query(IndexJob).filter(IndexJob.event_id == event_id, IndexJob.status == "queued").first()
+            if job is not None:
+                job.priority = min(job.priority, priority)
+                job.incremental = job.incremental and incremental
+                job.folder = folder
+            else:
+                job = IndexJob(event_id = event_id, tenant = tenant or "default", folder = folder, incremental = incremental,
+                               priority = priority, status = "queued", created_at = utcnow())
+                db.add(job)
+            db.commit()
+            return job.id
+        finally:
+            db.close()
+
+    def claim(self, worker: str):
+        """Marks the next runnable job as running for this worker. Returns
+        {"id", "event_id", "folder", "incremental"} or None when nothing may run now."""
+        db = self.session_factory()
+        try:
+            # every lost race means another worker claimed a job, so this ends
+            while True:
+                if db.bind.dialect.name == "postgresql":
+                    db.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": JOB_LOCK_KEY})
+                running = db.query(IndexJob.tenant, IndexJob.event_id).filter(IndexJob.status == "running").all()
+                if len(running) >= JOB_MAX_RUNNING:
+                    db.rollback()
+                    return None
+                per_tenant = Counter(tenant for tenant, _ in running)
+                busy_events = {event_id for _, event_id in running}
+                queued = (db.query(IndexJob).filter(IndexJob.status == "queued")
+                          .order_by(IndexJob.priority, IndexJob.id).limit(JOB_CLAIM_SCAN).all())
+                for job in queued:
+                    if per_tenant[job.tenant] >= JOB_MAX_PER_TENANT or job.event_id in busy_events:
+                        continue
+                    now = utcnow()
+                    # conditional update: a concurrent claimer (SQLite has no advisory lock) loses cleanly
+                    claimed = (db.query(IndexJob).filter(IndexJob.id == job.id, IndexJob.status == "queued")
+                               .update({"status": "running", "worker": worker, "attempts": IndexJob.attempts + 1,
+                                        "started_at": now, "heartbeat_at": now, "files_done": 0, "files_total": 0,
+                                        "faces": 0, "error": None}, synchronize_session = False))
+                    db.commit()
+                    if claimed:
+                        return {"id": job.id, "event_id": job.event_id, "folder": job.folder, "incremental": job.incremental}
+                    # lost it: the winner changed the running counts, so look again from the top
+                    break
+                else:
+                    db.rollback()
+                    return None
+        finally:
+            db.close()
+
+    def progress(self, job_id: int, files_done: int = None, files_total: int = None, faces: int = None): # type: ignore
+        """Heartbeat, optionally with progress counters."""
+        values = {"heartbeat_at": utcnow()}
+        for name, value in (("files_done", files_done), ("files_total", files_total), ("faces", faces)):
+            if value is not None:
+                values[name] = int(value)
+        db = self.session_factory()
+        try:
+            db.query(IndexJob).filter(IndexJob.id == job_id, IndexJob.status == "running").update(values, synchronize_session = False)
+            db.commit()
+        finally:
+            db.close()
+
+    def finish(self, job_id: int, error: str = None): # type: ignore
+        self._set_status(job_id, "failed" if error else "done", error = error, finished_at = utcnow())
+
+    def release(self, job_id: int):
+        """Puts a running job back in the queue (graceful worker shutdown); not counted as an attempt."""
+        self._set_status(job_id, "queued", worker = None, attempts = IndexJob.attempts - 1)
+
+    def _set_status(self, job_id: int, status: str, **values):
+        db = self.session_factory()
+        try:
+            db.query(IndexJob).filter(IndexJob.id == job_id, IndexJob.status == "running").update(
+                {"status": status, **values}, synchronize_session = False)
+            db.commit()
+        finally:
+            db.close()
+
+    def requeue_stale(self) -> int:
+        """Requeues running jobs whose worker stopped heart-beating; returns how many."""
+        cutoff = utcnow() - timedelta(seconds = JOB_STALE_S)
+        db = self.session_factory()
+        try:
+            stale = [j for j in db.query(IndexJob).filter(IndexJob.status == "running").all()
+                     if j.heartbeat_at is None or j.heartbeat_at < cutoff]
+            for job in stale:
+                print(f"[WARNING] Job {job.id} (event {job.event_id}) lost its worker {job.worker}")
+                if job.attempts >= JOB_MAX_ATTEMPTS:
+                    job.status, job.error, job.finished_at = "failed", f"worker {job.worker} stopped responding", utcnow()
+                else:
+                    job.status, job.worker = "queued", None
+            db.commit()
+            return len(stale)
+        finally:
+            db.close()
+
+    def status(self, db, event_id: int):
+        """Progress of the event's most recent job as a dict, or None if it never had one."""
+        job = db.query(IndexJob).filter(IndexJob.event_id == event_id).order_by(IndexJob.id.desc()).first()
+        if job is None:
+            return None
+        out = {
+            "job_id": job.id,
+            "status": job.status,
+            "tenant": job.tenant,
+            "priority": job.priority,
+            "incremental": job.incremental,
+            "attempts": job.attempts,
+            "files_done": job.files_done or 0,
+            "files_total": job.files_total or 0,
+            "faces": job.faces or 0,
+            "eta_s": None,
+            "queue_position": None,
+            "error": job.error,
+            "created_at": job.created_at,
+            "started_at": job.started_at,
+            "finished_at": job.finished_at,
+        }
+        if job.status == "queued":
+            out["queue_position"] = db.query(IndexJob).filter(
+                IndexJob.status == "queued",
+                (IndexJob.priority < job.priority) | ((IndexJob.priority == job.priority) & (IndexJob.id < job.id)),
+            ).count()
+        elif job.status == "running" and job.started_at is not None and out["files_done"] > 0:
+            elapsed = (utcnow() - job.started_at).total_seconds()
+            remaining = max(out["files_total"] - out["files_done"], 0)
+            out["eta_s"] = round(elapsed * remaining / out["files_done"], 1)
+        return out
+
+job_queue = JobQueue()
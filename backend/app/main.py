@@ -1,11 +1,17 @@
 import os
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import FileResponse
+import time
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from .db import init_db, get_db_session, SessionLocal
-from .models import Event
 from .api.studio import router as studio_router
 from .api.match import router as match_router
+from .derivatives import derivative_cache, DERIVATIVE_SIZES
+from .http_files import serve_file
+from .sources import source_for, SourceUnavailable
+from .path_index import event_paths, image_ids
+from .metrics import registry, profiler, stage, begin_request, end_request, server_timing, HTTP_SECONDS, TIMING_HEADER, PROFILER_ENABLED
 
 app = FastAPI(title="Vision Face MVP - backend")
 
@@ -18,10 +24,32 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.middleware("http")
+async def request_metrics(request: Request, call_next):
+    timings, token = begin_request()
+    t0 = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        end_request(token)
+    total = time.perf_counter() - t0
+    # label by route template, not raw URL, to keep the series count bounded
+    route = getattr(request.scope.get("route"), "path", "unmatched")
+    HTTP_SECONDS.observe(total, route=route, method=request.method, status=response.status_code)
+    if TIMING_HEADER:
+        response.headers["Server-Timing"] = server_timing(timings, total)
+    return response
+
 @app.on_event("startup")
 def startup_event():
     # create tables (dev only)
     init_db()
+    # authorization index of event roots for /images
+    event_paths.refresh_from_db(force=True)
+    if os.getenv("PRELOAD_MODELS") == "startup":
+        # pay the model load before the first selfie instead of during it
+        from .utils.embeddings import preload_models
+        preload_models()
 
 app.include_router(studio_router, prefix="/api/v1/studio")
 app.include_router(match_router, prefix="/api/v1")
@@ -30,27 +58,62 @@ app.include_router(match_router, prefix="/api/v1")
 def root():
     return {"status": "ok"}
 
-@app.get("/api/v1/images")
-def get_image(path: str = Query(...)):
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/debug/profile")
+async def debug_profile(seconds: float = Query(10.0, gt=0), interval_ms: float = Query(5.0, gt=0)):
+    # samples every thread (request handlers, inference pool) while the caller waits
+    if not PROFILER_ENABLED:
+        raise HTTPException(status_code=404, detail="Not Found")
+    try:
+        stacks = await run_in_threadpool(profiler.sample, seconds, interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return PlainTextResponse(stacks)
+
+def _authorize_image(path, id) -> str:
     # Security check: ensure path belongs to a registered event
-    db = SessionLocal()
-    events = db.query(Event).all()
-    allowed = False
-    for ev in events:
-        # normalize paths for comparison
-        if os.path.commonpath([os.path.abspath(path), os.path.abspath(ev.storage_path)]) == os.path.abspath(ev.storage_path):
-            allowed = True
-            break
-    db.close()
-    
-    if not allowed:
+    if id is not None:
+        # opaque ids from /match are signed by us, so verifying the signature is the authorization
+        resolved = image_ids.verify(id)
+        if resolved is None:
+            raise HTTPException(status_code=403, detail="Access denied to this image")
+        _, path = resolved
+    elif path is None:
+        raise HTTPException(status_code=400, detail="Either id or path is required")
+    elif event_paths.resolve(path) is None:
         # In a real app, strictly enforce this. 
         # For MVP/Demo, if the path exists and is an image, we might be lenient, 
         # but let's stick to security best practices even for MVP.
         # If the path is not in a registered folder, deny it.
         raise HTTPException(status_code=403, detail="Access denied to this path")
+    return path
+
+@app.get("/api/v1/images")
+def get_image(request: Request, path: str = Query(None), id: str = Query(None), size: str = Query("full")):
+    with stage("auth"):
+        path = _authorize_image(path, id)
 
-    if not os.path.exists(path):
+    if size != "full" and size not in DERIVATIVE_SIZES:
+        raise HTTPException(status_code=400, detail=f"size must be one of: full, {', '.join(DERIVATIVE_SIZES)}")
+    try:
+        source = source_for(path)
+        st = source.stat(path)
+        if size == "full":
+            # remote photos are served from the local read-through cache
+            local = source.local_path(path, st)
+            # the response itself (validators, 304 / range handling); the body is sent after the handler returns
+            with stage("serialize"):
+                return serve_file(request, local, etag=f"{st.mtime_ns:x}-{st.size:x}", media_type=source.media_type(path),
+                                  mtime=st.mtime_ns / 1e9)
+        with stage("derivative"):
+            out = derivative_cache.get(path, size, st)
+    except SourceUnavailable:
+        raise HTTPException(status_code=503, detail="Photo storage unavailable")
+    except (OSError, ValueError):
         raise HTTPException(status_code=404, detail="Image not found")
-    
-    return FileResponse(path)
\ No newline at end of file
+    # the file name is the source fingerprint + size, so it doubles as a strong ETag
+    with stage("serialize"):
+        return serve_file(request, str(out), etag=out.stem, media_type="image/jpeg", mtime=st.mtime_ns / 1e9)
@@ -0,0 +1,294 @@
+import os
+import sys
+import time
+import threading
+import functools
+import contextvars
+from collections import Counter as _Tally
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# record histograms / counters (the /metrics endpoint itself is always served)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# add a Server-Timing header with per-stage durations to every response
+TIMING_HEADER = os.getenv("TIMING_HEADER", "0") == "1"
+# allow GET /debug/profile (wall-clock stack sampling of the whole process)
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"
+PROFILER_MAX_SECONDS = float(os.getenv("PROFILER_MAX_SECONDS", "60"))
+
+# seconds; covers a 1 ms cache hit up to a cold multi-second model call
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels(names, values, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> list:
+        return []
+
+class Counter(_Metric):
+    """Monotonic total per label set."""
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames = ()):
+        super().__init__(name, help, labelnames)
+        self._values = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        if not METRICS_ENABLED or amount <= 0:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_labels(self.labelnames, key)} {_num(v)}" for key, v in items]
+
+class Gauge(Counter):
+    """Last value per label set; or, with fn, whatever fn() returns at scrape time
+    (a number, or a list of (labels dict, value))."""
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, labelnames = (), fn = None, kind: str = "gauge"):
+        super().__init__(name, help, labelnames)
+        self.fn = fn
+        self.kind = kind
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = float(value)
+
+    def _samples(self) -> list:
+        if self.fn is None:
+            return super()._samples()
+        try:
+            value = self.fn()
+        except Exception:
+            return []
+        if isinstance(value, (int, float)):
+            return [f"{self.name} {_num(value)}"]
+        return [f"{self.name}{_labels(self.labelnames, self._key(labels))} {_num(v)}" for labels, v in value]
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set."""
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames = (), buckets = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {} # key -> [per-bucket counts (+Inf last), sum, count]
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def _samples(self) -> list:
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        lines = []
+        for key, (counts, total, n) in items:
+            running = 0
+            for bound, c in zip(self.buckets + (float("inf"),), counts):
+                running += c
+                le = 'le="%s"' % _num(bound)
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, key, le)} {running}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {total!r}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {n}")
+        return lines
+
+class Registry:
+    """Metrics of this process in Prometheus text format (version 0.0.4). Every uvicorn worker
+    has its own registry, so scrape each worker (or run one per port)."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            # module reloads / repeated setup return the existing series
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str, labelnames = ()) -> Counter:
+        return self._register(Counter(name, help, labelnames)) # type: ignore
+
+    def gauge(self, name: str, help: str, labelnames = (), fn = None) -> Gauge:
+        return self._register(Gauge(name, help, labelnames, fn)) # type: ignore
+
+    def counter_fn(self, name: str, help: str, fn, labelnames = ()) -> Gauge:
+        """A counter whose total is read from fn() at scrape time (for objects that already count)."""
+        return self._register(Gauge(name, help, labelnames, fn, kind = "counter")) # type: ignore
+
+    def histogram(self, name: str, help: str, labelnames = (), buckets = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, labelnames, buckets)) # type: ignore
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for m in metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
+
+def start_http_server(port: int, host: str = "0.0.0.0"):
+    """Serves GET /metrics (this process's registry) from a daemon thread, for processes without
+    the API's own endpoint (the job worker). Returns the server, or None if the port is taken."""
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, fmt, *args):
+            pass
+
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    try:
+        server = ThreadingHTTPServer((host, int(port)), Handler)
+    except OSError as e:
+        print(f"[WARNING] Metrics not served on {host}:{port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target = server.serve_forever, name = "metrics-http", daemon = True).start()
+    return server
+
+STAGE_SECONDS = registry.histogram("vision_stage_seconds", "Wall time per processing stage (decode, detect, align, embed, inference, index_load, search, face_meta, db, auth, derivative, serialize = building the result list and the JSON / file response).", ("stage",))
+HTTP_SECONDS = registry.histogram("vision_http_request_seconds", "HTTP request latency by route.", ("route", "method", "status"))
+
+# ---------- per-request stage timings ----------
+
+_request_timings = contextvars.ContextVar("request_timings", default = None)
+
+def begin_request():
+    """Starts collecting stage timings for the current request; returns (timings, reset token)."""
+    timings = {}
+    return timings, _request_timings.set(timings)
+
+def end_request(token):
+    _request_timings.reset(token)
+
+def record_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage = name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+@contextmanager
+def stage(name: str):
+    """Times a block into vision_stage_seconds and, inside a request, its Server-Timing header."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - t0)
+
+def timed(name: str):
+    """Decorator form of stage()."""
+    def wrap(fn):
+        @functools.wraps(fn)
+        def inner(*args, **kwargs):
+            with stage(name):
+                return fn(*args, **kwargs)
+        return inner
+    return wrap
+
+def server_timing(timings: dict, total: float) -> str:
+    parts = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in timings.items()]
+    parts.append(f"total;dur={total * 1000:.2f}")
+    return ", ".join(parts)
+
+# ---------- sampling profiler ----------
+
+class SamplingProfiler:
+    """Wall-clock stack sampler over every thread of the process (sys._current_frames), cheap
+    enough to switch on in production for a few seconds. Output is collapsed stacks
+    ("frame;frame;frame count" per line), readable by flamegraph.pl and speedscope."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stack(frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+            frame = frame.f_back
+        return ";".join(reversed(names))
+
+    def sample(self, seconds: float, interval_ms: float = 5.0) -> str:
+        """Blocks for `seconds`, sampling all other threads every interval_ms. One run at a time."""
+        if not self._lock.acquire(blocking = False):
+            raise RuntimeError("a profile is already running")
+        try:
+            me = threading.get_ident()
+            names = {t.ident: t.name for t in threading.enumerate()}
+            tally = _Tally()
+            deadline = time.perf_counter() + min(float(seconds), PROFILER_MAX_SECONDS)
+            interval = max(float(interval_ms), 0.5) / 1000.0
+            while time.perf_counter() < deadline:
+                for ident, frame in sys._current_frames().items():
+                    if ident == me:
+                        continue
+                    tally[f"{names.get(ident, ident)};{self._stack(frame)}"] += 1
+                time.sleep(interval)
+            return "\n".join(f"{stack} {n}" for stack, n in tally.most_common()) + "\n"
+        finally:
+            self._lock.release()
+
+profiler = SamplingProfiler()
@@ -20,4 +20,40 @@ class Face(Base):
     face_id = Column(String, unique = True, index = True)
     image_path = Column(Text)
     bbox = Column(JSON)
-    created_at = Column(TIMESTAMP, default = lambda: datetime.now(timezone.utc))
\ No newline at end of file
+    created_at = Column(TIMESTAMP, default = lambda: datetime.now(timezone.utc))
+
+class DuplicateImage(Base):
+    """A photo the indexer linked to a near-duplicate instead of embedding it (worker/indexer.py):
+    it has no Face rows or vectors of its own, its people are face_ids (Face.id) of leader_path.
+    distance is the 256-bit dHash distance the link was made at (0: identical bytes), for auditing;
+    after tightening the DEDUP_* settings, the next run re-indexes the links that no longer qualify."""
+    __tablename__ = "duplicate_images"
+    id = Column(Integer, primary_key = True, index = True)
+    event_id = Column(Integer, index = True)
+    image_path = Column(Text)
+    leader_path = Column(Text)
+    face_ids = Column(JSON)
+    distance = Column(Integer)
+    created_at = Column(TIMESTAMP, default = lambda: datetime.now(timezone.utc))
+
+class IndexJob(Base):
+    """One indexing run of an event folder, claimed by a worker process (see app/jobs.py)."""
+    __tablename__ = "index_jobs"
+    id = Column(Integer, primary_key = True, index = True)
+    event_id = Column(Integer, index = True)
+    tenant = Column(String, index = True, default = "default")
+    folder = Column(Text)
+    incremental = Column(Boolean, default = True)
+    priority = Column(Integer, default = 0) # lower runs first
+    status = Column(String, index = True, default = "queued") # queued | running | done | failed
+    attempts = Column(Integer, default = 0)
+    worker = Column(String)
+    files_total = Column(Integer, default = 0)
+    files_done = Column(Integer, default = 0)
+    faces = Column(Integer, default = 0)
+    error = Column(Text)
+    # naive UTC, compared in Python by the worker (see jobs.utcnow)
+    created_at = Column(TIMESTAMP)
+    started_at = Column(TIMESTAMP)
+    heartbeat_at = Column(TIMESTAMP)
+    finished_at = Column(TIMESTAMP)
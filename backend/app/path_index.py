@@ -0,0 +1,136 @@
+import os
+import time
+import hmac
+import base64
+import hashlib
+import secrets
+import threading
+from pathlib import Path
+from .sources import path_parts
+
+# how often a path that is not under any known root may trigger a reload from the DB
+# (another worker process may have registered the event)
+EVENT_PATH_REFRESH_S = float(os.getenv("EVENT_PATH_REFRESH_S", "5"))
+SECRET_FILE = Path(__file__).resolve().parents[0] / "cache" / "image_id.secret"
+
+class EventPathIndex:
+    """In-memory trie of normalized event storage roots (one node per path component).
+    lookup() walks at most depth(path) nodes, independent of how many events exist,
+    and never touches the database on a hit."""
+
+    def __init__(self):
+        self._trie = {}
+        self._lock = threading.Lock()
+        self._last_refresh = 0.0
+        self.loaded = False
+
+    def _insert(self, trie: dict, event_id: int, root: str):
+        node = trie
+        for part in path_parts(root):
+            node = node.setdefault(part, {})
+        node[None] = int(event_id) # terminal marker
+
+    def add(self, event_id: int, root: str):
+        with self._lock:
+            self._insert(self._trie, event_id, root)
+
+    def rebuild(self, events):
+        """Replaces the trie from (event_id, storage_path) pairs."""
+        trie = {}
+        for event_id, root in events:
+            if root:
+                self._insert(trie, event_id, root)
+        with self._lock:
+            self._trie = trie
+            self._last_refresh = time.monotonic()
+            self.loaded = True
+
+    def lookup(self, path: str):
+        """Event id whose storage root contains path, or None."""
+        node = self._trie
+        found = node.get(None)
+        for part in path_parts(path):
+            node = node.get(part)
+            if node is None:
+                break
+            found = node.get(None, found)
+        return found
+
+    def refresh_from_db(self, force: bool = False):
+        """Reloads roots from the events table, rate-limited unless forced."""
+        if not force and time.monotonic() - self._last_refresh < EVENT_PATH_REFRESH_S:
+            return
+        from .db import SessionLocal
+        from .models import Event
+        db = SessionLocal()
+        try:
+            self.rebuild(db.query(Event.id, Event.storage_path).all())
+        finally:
+            db.close()
+
+    def resolve(self, path: str):
+        """lookup() with a rate-limited DB reload on a miss."""
+        event_id = self.lookup(path)
+        if event_id is None and (not self.loaded or time.monotonic() - self._last_refresh >= EVENT_PATH_REFRESH_S):
+            self.refresh_from_db(force = True)
+            event_id = self.lookup(path)
+        return event_id
+
+def _load_secret() -> bytes:
+    env = os.getenv("IMAGE_ID_SECRET")
+    if env:
+        return env.encode("utf-8")
+    # shared by all worker processes on this host
+    try:
+        return SECRET_FILE.read_bytes()
+    except OSError:
+        pass
+    SECRET_FILE.parent.mkdir(parents = True, exist_ok = True)
+    secret = secrets.token_bytes(32)
+    try:
+        fd = os.open(str(SECRET_FILE), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(secret)
+        return secret
+    except FileExistsError:
+        # another worker won the race
+        return SECRET_FILE.read_bytes()
+
+class ImageIdSigner:
+    """Opaque image ids: base64url("<event_id>:<path>") + "." + truncated HMAC-SHA256.
+    Verifying one is a constant-time comparison; no lookup of any kind. Other signed handles
+    pass a kind, which keys the MAC, so one can never be used as another."""
+
+    def __init__(self, secret: bytes = None): # type: ignore
+        self._secret = secret
+
+    def _key(self) -> bytes:
+        if self._secret is None:
+            self._secret = _load_secret()
+        return self._secret
+
+    def _mac(self, payload: bytes, kind: str = "") -> str:
+        if kind:
+            payload = kind.encode("utf-8") + b"\0" + payload
+        digest = hmac.new(self._key(), payload, hashlib.sha256).digest()[:18]
+        return base64.urlsafe_b64encode(digest).decode("ascii")
+
+    def sign(self, event_id: int, path: str, kind: str = "") -> str:
+        payload = f"{int(event_id)}:{path}".encode("utf-8")
+        return base64.urlsafe_b64encode(payload).decode("ascii").rstrip("=") + "." + self._mac(payload, kind)
+
+    def verify(self, image_id: str, kind: str = ""):
+        """(event_id, path) for an id we issued (with the same kind), else None."""
+        body, _, mac = image_id.partition(".")
+        try:
+            payload = base64.urlsafe_b64decode(body + "=" * (-len(body) % 4))
+        except (ValueError, TypeError):
+            return None
+        # as bytes: compare_digest rejects str with non-ASCII characters (TypeError), and the mac is client input
+        if not hmac.compare_digest(mac.encode("utf-8"), self._mac(payload, kind).encode("ascii")):
+            return None
+        event_id, _, path = payload.decode("utf-8").partition(":")
+        return int(event_id), path
+
+event_paths = EventPathIndex()
+image_ids = ImageIdSigner()
@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import threading
+import numpy as np
+from collections import OrderedDict
+from .metrics import registry
+
+# how long a selfie's embedding and a search result stay reusable in this process
+QUERY_CACHE_TTL_S = float(os.getenv("QUERY_CACHE_TTL_S", "600"))
+# selfie bytes -> embedding entries (2 KB each at 512 dims)
+SELFIE_CACHE_MAX_ENTRIES = int(os.getenv("SELFIE_CACHE_MAX_ENTRIES", "4096"))
+# (event index, query, k, ...) -> result list entries
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "4096"))
+# embedding components are rounded to multiples of 1/QUERY_CACHE_QUANT before keying results, so
+# float noise between model runs (batched vs single, another worker) still finds the entry
+QUERY_CACHE_QUANT = int(os.getenv("QUERY_CACHE_QUANT", "64"))
+
+def selfie_key(img_bytes: bytes) -> bytes:
+    return hashlib.sha256(img_bytes).digest()
+
+def query_key(q: np.ndarray) -> bytes:
+    """Digest of the quantized query vector(s); only near-identical embeddings share it."""
+    quantized = np.clip(np.rint(np.asarray(q, dtype = np.float32) * QUERY_CACHE_QUANT), -127, 127).astype(np.int8)
+    return hashlib.sha1(quantized.tobytes() + repr(quantized.shape).encode("ascii")).digest()
+
+class TTLCache:
+    """Process-wide key -> value cache with a TTL, bounded LRU (like EventTokenCache, for any key).
+    Values are shared between requests, so callers must not mutate what they get or put."""
+
+    def __init__(self, ttl: float = QUERY_CACHE_TTL_S, max_entries: int = 1024):
+        self.ttl = float(ttl)
+        self.max_entries = max(1, int(max_entries))
+        self._entries = OrderedDict() # key -> (expires, value)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """The cached value, or None on a miss (or when the entry expired)."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._insert(key, value)
+        return value
+
+    def drop(self, pred) -> int:
+        """Removes every entry whose key satisfies pred(key); returns how many."""
+        with self._lock:
+            return self._drop(pred)
+
+    # the two below expect self._lock to be held
+    def _insert(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last = False)
+
+    def _drop(self, pred) -> int:
+        keys = [k for k in self._entries if pred(k)]
+        for key in keys:
+            del self._entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+class SelfieCache(TTLCache):
+    """sha256 of the uploaded selfie -> its embedding (a zero vector when no face was found), so a
+    re-sent selfie (retry, second event, album after match) skips the model."""
+
+    def __init__(self, ttl: float = QUERY_CACHE_TTL_S, max_entries: int = SELFIE_CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+
+    def put(self, key, value):
+        value = np.array(value, dtype = np.float32)
+        value.setflags(write = False)
+        return super().put(key, value)
+
+class ResultCache(TTLCache):
+    """(event_id, index generation, query_key, *params) -> result list of a search.
+
+    The generation is EventFaissIndex.generation, new for every load of the event's index; the
+    registry reloads whenever the indexer changes the files, so a changed index can never answer
+    from an old entry. Entries of older generations are dropped as soon as a newer one is seen."""
+
+    def __init__(self, ttl: float = QUERY_CACHE_TTL_S, max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        super().__init__(ttl, max_entries)
+        self._generations = {} # event_id -> newest index generation seen
+        self.invalidations = 0
+
+    @staticmethod
+    def key(event_id: int, generation: int, q: np.ndarray, *params) -> tuple:
+        return (int(event_id), int(generation), query_key(q)) + tuple(params)
+
+    def put(self, key, value):
+        event_id, generation = key[0], key[1]
+        # one critical section, so no put of an older generation can slip in after the purge
+        with self._lock:
+            newest = self._generations.get(event_id, generation)
+            if generation < newest:
+                return value # a request that raced a reload; its results are already stale
+            if generation > newest:
+                self._generations[event_id] = generation
+                self._invalidate(event_id, below = generation)
+            else:
+                self._generations.setdefault(event_id, generation)
+            self._insert(key, value)
+        return value
+
+    def invalidate(self, event_id: int, below: int = None): # type: ignore
+        """Drops the event's results (only those of generations before `below`, if given)."""
+        with self._lock:
+            self._invalidate(int(event_id), below)
+
+    def _invalidate(self, event_id: int, below: int = None): # type: ignore
+        self.invalidations += self._drop(lambda k: k[0] == event_id and (below is None or k[1] < below))
+
+    def stats(self) -> dict:
+        return {**super().stats(), "invalidations": self.invalidations}
+
+# shared by all requests in this process
+selfie_cache = SelfieCache()
+result_cache = ResultCache()
+
+registry.counter_fn("vision_selfie_cache_hits_total", "Selfie embeddings reused without a model call.", lambda: selfie_cache.hits)
+registry.counter_fn("vision_selfie_cache_misses_total", "Selfies sent to the model.", lambda: selfie_cache.misses)
+registry.counter_fn("vision_result_cache_hits_total", "Searches answered from the result cache.", lambda: result_cache.hits)
+registry.counter_fn("vision_result_cache_misses_total", "Searches run against the event index.", lambda: result_cache.misses)
+registry.counter_fn("vision_result_cache_invalidations_total", "Cached results dropped because the event's index changed.", lambda: result_cache.invalidations)
@@ -0,0 +1,435 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+
+# compaction policy: merge small segments once there are more than this many
+COMPACT_MAX_SEGMENTS = int(os.getenv("COMPACT_MAX_SEGMENTS", "8"))
+# segments with fewer rows than this count as "small"
+COMPACT_SMALL_ROWS = int(os.getenv("COMPACT_SMALL_ROWS", "50000"))
+# rewrite everything once this fraction of rows is tombstoned
+COMPACT_TOMBSTONE_RATIO = float(os.getenv("COMPACT_TOMBSTONE_RATIO", "0.2"))
+# rows converted per step when writing a quantized copy of a segment
+QUANT_BLOCK_ROWS = int(os.getenv("QUANT_BLOCK_ROWS", "65536"))
+
+# dtypes a segment's search copy can be stored in (float32 = the vectors themselves)
+QUANT_DTYPES = ("float32", "float16", "int8")
+
+SEGMENTS_FORMAT = 1
+
+def l2_normalize(a: np.ndarray) -> np.ndarray:
+    """Row-wise L2 normalization to float32 (zero rows are left as zeros)."""
+    a = np.asarray(a, dtype = "float32")
+    if a.ndim == 1:
+        a = a.reshape(1, -1)
+    norms = np.linalg.norm(a, axis = 1, keepdims = True)
+    norms[norms == 0] = 1.0
+    return a / norms
+
+def atomic_write_json(path, obj, indent: int = None): # type: ignore
+    """Writes JSON to a temp file in the same directory, then renames it over path,
+    so readers never observe a half-written file."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding = "utf-8") as fh:
+        json.dump(obj, fh, indent = indent)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+def atomic_save_npy(path, arr: np.ndarray):
+    """np.save counterpart of atomic_write_json."""
+    path = Path(path)
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as fh:
+        np.save(fh, arr)
+        fh.flush()
+        os.fsync(fh.fileno())
+    os.replace(tmp, path)
+
+def load_vectors(path: Path) -> np.ndarray:
+    """Memory-maps a (n, dim) vector file. Files written before vectors were stored
+    normalized are normalized once in memory instead."""
+    emb = np.load(str(path), mmap_mode = "r")
+    sample = np.asarray(emb[:64], dtype = "float32")
+    norms = np.linalg.norm(sample, axis = 1) if sample.ndim == 2 and len(sample) else np.ones(0)
+    if emb.dtype != np.float32 or emb.ndim != 2 or not np.allclose(norms[norms > 0], 1.0, atol = 1e-3):
+        print(f"{Path(path).name}: vectors not stored normalized; normalizing in memory.")
+        emb = l2_normalize(np.asarray(emb))
+    return emb
+
+def quantize_rows(vectors: np.ndarray, dtype: str):
+    """(codes, scales) for unit vectors: float16 codes need no scale; int8 codes are
+    round(x / scale) with one float32 scale per row (max |x| / 127)."""
+    vectors = np.asarray(vectors, dtype = "float32")
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis = 1) / 127.0
+    scales[scales == 0] = 1.0
+    codes = np.clip(np.rint(vectors / scales[:, None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+class Segment:
+    """One immutable block of vectors + face ids. alive is None when no row is tombstoned.
+    codes (and scales, for int8) is an optional quantized copy of vectors used for scanning;
+    vectors then stay on disk, mapped but untouched except to re-rank a few candidates."""
+    __slots__ = ("name", "vectors", "ids", "alive", "quant", "codes", "scales")
+
+    def __init__(self, name: str, vectors: np.ndarray, ids: np.ndarray, quant: str = "float32",
+                 codes: np.ndarray = None, scales: np.ndarray = None): # type: ignore
+        self.name = name
+        self.vectors = vectors
+        self.ids = ids
+        self.alive = None
+        self.quant = quant
+        self.codes = codes
+        self.scales = scales
+
+    def __len__(self):
+        return len(self.ids)
+
+    def scores(self, q: np.ndarray, start: int, end: int) -> np.ndarray:
+        """q @ rows start..end of the scan copy, as float32 (int8 scales are applied to the
+        (n_q, rows) product rather than to the much larger block)."""
+        if self.codes is None:
+            return q @ np.asarray(self.vectors[start:end], dtype = "float32").T
+        sims = q @ self.codes[start:end].astype(np.float32).T
+        if self.scales is not None:
+            sims *= self.scales[start:end]
+        return sims
+
+    def scan_nbytes(self) -> int:
+        """Bytes a full scan touches."""
+        if self.codes is None:
+            return int(self.vectors.nbytes)
+        return int(self.codes.nbytes) + (int(self.scales.nbytes) if self.scales is not None else 0)
+
+class SegmentMeta:
+    """Compact lookup of face_db_id -> (image_path, bbox) for one segment, built once from
+    its meta.json: sorted ids for binary search, one shared string per image."""
+    __slots__ = ("ids", "paths", "path_idx", "bboxes")
+
+    def __init__(self, ids: np.ndarray, meta: list):
+        order = np.argsort(ids, kind = "stable")
+        self.ids = np.asarray(ids, dtype = np.int64)[order]
+        self.paths = []
+        by_path = {}
+        path_idx = np.full(len(meta), -1, dtype = np.int32)
+        bboxes = np.full((len(meta), 4), np.nan, dtype = np.float32)
+        for row, i in enumerate(order):
+            m = meta[i]
+            path = m.get("image_path")
+            if path is not None:
+                path_idx[row] = by_path.setdefault(path, len(by_path))
+            bbox = m.get("bbox")
+            if bbox is not None and len(bbox) == 4:
+                bboxes[row] = bbox
+        self.paths = list(by_path)
+        self.path_idx = path_idx
+        self.bboxes = bboxes
+
+    def nbytes(self) -> int:
+        return int(self.ids.nbytes + self.path_idx.nbytes + self.bboxes.nbytes) + sum(len(p) + 49 for p in self.paths)
+
+    def lookup(self, face_ids: np.ndarray) -> dict:
+        """{face_db_id: (image_path, bbox or None)} for the ids this segment has metadata for."""
+        pos = np.searchsorted(self.ids, face_ids)
+        pos[pos >= len(self.ids)] = 0
+        out = {}
+        for fid, p in zip(face_ids.tolist(), pos.tolist()):
+            if len(self.ids) == 0 or self.ids[p] != fid or self.path_idx[p] < 0:
+                continue
+            bbox = self.bboxes[p]
+            out[fid] = (self.paths[self.path_idx[p]], None if np.isnan(bbox).any() else bbox.tolist())
+        return out
+
+class SegmentStore:
+    """Append-only on-disk vector store of one event.
+
+    root/segments.json is the only mutable file and the commit point of every write:
+        {"format", "version", "next_seg", "segments": [{"name", "count"}], "tombstones": [...], "ann": {...}}
+    Each segment is written once as <name>.vec.npy (normalized float32), <name>.ids.npy (int64)
+    and <name>.meta.json, all via temp file + rename. Readers only see segments listed in the
+    manifest, so they never observe a half-written append. Removals are tombstones until the
+    next compaction rewrites the affected segments.
+
+    The legacy single-file layout (event_{id}_embeddings.npy + event_{id}_meta.json) is read
+    as one segment and migrated into the store on the first write."""
+
+    def __init__(self, root: Path, legacy_emb: Path = None, legacy_meta: Path = None): # type: ignore
+        self.root = Path(root)
+        self.manifest_path = self.root / "segments.json"
+        self.legacy_emb = Path(legacy_emb) if legacy_emb else None
+        self.legacy_meta = Path(legacy_meta) if legacy_meta else None
+        self._meta = {} # segment name -> SegmentMeta, built on first lookup
+        self.reload()
+
+    # ---------- reading ----------
+
+    def _read_manifest(self):
+        if not self.manifest_path.exists():
+            return None
+        with open(self.manifest_path, "r", encoding = "utf-8") as fh:
+            return json.load(fh)
+
+    def _has_legacy(self) -> bool:
+        return bool(self.legacy_emb and self.legacy_meta and self.legacy_emb.exists() and self.legacy_meta.exists())
+
+    def _read_legacy(self):
+        with open(self.legacy_meta, "r", encoding = "utf-8") as fh: # type: ignore
+            meta = json.load(fh)
+        ids = np.fromiter((int(m["face_db_id"]) for m in meta), dtype = np.int64, count = len(meta))
+        return load_vectors(self.legacy_emb), ids, meta # type: ignore
+
+    @staticmethod
+    def _empty_state() -> dict:
+        return {"format": SEGMENTS_FORMAT, "version": 0, "next_seg": 1, "segments": [], "tombstones": [], "ann": None}
+
+    def reload(self):
+        # a concurrent compaction may delete segments between reading the manifest
+        # and mapping them; the manifest read after that is consistent again
+        for attempt in range(3):
+            try:
+                return self._load()
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+
+    def _load(self):
+        state = self._read_manifest()
+        self.segments = []
+        if state is None:
+            state = self._empty_state()
+            if self._has_legacy():
+                vectors, ids, _ = self._read_legacy()
+                self.segments.append(Segment("legacy", vectors, ids))
+        else:
+            for s in state["segments"]:
+                name = s["name"]
+                vectors = load_vectors(self.root / f"{name}.vec.npy")
+                ids = np.load(str(self.root / f"{name}.ids.npy"))
+                quant = s.get("quant", "float32")
+                codes = scales = None
+                if quant != "float32":
+                    codes = np.load(str(self.root / f"{name}.q.npy"), mmap_mode = "r")
+                    if quant == "int8":
+                        scales = np.load(str(self.root / f"{name}.qs.npy"))
+                self.segments.append(Segment(name, vectors, ids, quant, codes, scales))
+        self.state = state
+        names = {s.name for s in self.segments}
+        self._meta = {n: m for n, m in self._meta.items() if n in names}
+        self.tombstones = set(int(x) for x in state.get("tombstones", []))
+        if self.tombstones:
+            dead = np.fromiter(self.tombstones, dtype = np.int64)
+            for seg in self.segments:
+                alive = ~np.isin(seg.ids, dead)
+                seg.alive = None if alive.all() else alive
+
+    @property
+    def version(self) -> int:
+        return int(self.state.get("version", 0))
+
+    @property
+    def ann(self):
+        return self.state.get("ann")
+
+    def files(self) -> list:
+        return [p for p in (self.manifest_path, self.legacy_emb, self.legacy_meta) if p is not None]
+
+    def total_rows(self) -> int:
+        return sum(len(s) for s in self.segments)
+
+    def live_rows(self) -> int:
+        return sum(len(s) if s.alive is None else int(s.alive.sum()) for s in self.segments)
+
+    def nbytes(self) -> int:
+        return sum(int(s.vectors.nbytes) + int(s.ids.nbytes) for s in self.segments)
+
+    def live_ids(self) -> np.ndarray:
+        parts = [s.ids if s.alive is None else s.ids[s.alive] for s in self.segments]
+        return np.concatenate(parts) if parts else np.empty(0, dtype = np.int64)
+
+    def meta_index(self, name: str) -> SegmentMeta:
+        """Cached SegmentMeta of a segment (segments are immutable, so it never goes stale)."""
+        meta = self._meta.get(name)
+        if meta is None:
+            seg = next(s for s in self.segments if s.name == name)
+            meta = self._meta[name] = SegmentMeta(seg.ids, self.segment_meta(name))
+        return meta
+
+    def segment_meta(self, name: str) -> list:
+        if name == "legacy":
+            return self._read_legacy()[2]
+        with open(self.root / f"{name}.meta.json", "r", encoding = "utf-8") as fh:
+            return json.load(fh)
+
+    # ---------- writing (single writer per event: the indexer) ----------
+
+    def _begin(self) -> dict:
+        """Fresh copy of the on-disk manifest for a write; migrates the legacy layout."""
+        self.root.mkdir(parents = True, exist_ok = True)
+        state = self._read_manifest()
+        if state is None:
+            state = self._empty_state()
+            if self._has_legacy():
+                vectors, ids, meta = self._read_legacy()
+                self._write_segment(state, vectors, ids, meta)
+        return state
+
+    def _write_segment(self, state: dict, vectors: np.ndarray, ids: np.ndarray, meta: list) -> str:
+        name = f"seg_{int(state['next_seg']):06d}"
+        state["next_seg"] = int(state["next_seg"]) + 1
+        atomic_save_npy(self.root / f"{name}.vec.npy", l2_normalize(vectors))
+        atomic_save_npy(self.root / f"{name}.ids.npy", np.asarray(ids, dtype = np.int64))
+        atomic_write_json(self.root / f"{name}.meta.json", meta)
+        state["segments"].append({"name": name, "count": int(len(ids))})
+        return name
+
+    def _commit(self, state: dict):
+        state["version"] = int(state.get("version", 0)) + 1
+        atomic_write_json(self.manifest_path, state, indent = 1)
+        self._gc(state)
+        self.reload()
+
+    def _gc(self, state: dict):
+        """Deletes files no longer referenced by the manifest (and the migrated legacy files).
+        Readers that still map an old segment keep it alive until they reload (POSIX unlink);
+        where the OS refuses, the file is retried on the next commit."""
+        keep = {"segments.json"}
+        for s in state["segments"]:
+            keep.update({f"{s['name']}.vec.npy", f"{s['name']}.ids.npy", f"{s['name']}.meta.json"})
+            if s.get("quant", "float32") != "float32":
+                keep.update({f"{s['name']}.q.npy", f"{s['name']}.qs.npy"})
+        if state.get("ann"):
+            keep.add(state["ann"]["file"])
+        stale = [p for p in self.root.iterdir() if p.name not in keep and not p.name.endswith(".tmp")]
+        if self._has_legacy():
+            stale += [self.legacy_emb, self.legacy_meta]
+        for p in stale:
+            try:
+                os.remove(p) # type: ignore
+            except OSError:
+                pass
+
+    def append(self, vectors: np.ndarray, ids, meta: list = None) -> str: # type: ignore
+        """Writes one new segment; cost is proportional to the batch, not the history."""
+        ids = np.asarray([int(x) for x in ids], dtype = np.int64)
+        if meta is None:
+            meta = [{"face_db_id": int(x)} for x in ids]
+        state = self._begin()
+        name = self._write_segment(state, vectors, ids, meta)
+        self._commit(state)
+        return name
+
+    def retire(self, ids):
+        """Tombstones face ids; their rows disappear from search immediately."""
+        ids = {int(x) for x in ids}
+        if not ids:
+            return
+        state = self._begin()
+        state["tombstones"] = sorted(set(state.get("tombstones", [])) | ids)
+        self._commit(state)
+
+    def set_ann(self, file_name: str, covered: list, params: dict = None): # type: ignore
+        """Records an ANN index file built over the given segment names (None drops it)."""
+        state = self._begin()
+        state["ann"] = {"file": file_name, "segments": list(covered), **(params or {})} if file_name else None
+        self._commit(state)
+
+    def _write_quantized(self, name: str, dtype: str):
+        # block by block from the mapped float32 file, so a huge segment is never fully in memory
+        vectors = np.load(str(self.root / f"{name}.vec.npy"), mmap_mode = "r")
+        path = self.root / f"{name}.q.npy"
+        tmp = path.with_name(path.name + ".tmp")
+        codes = np.lib.format.open_memmap(str(tmp), mode = "w+", dtype = dtype, shape = vectors.shape)
+        scales = np.empty(len(vectors), dtype = np.float32) if dtype == "int8" else None
+        for start in range(0, len(vectors), QUANT_BLOCK_ROWS):
+            end = min(start + QUANT_BLOCK_ROWS, len(vectors))
+            block, block_scales = quantize_rows(vectors[start:end], dtype)
+            codes[start:end] = block
+            if scales is not None:
+                scales[start:end] = block_scales
+        codes.flush()
+        del codes
+        os.replace(tmp, path)
+        if scales is not None:
+            atomic_save_npy(self.root / f"{name}.qs.npy", scales)
+
+    def quantize(self, dtype: str) -> bool:
+        """Gives every segment a scan copy in dtype (float32 drops the copies). The float32
+        vectors are kept for exact re-ranking. Returns True if the manifest changed."""
+        if dtype not in QUANT_DTYPES:
+            raise ValueError(f"unknown vector dtype {dtype!r}")
+        state = self._begin()
+        changed = False
+        for s in state["segments"]:
+            if s.get("quant", "float32") == dtype:
+                continue
+            if dtype == "float32":
+                s.pop("quant", None)
+            else:
+                self._write_quantized(s["name"], dtype)
+                s["quant"] = dtype
+            changed = True
+        if changed:
+            self._commit(state)
+        return changed
+
+    def needs_compaction(self) -> bool:
+        if not self.state["segments"]:
+            return self._has_legacy()
+        small = [s for s in self.state["segments"] if s["count"] < COMPACT_SMALL_ROWS]
+        total = max(self.total_rows(), 1)
+        return (len(self.state["segments"]) > COMPACT_MAX_SEGMENTS and len(small) > 1) \
+            or (self.total_rows() - self.live_rows()) / total > COMPACT_TOMBSTONE_RATIO
+
+    def compact(self, force: bool = False) -> bool:
+        """Merges small segments (or all, when tombstones pile up) into one, dropping retired
+        rows; small segments covered by the ANN index are left alone unless there are more than
+        COMPACT_MAX_SEGMENTS of them. Returns True if the manifest changed."""
+        if not force and not self.needs_compaction():
+            return False
+        state = self._begin()
+        if not state["segments"]:
+            # nothing to merge, but the legacy layout was migrated
+            self._commit(state)
+            return True
+        tombstones = set(int(x) for x in state.get("tombstones", []))
+        total = sum(s["count"] for s in state["segments"])
+        if force or len(tombstones) / max(total, 1) > COMPACT_TOMBSTONE_RATIO:
+            picked = list(state["segments"])
+        else:
+            small = [s for s in state["segments"] if s["count"] < COMPACT_SMALL_ROWS]
+            # segments under the ANN index stay as they are (merging them means rebuilding it)
+            # until there are too many of them
+            covered = set(state["ann"]["segments"]) if state.get("ann") else set()
+            picked = [s for s in small if s["name"] not in covered]
+            if len(small) - len(picked) > COMPACT_MAX_SEGMENTS:
+                picked = small
+            if len(picked) < 2:
+                return False
+
+        vecs, ids, meta = [], [], []
+        for s in picked:
+            seg_ids = np.load(str(self.root / f"{s['name']}.ids.npy"))
+            keep = ~np.isin(seg_ids, np.fromiter(tombstones, dtype = np.int64)) if tombstones else np.ones(len(seg_ids), dtype = bool)
+            seg_meta = self.segment_meta(s["name"])
+            vecs.append(np.load(str(self.root / f"{s['name']}.vec.npy"))[keep])
+            ids.append(seg_ids[keep])
+            meta.extend(m for m, k in zip(seg_meta, keep) if k)
+        picked_names = {s["name"] for s in picked}
+        state["segments"] = [s for s in state["segments"] if s["name"] not in picked_names]
+        if sum(len(x) for x in ids):
+            self._write_segment(state, np.concatenate(vecs), np.concatenate(ids), meta)
+
+        # tombstones that no longer match any row can go
+        remaining = set()
+        for s in state["segments"]:
+            remaining.update(int(x) for x in np.load(str(self.root / f"{s['name']}.ids.npy")))
+        state["tombstones"] = sorted(tombstones & remaining)
+        # an ANN index over merged-away segments is stale
+        ann = state.get("ann")
+        if ann and picked_names & set(ann["segments"]):
+            state["ann"] = None
+        self._commit(state)
+        return True
@@ -0,0 +1,419 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import mimetypes
+import posixpath
+import http.client
+from pathlib import Path
+from collections import namedtuple, OrderedDict
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlsplit, urlencode, quote
+from .metrics import registry, stage
+
+# Try to import google-auth (service account tokens); without it only GDRIVE_ACCESS_TOKEN works
+try:
+    import urllib3
+    from google.oauth2 import service_account
+    import google.auth.transport.urllib3 as google_urllib3
+    GOOGLE_AUTH_AVAILABLE = True
+except Exception:
+    GOOGLE_AUTH_AVAILABLE = False
+
+# Drive v3 REST endpoint (point it at infra/fake_drive.py to run without Google)
+GDRIVE_API_URL = os.getenv("GDRIVE_API_URL", "https://www.googleapis.com")
+# service account JSON with read access to the event folders ...
+GDRIVE_CREDENTIALS = os.getenv("GDRIVE_CREDENTIALS", "")
+# ... or a fixed bearer token (fake server, short manual runs)
+GDRIVE_ACCESS_TOKEN = os.getenv("GDRIVE_ACCESS_TOKEN", "")
+GDRIVE_TIMEOUT_S = float(os.getenv("GDRIVE_TIMEOUT_S", "30"))
+# retries of a failed / throttled call, with exponential backoff from GDRIVE_BACKOFF_S
+GDRIVE_RETRIES = int(os.getenv("GDRIVE_RETRIES", "3"))
+GDRIVE_BACKOFF_S = float(os.getenv("GDRIVE_BACKOFF_S", "0.5"))
+# how long a photo's metadata (version, folder membership) is trusted by GET /images
+GDRIVE_STAT_TTL_S = float(os.getenv("GDRIVE_STAT_TTL_S", "60"))
+GDRIVE_STAT_MAX_ENTRIES = int(os.getenv("GDRIVE_STAT_MAX_ENTRIES", "100000"))
+# local read-through cache of downloaded originals, pruned least-recently-used
+SOURCE_CACHE_DIR = Path(os.getenv("SOURCE_CACHE_DIR", str(Path(__file__).resolve().parents[0] / "cache" / "sources")))
+SOURCE_CACHE_MAX_MB = int(os.getenv("SOURCE_CACHE_MAX_MB", "4096"))
+
+GDRIVE_SCOPE = "https://www.googleapis.com/auth/drive.readonly"
+GDRIVE_IMAGE_TYPES = ("image/jpeg", "image/png")
+CHUNK_SIZE = 256 * 1024
+EPOCH = datetime(1970, 1, 1, tzinfo = timezone.utc)
+
+# one version of a photo: a new upload or an edit changes size and/or mtime_ns
+SourceFile = namedtuple("SourceFile", ["path", "size", "mtime_ns"])
+
+class SourceUnavailable(OSError):
+    """The photo store could not be reached or refused the request (not: the photo is gone)."""
+
+class LocalSource:
+    """Event folders on a local or mounted filesystem; photo paths are plain file paths."""
+    patterns = ("*.jpg", "*.jpeg", "*.JPG", "*.png", "*.PNG")
+
+    def exists(self, root: str) -> bool:
+        return Path(root).exists()
+
+    def list(self, root: str) -> list:
+        """SourceFile of every photo directly in root, in path order."""
+        files = []
+        for pattern in self.patterns:
+            for p in sorted(Path(root).glob(pattern)):
+                st = p.stat()
+                files.append(SourceFile(str(p), st.st_size, st.st_mtime_ns))
+        return sorted(files)
+
+    def stat(self, path: str) -> SourceFile:
+        st = os.stat(path)
+        return SourceFile(path, st.st_size, st.st_mtime_ns)
+
+    def read(self, path: str, st: SourceFile = None): # type: ignore
+        """(bytes, SourceFile); the stat is taken from the open file, whatever st says."""
+        with open(path, "rb") as fh:
+            fst = os.fstat(fh.fileno())
+            data = fh.read()
+        return data, SourceFile(path, fst.st_size, fst.st_mtime_ns)
+
+    def local_path(self, path: str, st: SourceFile = None) -> str: # type: ignore
+        return path
+
+    def media_type(self, path: str) -> str:
+        return mimetypes.guess_type(path)[0] or "application/octet-stream"
+
+class SourceCache:
+    """On-disk copies of remote photos addressed by path + version
+    (<root>/<key[:2]>/<key><ext>), pruned least-recently-used past max_bytes.
+    A hit touches the file's mtime, which is what pruning orders by."""
+
+    def __init__(self, root: Path = SOURCE_CACHE_DIR, max_bytes: int = SOURCE_CACHE_MAX_MB * 1024 * 1024):
+        self.root = Path(root)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._bytes = None # lazily measured on first write
+
+    def path_for(self, st: SourceFile, ext: str = "") -> Path:
+        key = hashlib.sha1(f"{st.path}|{int(st.size)}|{int(st.mtime_ns)}".encode("utf-8")).hexdigest()
+        return self.root / key[:2] / f"{key}{ext}"
+
+    def get(self, out: Path):
+        """out if cached (and marks it used), else None."""
+        try:
+            os.utime(out)
+        except OSError:
+            return None
+        return out
+
+    def put(self, out: Path, data: bytes):
+        out.parent.mkdir(parents = True, exist_ok = True)
+        tmp = out.with_name(out.name + f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, out)
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = self._measure()
+            else:
+                self._bytes += len(data)
+            over = self._bytes > self.max_bytes
+        if over:
+            self.prune()
+
+    def _files(self):
+        return (p for p in self.root.rglob("*") if p.is_file() and not p.name.endswith(".tmp"))
+
+    def _measure(self) -> int:
+        return sum(p.stat().st_size for p in self._files()) if self.root.exists() else 0
+
+    def prune(self, target_ratio: float = 0.9):
+        """Deletes least-recently-used copies until the cache is under target_ratio * max_bytes."""
+        with self._lock:
+            files = []
+            for p in self._files():
+                try:
+                    st = p.stat()
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, p))
+            total = sum(size for _, size, _ in files)
+            files.sort()
+            for _, size, p in files:
+                if total <= self.max_bytes * target_ratio:
+                    break
+                try:
+                    p.unlink()
+                    total -= size
+                except OSError:
+                    pass
+            self._bytes = total
+
+class DriveSource:
+    """Google Drive folders through the Drive v3 REST API.
+
+    An event root is gdrive://<folder id>; a photo is gdrive://<folder id>/<name>?id=<file id>
+    (name first, so a listing sorts like the folder would on disk and burst frames stay next to
+    each other). Each thread keeps its own keep-alive connection, so the indexer's I/O threads
+    download concurrently. Downloads are kept whole in memory for decoding and written through
+    to a SourceCache; concurrent reads of one photo share a single download."""
+    scheme = "gdrive"
+
+    def __init__(self, api_url: str = GDRIVE_API_URL, cache: SourceCache = None): # type: ignore
+        url = urlsplit(api_url)
+        self.secure = url.scheme == "https"
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip("/") + "/drive/v3/files"
+        self.cache = cache or SourceCache()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._creds = None
+        self._stats = OrderedDict() # path -> (expires, SourceFile)
+        self._inflight = {} # cache file -> threading.Event of the download in progress
+        # counters are bumped from request, I/O and prefetch threads at once
+        self._count_lock = threading.Lock()
+        self.downloads = 0
+        self.download_bytes = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    def _count(self, name: str, amount: int = 1):
+        with self._count_lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    # ---------- paths ----------
+
+    @staticmethod
+    def folder_of(root: str) -> str:
+        scheme, _, rest = root.partition("://")
+        folder = rest.strip("/").split("/", 1)[0]
+        if scheme != DriveSource.scheme or not folder:
+            raise ValueError(f"not a Drive folder: {root!r}")
+        return folder
+
+    @staticmethod
+    def split(path: str) -> tuple:
+        """(folder id, name, file id) of a photo path."""
+        rest, sep, file_id = path.rpartition("?id=")
+        folder = DriveSource.folder_of(rest)
+        name = rest.partition("://")[2].strip("/").partition("/")[2]
+        if not sep or not file_id or not name:
+            raise ValueError(f"not a Drive photo: {path!r}")
+        return folder, name, file_id
+
+    @staticmethod
+    def path_for(folder: str, name: str, file_id: str) -> str:
+        return f"gdrive://{folder}/{name}?id={file_id}"
+
+    # ---------- HTTP ----------
+
+    def _token(self, refresh: bool = False) -> str:
+        if GDRIVE_ACCESS_TOKEN:
+            return GDRIVE_ACCESS_TOKEN
+        if not GDRIVE_CREDENTIALS:
+            raise SourceUnavailable("no Drive credentials: set GDRIVE_CREDENTIALS or GDRIVE_ACCESS_TOKEN")
+        if not GOOGLE_AUTH_AVAILABLE:
+            raise SourceUnavailable("GDRIVE_CREDENTIALS needs google-auth installed")
+        with self._lock:
+            if self._creds is None:
+                self._creds = service_account.Credentials.from_service_account_file(GDRIVE_CREDENTIALS, scopes = [GDRIVE_SCOPE]) # type: ignore
+            if refresh or not self._creds.valid:
+                self._creds.refresh(google_urllib3.Request(urllib3.PoolManager())) # type: ignore
+            return self._creds.token
+
+    def _conn(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            cls = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+            conn = self._local.conn = cls(self.host, self.port, timeout = GDRIVE_TIMEOUT_S) # type: ignore
+        return conn
+
+    def _drop_conn(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        if conn is not None:
+            conn.close()
+
+    def _get(self, path: str, params: dict) -> bytes:
+        """Body of GET prefix+path. 404 raises FileNotFoundError; throttling, server errors and
+        dropped connections are retried, then raise SourceUnavailable."""
+        url = self.prefix + path + "?" + urlencode({**params, "supportsAllDrives": "true"})
+        error = None
+        refresh = refreshed = False
+        for attempt in range(GDRIVE_RETRIES + 1):
+            if attempt and not refresh:
+                time.sleep(GDRIVE_BACKOFF_S * 2 ** (attempt - 1))
+            try:
+                token = self._token(refresh)
+                refresh = False
+                conn = self._conn()
+                conn.request("GET", url, headers = {"Authorization": f"Bearer {token}"})
+                resp = conn.getresponse()
+                chunks = []
+                while True:
+                    chunk = resp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    chunks.append(chunk)
+                body = b"".join(chunks)
+            except (OSError, http.client.HTTPException) as e:
+                if isinstance(e, SourceUnavailable):
+                    raise
+                self._drop_conn()
+                error = e
+                continue
+            if resp.status == 200:
+                return body
+            if resp.status == 404:
+                raise FileNotFoundError(f"Drive has no {path}")
+            if resp.status == 401 and not refreshed:
+                # expired token: refresh once, right away
+                refresh = refreshed = True
+                error = "HTTP 401"
+                continue
+            retryable = resp.status in (429, 500, 502, 503, 504) or (resp.status == 403 and b"ateLimit" in body)
+            error = f"HTTP {resp.status}: {body[:200]!r}"
+            if not retryable:
+                break
+        raise SourceUnavailable(f"Drive request {path} failed: {error}")
+
+    # ---------- PhotoSource ----------
+
+    def exists(self, root: str) -> bool:
+        try:
+            self._get("/" + quote(self.folder_of(root)), {"fields": "id"})
+        except FileNotFoundError:
+            return False
+        return True
+
+    @staticmethod
+    def _parse(folder: str, item: dict) -> SourceFile:
+        modified = datetime.fromisoformat(item["modifiedTime"].replace("Z", "+00:00"))
+        mtime_ns = (modified - EPOCH) // timedelta(microseconds = 1) * 1000
+        return SourceFile(DriveSource.path_for(folder, item["name"], item["id"]), int(item.get("size", 0)), mtime_ns)
+
+    def list(self, root: str) -> list:
+        """SourceFile of every JPEG / PNG directly in the folder, in path order."""
+        folder = self.folder_of(root)
+        types = " or ".join(f"mimeType = '{t}'" for t in GDRIVE_IMAGE_TYPES)
+        params = {"q": f"'{folder}' in parents and trashed = false and ({types})", "pageSize": 1000,
+                  "fields": "nextPageToken, files(id, name, size, modifiedTime)", "includeItemsFromAllDrives": "true"}
+        files = []
+        while True:
+            page = json.loads(self._get("", params))
+            for item in page.get("files", []):
+                files.append(self._remember(self._parse(folder, item)))
+            if not page.get("nextPageToken"):
+                break
+            params["pageToken"] = page["nextPageToken"]
+        return sorted(files)
+
+    def _remember(self, st: SourceFile) -> SourceFile:
+        with self._lock:
+            self._stats[st.path] = (time.monotonic() + GDRIVE_STAT_TTL_S, st)
+            self._stats.move_to_end(st.path)
+            while len(self._stats) > GDRIVE_STAT_MAX_ENTRIES:
+                self._stats.popitem(last = False)
+        return st
+
+    def stat(self, path: str, fresh: bool = False) -> SourceFile:
+        """Current version of a photo. Raises FileNotFoundError unless the file id really is the
+        named, untrashed photo in that folder (a path is only authorized by its folder)."""
+        if not fresh:
+            with self._lock:
+                entry = self._stats.get(path)
+            if entry is not None and entry[0] > time.monotonic():
+                return entry[1]
+        folder, name, file_id = self.split(path)
+        item = json.loads(self._get("/" + quote(file_id), {"fields": "id, name, size, modifiedTime, parents, trashed"}))
+        if item.get("trashed") or folder not in item.get("parents", []) or item.get("name") != name:
+            raise FileNotFoundError(f"{path} is not in Drive folder {folder}")
+        return self._remember(self._parse(folder, item))
+
+    def read(self, path: str, st: SourceFile = None): # type: ignore
+        """(bytes, SourceFile): from the local cache when this version was fetched before,
+        otherwise downloaded (and cached). st, if the caller has it from list(), saves a stat."""
+        st = st or self.stat(path)
+        key = out = self.cache.path_for(st, Path(self.split(path)[1]).suffix.lower())
+        first = True
+        while True:
+            if self.cache.get(out) is not None:
+                try:
+                    data = out.read_bytes()
+                    if first:
+                        self._count("cache_hits")
+                    return data, st
+                except OSError:
+                    pass # pruned in between
+            if first:
+                self._count("cache_misses")
+            first = False
+            with self._lock:
+                running = self._inflight.get(key)
+                owner = running is None
+                if owner:
+                    running = self._inflight[key] = threading.Event()
+            if owner or not running.wait(GDRIVE_TIMEOUT_S): # type: ignore
+                break
+            # the other download finished: take it from the cache (or retry it ourselves if it failed)
+        try:
+            with stage("fetch"):
+                data = self._get("/" + quote(self.split(path)[2]), {"alt": "media"})
+            self._count("downloads")
+            self._count("download_bytes", len(data))
+            if len(data) != st.size:
+                # changed since it was listed: cache it under the version it really is
+                st = self.stat(path, fresh = True)
+                out = self.cache.path_for(st, out.suffix)
+            try:
+                self.cache.put(out, data)
+            except OSError as e:
+                print(f"[WARNING] Not caching {path}: {e}")
+            return data, st
+        finally:
+            if owner:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                running.set() # type: ignore
+
+    def local_path(self, path: str, st: SourceFile = None) -> str: # type: ignore
+        """A local file with the photo's bytes (the cached copy, downloaded on a miss)."""
+        st = st or self.stat(path)
+        out = self.cache.path_for(st, Path(self.split(path)[1]).suffix.lower())
+        if self.cache.get(out) is not None:
+            self._count("cache_hits")
+            return str(out)
+        _, st = self.read(path, st)
+        return str(self.cache.path_for(st, out.suffix))
+
+    def media_type(self, path: str) -> str:
+        return mimetypes.guess_type(self.split(path)[1])[0] or "application/octet-stream"
+
+local_source = LocalSource()
+drive_source = DriveSource()
+
+# storage_path scheme -> source ("" = local paths)
+SOURCES = {"": local_source, DriveSource.scheme: drive_source}
+
+def source_for(path: str):
+    """The source serving an event root or photo path. Raises ValueError for an unknown scheme."""
+    scheme = path.partition("://")[0].lower() if "://" in path else ""
+    source = SOURCES.get(scheme)
+    if source is None:
+        raise ValueError(f"unsupported storage {scheme}://")
+    return source
+
+def path_parts(path: str) -> tuple:
+    """Normalized components of a storage path: ("gdrive:", folder, name...) for remote ones,
+    (drive, dir, ...) for local ones."""
+    if "://" in path:
+        scheme, _, rest = path.partition("://")
+        return (scheme.lower() + ":",) + tuple(p for p in posixpath.normpath("/" + rest).split("/") if p)
+    norm = os.path.normcase(os.path.abspath(path))
+    drive, rest = os.path.splitdrive(norm)
+    return (drive,) + tuple(p for p in rest.split(os.sep) if p)
+
+registry.counter_fn("vision_source_downloads_total", "Photos downloaded from remote storage.", lambda: drive_source.downloads)
+registry.counter_fn("vision_source_download_bytes_total", "Bytes downloaded from remote storage.", lambda: drive_source.download_bytes)
+registry.counter_fn("vision_source_cache_hits_total", "Remote photos read from the local cache.", lambda: drive_source.cache_hits)
+registry.counter_fn("vision_source_cache_misses_total", "Remote photos not in the local cache.", lambda: drive_source.cache_misses)
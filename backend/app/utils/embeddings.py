@@ -1,49 +1,211 @@
+import os
+import threading
 import numpy as np
-import cv2
-import insightface
-from insightface.app import FaceAnalysis
+from .images import DecodedImage, decode_image, decode_file
+from ..metrics import timed
 
-# Initialize FaceAnalysis globally to avoid reloading models on every call
-# Using buffalo_l model for high accuracy (512-dimensional embeddings)
-app_face = FaceAnalysis(name='buffalo_l', providers=['CPUExecutionProvider'])
-app_face.prepare(ctx_id=0, det_size=(640, 640))
+# insightface model pack (~/.insightface/models/<name>); buffalo_l gives 512-d embeddings
+FACE_MODEL_NAME = os.getenv("FACE_MODEL_NAME", "buffalo_l")
+FACE_MODEL_ROOT = os.getenv("FACE_MODEL_ROOT", "~/.insightface")
+# only these two files of the pack are loaded (buffalo_l also ships landmark and gender/age models)
+FACE_DET_MODEL = os.getenv("FACE_DET_MODEL", "det_10g.onnx")
+FACE_REC_MODEL = os.getenv("FACE_REC_MODEL", "w600k_r50.onnx")
+FACE_DET_SIZE = int(os.getenv("FACE_DET_SIZE", "640"))
+# onnxruntime intra-op threads per session (0 = onnxruntime default)
+ONNX_THREADS = int(os.getenv("ONNX_THREADS", "0"))
+# faces smaller than this in the detection image are aligned from a larger decode
+REC_MIN_FACE_PX = int(os.getenv("REC_MIN_FACE_PX", "112"))
+# "fork": load before worker processes fork (gunicorn --preload, indexer pool) and share pages
+PRELOAD_MODELS = os.getenv("PRELOAD_MODELS", "")
+
+class FaceModels:
+    """The detection + recognition sessions, built once per process on first use."""
+
+    def __init__(self, det_model, rec_model):
+        self.det_model = det_model
+        self.rec_model = rec_model
+
+_models = None
+_models_lock = threading.Lock()
+
+def _load_models(intra_op_threads: int) -> FaceModels:
+    # heavy imports stay out of module import time
+    import onnxruntime
+    from insightface.utils import ensure_available
+    from insightface.model_zoo.retinaface import RetinaFace
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+
+    onnxruntime.set_default_logger_severity(3)
+    model_dir = ensure_available('models', FACE_MODEL_NAME, root=FACE_MODEL_ROOT)
+    opts = onnxruntime.SessionOptions()
+    if intra_op_threads > 0:
+        opts.intra_op_num_threads = intra_op_threads
+        opts.inter_op_num_threads = 1
+
+    def session(file_name):
+        path = os.path.join(model_dir, file_name)
+        return path, onnxruntime.InferenceSession(path, sess_options=opts, providers=['CPUExecutionProvider'])
+
+    det_path, det_sess = session(FACE_DET_MODEL)
+    rec_path, rec_sess = session(FACE_REC_MODEL)
+    det_model = RetinaFace(model_file=det_path, session=det_sess)
+    det_model.prepare(0, input_size=(FACE_DET_SIZE, FACE_DET_SIZE), det_thresh=0.5)
+    rec_model = ArcFaceONNX(model_file=rec_path, session=rec_sess)
+    rec_model.prepare(0)
+    return FaceModels(det_model, rec_model)
+
+def get_models() -> FaceModels:
+    """
+    Lazily loads the detector and recognizer, once per process and thread-safe.
+    """
+    global _models
+    if _models is None:
+        with _models_lock:
+            if _models is None:
+                _models = _load_models(ONNX_THREADS)
+    return _models
+
+def preload_models(fork_safe: bool = False) -> FaceModels:
+    """
+    Loads the models now instead of on the first request.
+    With fork_safe, sessions are built single-threaded: onnxruntime thread pools do not survive
+    fork(), while single-threaded sessions do, so a parent can load once and forked children
+    (gunicorn --preload workers, the indexer's fork pool) share the weights copy-on-write.
+    """
+    global _models
+    if fork_safe:
+        with _models_lock:
+            if _models is None:
+                _models = _load_models(1)
+        return _models
+    return get_models()
+
+if PRELOAD_MODELS == "fork":
+    preload_models(fork_safe=True)
+
+@timed("detect")
+def _detect(img: np.ndarray):
+    """
+    Single detector pass. Returns (bboxes (n, 5) with det_score last, kpss (n, 5, 2)), largest face first.
+    """
+    bboxes, kpss = get_models().det_model.detect(img, max_num=0, metric='default')
+    if bboxes.shape[0] == 0:
+        return bboxes, kpss
+    # bbox is [x1, y1, x2, y2]
+    areas = (bboxes[:, 2] - bboxes[:, 0]) * (bboxes[:, 3] - bboxes[:, 1])
+    order = np.argsort(-areas, kind="stable")
+    return bboxes[order], kpss[order]
+
+@timed("align")
+def _align(img: np.ndarray, kps: np.ndarray) -> np.ndarray:
+    from insightface.utils import face_align
+    return face_align.norm_crop(img, landmark=kps, image_size=get_models().rec_model.input_size[0])
+
+@timed("embed")
+def _embed_crops(crops: list) -> np.ndarray:
+    """
+    Runs the recognition model once on a batch of aligned face crops -> (n, 512) float32.
+    """
+    if not crops:
+        return np.zeros((0, 512), dtype=np.float32)
+    return get_models().rec_model.get_feat(crops).astype(np.float32)
+
+def _crop(dec: DecodedImage, bbox: np.ndarray, kps: np.ndarray) -> np.ndarray:
+    """
+    Aligned recognition crop. Big enough faces come straight from the detection image; small ones
+    from the cheapest larger decode in which they span about REC_MIN_FACE_PX pixels.
+    """
+    face_px = float(min(bbox[2] - bbox[0], bbox[3] - bbox[1]))
+    if face_px >= REC_MIN_FACE_PX or dec.scale <= 1.0:
+        return _align(dec.img, kps)
+    needed = max(dec.img.shape[:2]) * REC_MIN_FACE_PX / max(face_px, 1.0)
+    img, scale = dec.at_least(int(needed))
+    return _align(img, kps * (dec.scale / scale))
+
+def get_faces_from_decoded(dec: DecodedImage) -> list:
+    """
+    Runs the detector once on the detection-sized image and returns every face found,
+    largest first, as dicts: {"bbox": [x1, y1, x2, y2], "det_score": float, "embedding": np.ndarray}.
+    bbox is in the coordinates of the upright full-resolution photo.
+    All faces of the image go through the recognition model as one batch.
+    """
+    if dec is None:
+        return []
+    bboxes, kpss = _detect(dec.img)
+    if not bboxes.shape[0]:
+        return []
+    embeddings = _embed_crops([_crop(dec, bbox, kps) for bbox, kps in zip(bboxes, kpss)])
+    return [
+        {
+            "bbox": [float(v) * dec.scale for v in bbox[:4]],
+            "det_score": float(bbox[4]),
+            "embedding": emb,
+        }
+        for bbox, emb in zip(bboxes, embeddings)
+    ]
+
+def get_faces_from_image(img: np.ndarray) -> list:
+    """
+    Same as get_faces_from_decoded for an already decoded BGR image (no rescaling).
+    """
+    if img is None:
+        return []
+    return get_faces_from_decoded(DecodedImage(b"", img, max(img.shape[:2]), "", 1))
+
+def get_faces_from_image_bytes(image_bytes: bytes) -> list:
+    """
+    Decodes image bytes (reduced-resolution, EXIF-upright) and returns all faces.
+    """
+    return get_faces_from_decoded(decode_image(image_bytes))
+
+def get_faces_from_file(file_path: str) -> list:
+    """
+    Reads an image from disk and returns all faces (see get_faces_from_image_bytes).
+    """
+    try:
+        dec = decode_file(file_path)
+    except OSError:
+        return []
+    return get_faces_from_decoded(dec)
 
 def get_embedding_from_image_bytes(image_bytes: bytes) -> np.ndarray:
     """
     Detects the largest face in the image bytes and returns its embedding.
     Returns a zero-vector if no face is found.
     """
-    # Convert bytes to numpy array
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-    
-    if img is None:
-        # Could not decode image
-        return np.zeros(512, dtype=np.float32)
-
-    faces = app_face.get(img)
+    faces = get_faces_from_image_bytes(image_bytes)
     if not faces:
         return np.zeros(512, dtype=np.float32)
 
-    # Sort by area (box width * height) to find the largest face
-    # face.bbox is [x1, y1, x2, y2]
-    faces = sorted(faces, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]), reverse=True)
-    
-    # Return the embedding of the largest face
+    # faces are sorted by area, so the first one is the largest
     # embedding is usually 512-d for buffalo_l
-    return faces[0].embedding.astype(np.float32)
+    return faces[0]["embedding"]
+
+def get_embeddings_from_image_bytes_batch(images: list) -> list:
+    """
+    Largest-face embedding of each image in a batch of selfies (zero-vector where no face is found).
+    Detection runs per image; recognition runs once for the whole batch.
+    """
+    crops = []
+    owners = []
+    for i, image_bytes in enumerate(images):
+        dec = decode_image(image_bytes)
+        if dec is None:
+            continue
+        bboxes, kpss = _detect(dec.img)
+        if bboxes.shape[0]:
+            crops.append(_crop(dec, bboxes[0], kpss[0]))
+            owners.append(i)
+    out = [np.zeros(512, dtype=np.float32) for _ in images]
+    for i, emb in zip(owners, _embed_crops(crops)):
+        out[i] = emb
+    return out
 
 def get_embedding_from_file(file_path: str) -> np.ndarray:
     """
     Reads an image from disk and returns the embedding of the largest face.
     """
-    img = cv2.imread(file_path)
-    if img is None:
-        return np.zeros(512, dtype=np.float32)
-        
-    faces = app_face.get(img)
+    faces = get_faces_from_file(file_path)
     if not faces:
         return np.zeros(512, dtype=np.float32)
-
-    faces = sorted(faces, key=lambda x: (x.bbox[2] - x.bbox[0]) * (x.bbox[3] - x.bbox[1]), reverse=True)
-    return faces[0].embedding.astype(np.float32)
\ No newline at end of file
+    return faces[0]["embedding"]
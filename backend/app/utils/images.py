@@ -0,0 +1,163 @@
+import os
+import io
+import numpy as np
+from datetime import datetime, timezone
+import cv2
+from PIL import Image
+from ..metrics import timed
+
+# long edge images are decoded to before detection; the detector itself works at 640x640,
+# so anything above that only buys headroom for aligning mid-sized faces
+DECODE_LONG_EDGE = int(os.getenv("DECODE_LONG_EDGE", "960"))
+
+_REDUCED = {1: cv2.IMREAD_COLOR, 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8}
+
+def read_header(data: bytes):
+    """(width, height, format, exif_orientation) from the file header, without decoding pixels.
+    Returns None if Pillow cannot parse it."""
+    try:
+        im = Image.open(io.BytesIO(data))
+        orientation = int(im.getexif().get(0x0112, 1) or 1)
+        return im.size[0], im.size[1], im.format, orientation
+    except Exception:
+        return None
+
+def apply_orientation(img: np.ndarray, orientation: int) -> np.ndarray:
+    """Rotates/flips a decoded image per its EXIF orientation tag (1..8)."""
+    if orientation == 2:
+        return cv2.flip(img, 1)
+    if orientation == 3:
+        return cv2.rotate(img, cv2.ROTATE_180)
+    if orientation == 4:
+        return cv2.flip(img, 0)
+    if orientation == 5:
+        return cv2.flip(cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE), 1)
+    if orientation == 6:
+        return cv2.rotate(img, cv2.ROTATE_90_CLOCKWISE)
+    if orientation == 7:
+        return cv2.flip(cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE), 1)
+    if orientation == 8:
+        return cv2.rotate(img, cv2.ROTATE_90_COUNTERCLOCKWISE)
+    return img
+
+class DecodedImage:
+    """A detection-sized, upright BGR image plus the way back to full resolution.
+
+    img is what the detector sees; multiplying its coordinates by scale gives coordinates in the
+    upright full-resolution photo. at_least(long_edge) re-decodes (cached, with the cheapest JPEG
+    reduction that is big enough) when recognition needs more pixels than img has."""
+
+    def __init__(self, data: bytes, img: np.ndarray, full_long_edge: int, fmt: str, orientation: int):
+        self.data = data
+        self.img = img
+        self.full_long_edge = int(full_long_edge)
+        self.format = fmt
+        self.orientation = orientation
+        self.scale = self.full_long_edge / float(max(img.shape[:2]))
+        self._larger = {}
+
+    def at_least(self, long_edge: int):
+        """(image, scale) with a long edge of at least long_edge (capped at full size)."""
+        if max(self.img.shape[:2]) >= long_edge:
+            return self.img, self.scale
+        factor = _reduction(self.full_long_edge, long_edge, self.format)
+        if factor not in self._larger:
+            self._larger[factor] = _decode(self.data, factor, self.orientation)
+        img = self._larger[factor]
+        return img, self.full_long_edge / float(max(img.shape[:2]))
+
+    def __getstate__(self):
+        # cached larger decodes stay in the process that made them
+        return {"data": self.data, "img": self.img, "full_long_edge": self.full_long_edge,
+                "format": self.format, "orientation": self.orientation}
+
+    def __setstate__(self, state):
+        self.__init__(state["data"], state["img"], state["full_long_edge"], state["format"], state["orientation"])
+
+def _reduction(full_long_edge: int, target: int, fmt: str) -> int:
+    # JPEG can be decoded at 1/2, 1/4, 1/8 scale directly (DCT scaling), at a fraction of the cost
+    if fmt != "JPEG":
+        return 1
+    for factor in (8, 4, 2):
+        if full_long_edge / factor >= target:
+            return factor
+    return 1
+
+def _decode(data: bytes, factor: int, orientation: int):
+    img = cv2.imdecode(np.frombuffer(data, np.uint8), _REDUCED[factor] | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        return None
+    return apply_orientation(img, orientation)
+
+@timed("decode")
+def decode_image(data: bytes, long_edge: int = DECODE_LONG_EDGE):
+    """Decodes image bytes to an upright image whose long edge is about long_edge.
+    Returns a DecodedImage, or None if the bytes are not a readable image."""
+    header = read_header(data)
+    if header is None:
+        # unknown to Pillow; let OpenCV try (it applies EXIF orientation itself)
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return None
+        return DecodedImage(data, img, max(img.shape[:2]), "", 1)
+
+    width, height, fmt, orientation = header
+    full_long = max(width, height)
+    img = _decode(data, _reduction(full_long, long_edge, fmt), orientation)
+    if img is None:
+        return None
+    cur_long = max(img.shape[:2])
+    if long_edge and cur_long > long_edge:
+        f = long_edge / float(cur_long)
+        img = cv2.resize(img, (max(1, round(img.shape[1] * f)), max(1, round(img.shape[0] * f))), interpolation=cv2.INTER_AREA)
+    return DecodedImage(data, img, full_long, fmt, orientation)
+
+def decode_file(file_path: str, long_edge: int = DECODE_LONG_EDGE):
+    with open(file_path, "rb") as fh:
+        return decode_image(fh.read(), long_edge)
+
+def perceptual_hash(img: np.ndarray, size: int = 8) -> int:
+    """size*size-bit difference hash (dHash) of an image: the sign of the horizontal gradient on a
+    (size+1) x size grayscale thumbnail. At 8 (64 bits) re-encodes, resizes and the frames of a
+    burst land within a few bits of each other, but so do unrelated photos with the same coarse
+    layout; at 16 (256 bits) a shift of 1% already moves ~20 bits, so it tells those apart."""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    small = cv2.resize(gray, (size + 1, size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def _exif_seconds(stamp, subsec=None):
+    # "YYYY:MM:DD HH:MM:SS" (camera local time; only differences between photos matter)
+    try:
+        t = datetime.strptime(str(stamp).strip("\x00 "), "%Y:%m:%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+    digits = str(subsec or "").strip("\x00 ")
+    return t + float("0." + digits) if digits.isdigit() else t
+
+def read_photo_info(data: bytes):
+    """(width, height, taken) of the upright photo from its header, without decoding pixels.
+    taken is the EXIF capture time in seconds (DateTimeOriginal, else DateTime), or None when
+    the file carries none (screenshots, messenger re-sends, synthetic images). None if Pillow
+    cannot parse the header."""
+    try:
+        im = Image.open(io.BytesIO(data))
+        exif = im.getexif()
+        width, height = im.size
+    except Exception:
+        return None
+    if int(exif.get(0x0112, 1) or 1) in (5, 6, 7, 8):
+        width, height = height, width
+    try:
+        sub = exif.get_ifd(0x8769)
+    except Exception:
+        sub = {}
+    taken = None
+    if sub.get(0x9003):
+        taken = _exif_seconds(sub.get(0x9003), sub.get(0x9291))
+    if taken is None and exif.get(0x0132):
+        taken = _exif_seconds(exif.get(0x0132), sub.get(0x9290))
+    return width, height, taken
+
+def hash_distance(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
@@ -0,0 +1,553 @@
+"""Offline benchmarks for indexing and matching.
+
+Needs no server, Postgres, model download or sample photos: embeddings come from a deterministic
+stub embedder, photos are synthetic JPEGs, the database is a throwaway SQLite file and every
+index/cache directory lives under --workdir. Results are written as JSON so two commits can be
+compared with --compare.
+
+    python benchmarks/bench.py --out before.json
+    python benchmarks/bench.py --only index --sizes 1000000,5000000 --chunk 250000 --out big.json
+    python benchmarks/bench.py --compare before.json after.json
+
+Phases:
+  index    EventFaissIndex add / compact / search latency, recall@k against exact brute force
+           and memory per face, for the numpy path (uncompacted segments) and each index type
+           in --index-types after compact
+  indexer  worker.indexer.index_local_folder throughput on synthetic photos, cold and re-run
+           (near-duplicate skipping off, so runs stay comparable across commits)
+  match    POST /api/v1/match end to end under concurrent load, on the indexer's event
+  dedup    near-duplicate skipping on bursts of really similar photos (shifted / re-encoded /
+           resized frames with EXIF capture times) next to distinct photos taken seconds apart:
+           links made, wrong links, and inference saved
+"""
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+BENCH_FORMAT = 1
+DIM = 512
+
+# --------------------------------------------------------------------------- helpers
+
+def percentiles(values: list) -> dict:
+    """p50/p95/p99/mean in milliseconds for a list of seconds."""
+    if not values:
+        return {"p50": None, "p95": None, "p99": None, "mean": None}
+    v = np.sort(np.asarray(values, dtype = np.float64)) * 1000.0
+    def pct(p):
+        return round(float(v[min(len(v) - 1, int(p * len(v)))]), 3)
+    return {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99), "mean": round(float(v.mean()), 3)}
+
+def rss_peak_mb() -> float:
+    # ru_maxrss is KiB on Linux, bytes on macOS; peak over the whole process so far
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+def dir_bytes(path: Path) -> int:
+    return sum(p.stat().st_size for p in Path(path).rglob("*") if p.is_file())
+
+def git_commit() -> str:
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd = REPO_ROOT, capture_output = True, text = True, timeout = 10)
+        return out.stdout.strip() or None # type: ignore
+    except Exception:
+        return None # type: ignore
+
+def unit(v: np.ndarray) -> np.ndarray:
+    return (v / np.maximum(np.linalg.norm(v, axis = -1, keepdims = True), 1e-12)).astype(np.float32)
+
+# --------------------------------------------------------------------------- stub embedder
+
+class StubEmbedder:
+    """Deterministic stand-in for app.utils.embeddings.
+
+    Every photo gets 0-3 faces chosen from a fixed pool of identities by hashing its bytes; a
+    face embedding is its identity's centroid plus noise. A selfie is embedded as the largest
+    face's identity with fresh noise, so it matches that person's photos the way a real selfie
+    would. infer_ms adds a per-image sleep to stand in for model cost."""
+
+    def __init__(self, identities: int = 200, noise: float = 0.35, infer_ms: float = 0.0, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.centroids = unit(rng.standard_normal((identities, DIM)))
+        self.noise = noise
+        self.infer_ms = infer_ms
+
+    def _rng(self, data: bytes, salt: bytes = b""):
+        return np.random.default_rng(int.from_bytes(hashlib.sha1(salt + data).digest()[:8], "little"))
+
+    def identities_of(self, data: bytes) -> list:
+        """Identity ids in a photo, largest face first."""
+        rng = self._rng(data)
+        n = int(rng.integers(0, 4))
+        return [int(x) for x in rng.choice(len(self.centroids), size = n, replace = False)]
+
+    def _face(self, identity: int, rng) -> np.ndarray:
+        return unit(self.centroids[identity] + self.noise * rng.standard_normal(DIM) / np.sqrt(DIM))
+
+    def faces(self, data: bytes) -> list:
+        if self.infer_ms:
+            time.sleep(self.infer_ms / 1000.0)
+        rng = self._rng(data, b"faces")
+        out = []
+        for i, identity in enumerate(self.identities_of(data)):
+            size = 400.0 / (i + 1)
+            out.append({"bbox": [10.0 * i, 10.0, 10.0 * i + size, 10.0 + size], "det_score": 0.9, "embedding": self._face(identity, rng)})
+        return out
+
+    def selfie(self, data: bytes) -> np.ndarray:
+        ids = self.identities_of(data)
+        if not ids:
+            return np.zeros(DIM, dtype = np.float32)
+        return self._face(ids[0], self._rng(data, b"selfie"))
+
+    def install(self):
+        """Replaces app.utils.embeddings in sys.modules; must run before the app or indexer is imported."""
+        from app.utils.images import decode_image
+        m = types.ModuleType("app.utils.embeddings")
+        m.preload_models = lambda *args, **kwargs: None
+        m.get_faces_from_decoded = lambda dec: [] if dec is None else self.faces(dec.data)
+        m.get_faces_from_image_bytes = self.faces
+        m.get_faces_from_file = lambda path: self.faces(Path(path).read_bytes())
+        m.get_embedding_from_image_bytes = self.selfie
+        m.get_embedding_from_file = lambda path: self.selfie(Path(path).read_bytes())
+        m.get_embeddings_from_image_bytes_batch = lambda images: [self.selfie(b) for b in images]
+        m.decode_image = decode_image
+        sys.modules["app.utils.embeddings"] = m
+        import app.utils
+        app.utils.embeddings = m # type: ignore
+
+# --------------------------------------------------------------------------- index phase
+
+def synthetic_chunk(seed: int, start: int, n: int) -> np.ndarray:
+    """Rows start..start+n of the synthetic corpus; any chunk can be regenerated on its own."""
+    return unit(np.random.default_rng([seed, start]).standard_normal((n, DIM), dtype = np.float32))
+
+def synthetic_queries(seed: int, size: int, chunk: int, nq: int, noise: float) -> np.ndarray:
+    """Noisy copies of random corpus rows, so every query has a true near neighbour."""
+    rng = np.random.default_rng([seed, size, 7])
+    rows = np.sort(rng.choice(size, min(nq, size), replace = False))
+    base = []
+    for start in sorted({int(r) // chunk * chunk for r in rows}):
+        vecs = synthetic_chunk(seed, start, min(chunk, size - start))
+        base.extend(vecs[int(r) - start] for r in rows if start <= r < start + chunk)
+    base = np.stack(base) if base else np.empty((0, DIM), np.float32)
+    return unit(base + noise * rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(DIM))
+
+def exact_top_k(seed: int, size: int, chunk: int, queries: np.ndarray, k: int) -> np.ndarray:
+    """Ground-truth face ids (row + 1) by brute force, one chunk of the corpus at a time."""
+    best_s = np.full((len(queries), 0), -np.inf, dtype = np.float32)
+    best_i = np.empty((len(queries), 0), dtype = np.int64)
+    for start in range(0, size, chunk):
+        n = min(chunk, size - start)
+        sims = queries @ synthetic_chunk(seed, start, n).T
+        best_s = np.concatenate([best_s, sims], axis = 1)
+        best_i = np.concatenate([best_i, np.broadcast_to(np.arange(start + 1, start + n + 1), sims.shape)], axis = 1)
+        keep = np.argsort(-best_s, axis = 1)[:, :k]
+        best_s = np.take_along_axis(best_s, keep, axis = 1)
+        best_i = np.take_along_axis(best_i, keep, axis = 1)
+    return best_i
+
+def recall_at_k(rows: list, truth: np.ndarray, k: int) -> float:
+    hits = 0
+    for row, true_ids in zip(rows, truth):
+        hits += len({m["face_db_id"] for m in row[:k]} & set(int(t) for t in true_ids[:k]))
+    return round(hits / float(max(truth.shape[0] * k, 1)), 4)
+
+def measure_search(idx, queries: np.ndarray, truth: np.ndarray, k: int, single: int) -> dict:
+    lat = []
+    for q in queries[:single]:
+        t0 = time.perf_counter()
+        idx.search(q.reshape(1, -1), k = k)
+        lat.append(time.perf_counter() - t0)
+    t0 = time.perf_counter()
+    rows = idx.search(queries, k = k)
+    batch_s = time.perf_counter() - t0
+    return {
+        "single_query_ms": percentiles(lat),
+        "batch_queries": int(len(queries)),
+        "batch_ms": round(batch_s * 1000.0, 3),
+        "batch_qps": round(len(queries) / max(batch_s, 1e-9), 1),
+        # recall@1: was the row the query was made from found; recall@k: the exact top-k set
+        "recall_at_1": recall_at_k(rows, truth, 1),
+        f"recall_at_{k}": recall_at_k(rows, truth, k),
+    }
+
+def bench_index(args, workdir: Path) -> dict:
+    from app import faiss_index
+    from app.faiss_index import EventFaissIndex
+
+    out = {}
+    for size in args.sizes:
+        root = workdir / f"vectors_{size}"
+        shutil.rmtree(root, ignore_errors = True)
+        queries = synthetic_queries(args.seed, size, args.chunk, args.queries, args.query_noise)
+        truth = exact_top_k(args.seed, size, args.chunk, queries, args.k)
+        idx = EventFaissIndex(1, dim = DIM, index_dir = str(root))
+
+        add_s = 0.0
+        for start in range(0, size, args.chunk):
+            n = min(args.chunk, size - start)
+            vecs = synthetic_chunk(args.seed, start, n)
+            t0 = time.perf_counter()
+            idx.add(vecs, list(range(start + 1, start + n + 1)))
+            add_s += time.perf_counter() - t0
+        res = {
+            "vectors": size,
+            "segments_before_compact": len(idx.store.segments),
+            "add_s": round(add_s, 3),
+            "add_vectors_per_s": round(size / max(add_s, 1e-9), 1),
+        }
+        # freshly appended segments are not covered by an ANN index: brute-force numpy path
+        res["numpy"] = measure_search(EventFaissIndex(1, dim = DIM, index_dir = str(root)), queries, truth, args.k, args.single_queries)
+
+        # compact into each requested index type in turn (the first call also merges segments)
+        res["types"] = {}
+        for i, requested in enumerate(args.index_types):
+            faiss_index.INDEX_TYPE = requested
+            t0 = time.perf_counter()
+            idx.compact(force = i == 0)
+            compact_s = time.perf_counter() - t0
+            reopened = EventFaissIndex(1, dim = DIM, index_dir = str(root))
+            kind = faiss_index.choose_index_type(reopened.store.live_rows())
+            entry = measure_search(reopened, queries, truth, args.k, args.single_queries)
+            entry.update({
+                "requested": requested,
+                "compact_s": round(compact_s, 3),
+                "segments": len(reopened.store.segments),
+                "index_memory_mb": round(reopened.memory_bytes() / 1e6, 1),
+                "bytes_per_face": round(reopened.memory_bytes() / float(size), 1),
+                "disk_mb": round(dir_bytes(root) / 1e6, 1),
+            })
+            res["types"][kind] = entry
+            del reopened
+        faiss_index.INDEX_TYPE = "auto"
+        res["rss_peak_mb"] = rss_peak_mb()
+        res["faiss_available"] = bool(faiss_index.FAISS_AVAILABLE)
+        out[str(size)] = res
+        print(f"[INFO] index {size}: {json.dumps(res)}")
+        if not args.keep:
+            del idx
+            shutil.rmtree(root, ignore_errors = True)
+    return out
+
+# --------------------------------------------------------------------------- indexer phase
+
+def make_photos(folder: Path, count: int, width: int, height: int, seed: int) -> list:
+    """Synthetic JPEGs with enough structure to decode and compress like photos."""
+    import cv2
+    folder.mkdir(parents = True, exist_ok = True)
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    paths = []
+    for i in range(count):
+        path = folder / f"photo_{i:06d}.jpg"
+        if not path.exists():
+            base = (np.sin(xx / rng.uniform(20, 200)) + np.cos(yy / rng.uniform(20, 200))) * 60 + 128
+            img = np.clip(base[..., None] + rng.normal(0, 18, (height, width, 3)), 0, 255).astype(np.uint8)
+            ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, 88])
+            path.write_bytes(buf.tobytes())
+        paths.append(path)
+    return paths
+
+def make_bursts(folder: Path, bursts: int, frames: int, width: int, height: int, seed: int) -> dict:
+    """Synthetic bursts: frame 0 of each is a distinct scene, the others are it shifted by 0.5%
+    per frame and re-encoded, the last one also resized to half (a re-export). Bursts are taken 3 s
+    apart, so neighbouring bursts are only told apart by their pixels. Returns {path: burst}."""
+    import cv2
+    from PIL import Image
+    folder.mkdir(parents = True, exist_ok = True)
+    rng = np.random.default_rng([seed, 20])
+    start = time.mktime((2024, 5, 1, 12, 0, 0, 0, 0, -1))
+    out = {}
+    for b in range(bursts):
+        # random low-frequency structure: each scene has its own layout, unlike make_photos' gradients
+        field = cv2.resize(rng.standard_normal((6, 8)).astype(np.float32), (width, height), interpolation = cv2.INTER_CUBIC)
+        scene = np.clip(field[..., None] * 50 + 128 + rng.normal(0, 8, (height, width, 3)), 0, 255).astype(np.uint8)
+        for f in range(frames):
+            dx, dy = int(width * 0.005 * f), int(height * 0.005 * f)
+            img = np.roll(scene, (dy, dx), axis = (0, 1))
+            if f == frames - 1 and f > 0:
+                img = cv2.resize(img, (width // 2, height // 2), interpolation = cv2.INTER_AREA)
+            exif = Image.Exif()
+            taken = time.localtime(start + 3 * b)
+            exif.get_ifd(0x8769)[0x9003] = time.strftime("%Y:%m:%d %H:%M:%S", taken)
+            exif.get_ifd(0x8769)[0x9291] = f"{f * 30:02d}"
+            path = folder / f"burst_{b:04d}_{f:02d}.jpg"
+            Image.fromarray(img[..., ::-1]).save(path, "JPEG", quality = int(rng.integers(80, 95)), exif = exif)
+            out[str(path)] = b
+    return out
+
+def bench_dedup(args, workdir: Path) -> dict:
+    import indexer
+    from app.db import SessionLocal
+    from app.models import DuplicateImage
+
+    folder = workdir / "bursts"
+    bursts = make_bursts(folder, args.dedup_bursts, args.dedup_frames, args.image_width, args.image_height, args.seed)
+    event_id, _ = create_event(str(folder))
+    saved = indexer.INDEXER_DEDUP
+    indexer.INDEXER_DEDUP = True
+    try:
+        run = indexer.index_local_folder(event_id, str(folder), workers = args.workers)
+    finally:
+        indexer.INDEXER_DEDUP = saved
+    db = SessionLocal()
+    try:
+        links = [(row.image_path, row.leader_path, row.distance) for row in db.query(DuplicateImage).filter(DuplicateImage.event_id == event_id)]
+    finally:
+        db.close()
+    wrong = [l for l in links if bursts[l[0]] != bursts[l[1]]]
+    possible = args.dedup_bursts * (args.dedup_frames - 1)
+    res = {
+        "files": len(bursts),
+        "bursts": args.dedup_bursts,
+        "possible_links": possible,
+        "links": len(links),
+        "wrong_links": len(wrong),
+        "link_recall": round((len(links) - len(wrong)) / float(max(possible, 1)), 4),
+        "embedded": run["images"] if run else None,
+        "duplicate_distances": run["duplicate_distances"] if run else None,
+        "elapsed_s": run["elapsed_s"] if run else None,
+    }
+    print(f"[INFO] dedup: {json.dumps(res)}")
+    return res
+
+def create_event(storage_path: str):
+    import secrets
+    from app.db import SessionLocal
+    from app.models import Event
+    db = SessionLocal()
+    ev = Event(event_code = f"BENCH_{secrets.token_hex(4)}", token = secrets.token_urlsafe(16), storage_path = storage_path)
+    db.add(ev)
+    db.commit()
+    db.refresh(ev)
+    event_id, token = ev.id, ev.token
+    db.close()
+    return event_id, token
+
+def bench_indexer(args, workdir: Path, state: dict) -> dict:
+    from indexer import index_local_folder
+
+    folder = workdir / "photos"
+    t0 = time.perf_counter()
+    make_photos(folder, args.images, args.image_width, args.image_height, args.seed)
+    gen_s = time.perf_counter() - t0
+    event_id, token = create_event(str(folder))
+    state["event_id"], state["token"], state["folder"] = event_id, token, folder
+
+    cold = index_local_folder(event_id, str(folder), workers = args.workers)
+    warm = index_local_folder(event_id, str(folder), workers = args.workers)
+    res = {
+        "images": args.images,
+        "image_size": f"{args.image_width}x{args.image_height}",
+        "workers": args.workers,
+        "stub_infer_ms": args.stub_infer_ms,
+        "photo_generation_s": round(gen_s, 3),
+        "cold": cold,
+        "rerun_unchanged": warm,
+        "rss_peak_mb": rss_peak_mb(),
+    }
+    print(f"[INFO] indexer: {json.dumps(res)}")
+    return res
+
+# --------------------------------------------------------------------------- match phase
+
+def bench_match(args, workdir: Path, state: dict, stub: StubEmbedder) -> dict:
+    from fastapi.testclient import TestClient
+    from app.main import app
+
+    if "event_id" not in state:
+        # --only match: index a small photo set first
+        bench_indexer(args, workdir, state)
+    photos = sorted(Path(state["folder"]).glob("*.jpg"))
+    selfies = [p.read_bytes() for p in photos]
+    selfies = [b for b in selfies if stub.identities_of(b)]
+    if not selfies:
+        return {"error": "no synthetic photo has a face; raise --images"}
+    rng = np.random.default_rng(args.seed)
+    picks = rng.integers(0, len(selfies), args.requests)
+
+    def one(i):
+        data = selfies[int(picks[i])]
+        t0 = time.perf_counter()
+        resp = client.post("/api/v1/match", data = {"token": state["token"], "k": str(args.k)},
+                           files = {"file": ("selfie.jpg", data, "image/jpeg")})
+        elapsed = time.perf_counter() - t0
+        top_hit = None
+        if resp.status_code == 200:
+            results = resp.json()["results"]
+            if results:
+                # quality check: does the best image contain the selfie's person?
+                wanted = stub.identities_of(data)[0]
+                top_hit = wanted in stub.identities_of(Path(results[0]["image_path"]).read_bytes())
+        return resp.status_code, elapsed, top_hit
+
+    with TestClient(app) as client:
+        for i in range(min(args.concurrency, args.requests)):
+            one(i) # warm-up: index load, first-request costs
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers = args.concurrency) as pool:
+            outcomes = list(pool.map(one, range(args.requests)))
+        wall = time.perf_counter() - t0
+        inference = client.get("/api/v1/match/inference-stats").json()
+        cache = client.get("/api/v1/match/cache-stats").json()
+
+    ok = [o for o in outcomes if o[0] == 200]
+    judged = [o[2] for o in ok if o[2] is not None]
+    res = {
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "ok": len(ok),
+        "status_counts": {str(s): sum(1 for o in outcomes if o[0] == s) for s in sorted({o[0] for o in outcomes})},
+        "latency_ms": percentiles([o[1] for o in ok]),
+        "throughput_rps": round(len(outcomes) / max(wall, 1e-9), 1),
+        "top1_identity_hit_rate": round(sum(judged) / float(len(judged)), 4) if judged else None,
+        "inference": inference,
+        "index_cache": cache,
+        "rss_peak_mb": rss_peak_mb(),
+    }
+    print(f"[INFO] match: {json.dumps(res)}")
+    return res
+
+# --------------------------------------------------------------------------- compare
+
+def flatten(obj, prefix: str = "") -> dict:
+    out = {}
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            out.update(flatten(v, f"{prefix}.{k}" if prefix else str(k)))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        out[prefix] = float(obj)
+    return out
+
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    """Prints every numeric metric whose relative change exceeds threshold (in percent)."""
+    with open(old_path) as fh:
+        old = flatten({k: v for k, v in json.load(fh).items() if k != "meta"})
+    with open(new_path) as fh:
+        new = flatten({k: v for k, v in json.load(fh).items() if k != "meta"})
+    changed = 0
+    for key in sorted(set(old) & set(new)):
+        a, b = old[key], new[key]
+        if a == b:
+            continue
+        delta = (b - a) / abs(a) * 100.0 if a else float("inf")
+        if abs(delta) >= threshold:
+            changed += 1
+            print(f"{key:70s} {a:>14.3f} -> {b:>14.3f}  ({delta:+.1f}%)")
+    for key in sorted(set(old) ^ set(new)):
+        print(f"{key:70s} only in {'old' if key in old else 'new'}")
+    print(f"{changed} metric(s) changed by >= {threshold}%")
+    return 0
+
+# --------------------------------------------------------------------------- main
+
+def parse_args(argv = None):
+    p = argparse.ArgumentParser(description = "Offline indexing / matching benchmarks (JSON output).")
+    p.add_argument("--only", choices = ["index", "indexer", "match", "dedup"], action = "append", help = "run only these phases (repeatable)")
+    p.add_argument("--sizes", default = "10000,100000", help = "comma-separated corpus sizes for the index phase (up to millions)")
+    p.add_argument("--chunk", type = int, default = 100000, help = "vectors per add() call / ground-truth chunk")
+    p.add_argument("--queries", type = int, default = 200, help = "queries for batch search and recall")
+    p.add_argument("--single-queries", type = int, default = 100, help = "queries timed one at a time")
+    p.add_argument("--query-noise", type = float, default = 0.5)
+    p.add_argument("--index-types", default = "auto", help = "comma-separated INDEX_TYPE values to compact into and measure "
+                   "(auto, flat, flat_f16, flat_i8, hnsw, hnsw_sq8, ivfpq)")
+    p.add_argument("--k", type = int, default = 10)
+    p.add_argument("--images", type = int, default = 200)
+    p.add_argument("--image-width", type = int, default = 1600)
+    p.add_argument("--image-height", type = int, default = 1200)
+    p.add_argument("--workers", type = int, default = 2, help = "indexer inference processes (0 = in-process)")
+    p.add_argument("--identities", type = int, default = 50, help = "distinct people in the synthetic photos")
+    p.add_argument("--stub-infer-ms", type = float, default = 0.0, help = "simulated model time per image")
+    p.add_argument("--dedup-bursts", type = int, default = 20, help = "dedup phase: bursts (distinct scenes)")
+    p.add_argument("--dedup-frames", type = int, default = 4, help = "dedup phase: photos per burst")
+    p.add_argument("--requests", type = int, default = 300)
+    p.add_argument("--concurrency", type = int, default = 8)
+    p.add_argument("--seed", type = int, default = 1234)
+    p.add_argument("--workdir", default = None, help = "scratch dir (default: a new temp dir, removed afterwards)")
+    p.add_argument("--keep", action = "store_true", help = "keep the scratch dir")
+    p.add_argument("--out", default = None, help = "write JSON here (default: stdout)")
+    p.add_argument("--compare", nargs = 2, metavar = ("OLD", "NEW"), help = "diff two result files and exit")
+    p.add_argument("--threshold", type = float, default = 5.0, help = "--compare: minimum relative change to show, percent")
+    args = p.parse_args(argv)
+    args.sizes = [int(s) for s in str(args.sizes).split(",") if s.strip()]
+    args.index_types = [t.strip() for t in str(args.index_types).split(",") if t.strip()]
+    return args
+
+def main(argv = None):
+    args = parse_args(argv)
+    if args.compare:
+        return compare(args.compare[0], args.compare[1], args.threshold)
+
+    workdir = Path(args.workdir or tempfile.mkdtemp(prefix = "vision-bench-"))
+    workdir.mkdir(parents = True, exist_ok = True)
+    # everything the app and indexer write goes to the scratch dir; set before they are imported
+    os.environ["DATABASE_URL"] = f"sqlite:///{workdir / 'bench.sqlite'}?check_same_thread=false"
+    os.environ["INDEX_DIR"] = str(workdir / "indices")
+    os.environ["DERIVATIVE_CACHE_DIR"] = str(workdir / "derivatives")
+    os.environ.setdefault("IMAGE_ID_SECRET", "bench")
+    # the indexer / match phases measure every photo embedded (make_photos' gradients look alike
+    # to a perceptual hash); the dedup phase switches skipping on for its own event
+    os.environ.setdefault("INDEXER_DEDUP", "0")
+    for p in (REPO_ROOT / "backend", REPO_ROOT / "worker"):
+        if str(p) not in sys.path:
+            sys.path.insert(0, str(p))
+
+    stub = StubEmbedder(identities = args.identities, infer_ms = args.stub_infer_ms, seed = args.seed)
+    stub.install()
+    from app.db import init_db
+    from app import faiss_index
+    init_db()
+
+    phases = args.only or ["index", "indexer", "match", "dedup"]
+    result = {
+        "meta": {
+            "format": BENCH_FORMAT,
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "faiss_available": bool(faiss_index.FAISS_AVAILABLE),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": {k: v for k, v in vars(args).items() if k not in ("compare", "out", "workdir")},
+        }
+    }
+    state = {}
+    try:
+        if "index" in phases:
+            result["index"] = bench_index(args, workdir)
+        if "indexer" in phases:
+            result["indexer"] = bench_indexer(args, workdir, state)
+        if "match" in phases:
+            result["match"] = bench_match(args, workdir, state, stub)
+        if "dedup" in phases:
+            result["dedup"] = bench_dedup(args, workdir)
+    finally:
+        if not (args.keep or args.workdir):
+            shutil.rmtree(workdir, ignore_errors = True)
+    result["meta"]["rss_peak_mb"] = rss_peak_mb()
+
+    text = json.dumps(result, indent = 2)
+    if args.out:
+        Path(args.out).write_text(text)
+        print(f"[INFO] Results written to {args.out}")
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
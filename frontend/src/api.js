@@ -20,3 +20,39 @@ export const matchFace = async (token, file) => {
   });
   return response.data;
 };
+
+export const matchFaces = async (tokens, files, fusion = 'max') => {
+  const formData = new FormData();
+  tokens.forEach((token) => formData.append('tokens', token));
+  files.forEach((file) => formData.append('files', file));
+  formData.append('k', 5);
+  formData.append('fusion', fusion);
+
+  const response = await axios.post(`${API_URL}/match/batch`, formData, {
+    headers: {
+      'Content-Type': 'multipart/form-data',
+    },
+  });
+  return response.data;
+};
+
+export const matchAlbum = async (token, file, limit = 60) => {
+  const formData = new FormData();
+  formData.append('token', token);
+  formData.append('file', file);
+  formData.append('limit', limit);
+
+  const response = await axios.post(`${API_URL}/match/album`, formData, {
+    headers: {
+      'Content-Type': 'multipart/form-data',
+    },
+  });
+  return response.data;
+};
+
+export const albumPage = async (token, album, offset, limit = 60) => {
+  const response = await axios.get(`${API_URL}/match/album`, {
+    params: { token, album, offset, limit },
+  });
+  return response.data;
+};
@@ -0,0 +1,145 @@
+"""Local stand-in for the Google Drive v3 API, enough for app/sources.py (DriveSource).
+
+Serves a directory as Drive folders: the directory itself is folder --folder-id, and each
+subdirectory is a folder whose id is its name. File ids are stable hashes of the relative path;
+modifiedTime and size come from the files on disk, so editing or deleting a photo shows up
+like it would on Drive.
+
+    python infra/fake_drive.py --root sample_images --port 8765 --token dev --latency-ms 50
+    GDRIVE_API_URL=http://127.0.0.1:8765 GDRIVE_ACCESS_TOKEN=dev uvicorn app.main:app
+    # register the event with storage_path "gdrive://photos"
+
+Endpoints: GET /drive/v3/files?q=... (paged), GET /drive/v3/files/<id>?fields=...,
+GET /drive/v3/files/<id>?alt=media. --fail-rate makes that fraction of calls answer 503.
+"""
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import mimetypes
+from pathlib import Path
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png")
+
+class FakeDrive:
+    def __init__(self, root: Path, folder_id: str = "photos"):
+        self.root = Path(root)
+        self.folder_id = folder_id
+
+    def folders(self) -> dict:
+        out = {self.folder_id: self.root}
+        for p in sorted(self.root.iterdir()):
+            if p.is_dir():
+                out[p.name] = p
+        return out
+
+    @staticmethod
+    def file_id(folder: str, name: str) -> str:
+        return hashlib.sha1(f"{folder}/{name}".encode("utf-8")).hexdigest()[:24]
+
+    def item(self, folder: str, path: Path) -> dict:
+        st = path.stat()
+        modified = datetime.fromtimestamp(st.st_mtime_ns // 1000 / 1e6, tz = timezone.utc)
+        return {
+            "kind": "drive#file",
+            "id": self.file_id(folder, path.name),
+            "name": path.name,
+            "mimeType": mimetypes.guess_type(path.name)[0] or "application/octet-stream",
+            "size": str(st.st_size),
+            "modifiedTime": modified.strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "parents": [folder],
+            "trashed": False,
+        }
+
+    def children(self, folder: str) -> list:
+        root = self.folders().get(folder)
+        if root is None:
+            return []
+        return [self.item(folder, p) for p in sorted(root.iterdir()) if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES]
+
+    def find(self, file_id: str):
+        """(item, path) for a file or folder id, else (None, None)."""
+        for folder, root in self.folders().items():
+            if file_id == folder:
+                return {"kind": "drive#file", "id": folder, "name": root.name, "mimeType": "application/vnd.google-apps.folder"}, None
+            for p in root.iterdir():
+                if p.is_file() and self.file_id(folder, p.name) == file_id:
+                    return self.item(folder, p), p
+        return None, None
+
+def make_handler(drive: FakeDrive, token: str, latency_s: float, fail_rate: float, page_size: int):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # keep-alive, like the real API
+
+        def log_message(self, fmt, *args):
+            pass
+
+        def send(self, status: int, body: bytes, content_type: str = "application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def error(self, status: int, message: str):
+            self.send(status, json.dumps({"error": {"code": status, "message": message}}).encode("utf-8"))
+
+        def do_GET(self):
+            if latency_s:
+                time.sleep(latency_s)
+            if token and self.headers.get("Authorization") != f"Bearer {token}":
+                return self.error(401, "Invalid Credentials")
+            if fail_rate and random.random() < fail_rate:
+                return self.error(503, "Backend Error")
+            url = urlsplit(self.path)
+            params = {k: v[0] for k, v in parse_qs(url.query).items()}
+            if url.path == "/drive/v3/files":
+                m = re.search(r"'([^']+)' in parents", params.get("q", ""))
+                items = drive.children(m.group(1)) if m else []
+                start = int(params.get("pageToken", "0") or 0)
+                size = min(int(params.get("pageSize", page_size)), page_size)
+                page = {"files": items[start:start + size]}
+                if start + size < len(items):
+                    page["nextPageToken"] = str(start + size)
+                return self.send(200, json.dumps(page).encode("utf-8"))
+            m = re.fullmatch(r"/drive/v3/files/([^/]+)", url.path)
+            if not m:
+                return self.error(404, "Not Found")
+            item, path = drive.find(m.group(1))
+            if item is None:
+                return self.error(404, f"File not found: {m.group(1)}")
+            if params.get("alt") == "media":
+                if path is None:
+                    return self.error(403, "Only files with binary content can be downloaded")
+                return self.send(200, path.read_bytes(), item["mimeType"])
+            return self.send(200, json.dumps(item).encode("utf-8"))
+
+    return Handler
+
+def main(argv = None):
+    p = argparse.ArgumentParser(description = "Serve a local directory through a minimal Drive v3 API.")
+    p.add_argument("--root", required = True, help = "directory served as the folder --folder-id (subdirectories: one folder each)")
+    p.add_argument("--folder-id", default = "photos")
+    p.add_argument("--host", default = "127.0.0.1")
+    p.add_argument("--port", type = int, default = 8765)
+    p.add_argument("--token", default = "", help = "bearer token to require (default: none)")
+    p.add_argument("--latency-ms", type = float, default = 0.0, help = "delay added to every call")
+    p.add_argument("--fail-rate", type = float, default = 0.0, help = "fraction of calls answered 503")
+    p.add_argument("--page-size", type = int, default = 100, help = "largest listing page")
+    args = p.parse_args(argv)
+    drive = FakeDrive(Path(args.root), args.folder_id)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(drive, args.token, args.latency_ms / 1000.0, args.fail_rate, args.page_size))
+    print(f"[INFO] Fake Drive on http://{args.host}:{server.server_port}: folders {', '.join(drive.folders())}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -26,9 +26,27 @@ except Exception as e:
     print(f"Error registering: {e}")
     sys.exit(1)
 
-# 2. Wait for Indexing (Mock wait since it's background)
-print("2. Waiting for indexing (5s)...")
-time.sleep(5)
+# 2. Wait for Indexing (run by worker/job_worker.py; poll its progress)
+print("2. Waiting for indexing...")
+deadline = time.time() + 600
+while True:
+    status = requests.get(f"{BASE_URL}/studio/events/{EVENT_ID}/status").json()
+    job = status.get("job") or {}
+    state = job.get("status")
+    if state == "done":
+        print(f"   Indexed {job['files_done']} files, {job['faces']} faces.")
+        break
+    if state == "failed":
+        print(f"Indexing failed: {job.get('error')}")
+        sys.exit(1)
+    if time.time() > deadline:
+        print(f"Timed out waiting for indexing (last status: {state}). Is worker/job_worker.py running?")
+        sys.exit(1)
+    if state == "queued":
+        print(f"   queued (position {job.get('queue_position')})")
+    else:
+        print(f"   {state}: {job.get('files_done')}/{job.get('files_total')} files, {job.get('faces')} faces, ETA {job.get('eta_s')}s")
+    time.sleep(1)
 
 # 3. Match Face
 # We need a selfie. Let's pick one from the sample images itself to ensure a match.
@@ -66,4 +84,36 @@ try:
 except Exception as e:
     print(f"Error matching: {e}")
 
+# 5. A job for a folder that does not exist must end failed, with the reason
+print("5. Indexing a missing folder...")
+missing_dir = os.path.join(SAMPLE_IMAGES_DIR, "does_not_exist")
+resp = requests.post(f"{BASE_URL}/studio/register", json={"storage_path": missing_dir})
+if resp.status_code != 200:
+    print(f"Failed to register: {resp.text}")
+    sys.exit(1)
+missing_id = resp.json()["id"]
+deadline = time.time() + 120
+while True:
+    job = requests.get(f"{BASE_URL}/studio/events/{missing_id}/status").json().get("job") or {}
+    if job.get("status") == "failed":
+        print(f"   Failed as expected: {job.get('error')}")
+        break
+    if job.get("status") == "done":
+        print("   Job for a missing folder was marked done.")
+        sys.exit(1)
+    if time.time() > deadline:
+        print(f"Timed out waiting for the job to fail (last status: {job.get('status')}).")
+        sys.exit(1)
+    time.sleep(1)
+
+# 6. Forged image ids and album cursors (non-ASCII signatures included) are refused, not a server error
+print("6. Sending forged image ids...")
+for forged in ("abc.def", "abc.\u00e9"):
+    img_resp = requests.get(f"{BASE_URL}/images", params={"id": forged})
+    album_resp = requests.get(f"{BASE_URL}/match/album", params={"token": TOKEN, "album": forged})
+    if img_resp.status_code != 403 or album_resp.status_code != 403:
+        print(f"   {forged!r}: expected 403, got {img_resp.status_code} (image), {album_resp.status_code} (album)")
+        sys.exit(1)
+print("   Refused.")
+
 print("\nVerification Complete.")
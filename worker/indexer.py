@@ -4,7 +4,13 @@ from pathlib import Path
 import glob
 import uuid
 import json
+import time
+import hashlib
+import itertools
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from sqlalchemy import insert
 
 REPO_ROOT = Path(__file__).resolve().parents[1]
 BACKEND_ROOT = REPO_ROOT / "backend"
@@ -14,75 +20,615 @@ if str(BACKEND_ROOT) not in sys.path:
 # import backend.app modules as app.
 try:
     from app.db import SessionLocal
-    from app.models import Event, Face
+    from app.models import Event, Face, DuplicateImage
     # Import the new embedding utility
-    from app.utils.embeddings import get_embedding_from_file
+    from app.utils.embeddings import get_faces_from_decoded, preload_models
+    from app.utils.images import decode_image, perceptual_hash, hash_distance, read_photo_info
+    from app.derivatives import derivative_cache
+    from app.faiss_index import EventFaissIndex, default_index_dir, duplicates_path
+    from app.segments import atomic_write_json
+    from app.metrics import registry
+    from app.sources import source_for, SourceFile
+    from manifest import IndexManifest, ImageHash
 except Exception as e:
     print(f"Failed to import backend.app modules: {e}")
     # Fallback if running directly and path insertion didn't work as expected for imports
     # But the sys.path insert above should handle it.
     raise SystemExit(e)
 
-def index_local_folder(event_id: int, folder_path: str):
-    folder = Path(folder_path)
-    if not folder.exists():
-        print(f"[ERROR] Folder not found: {folder}")
-        return
+# inference processes (0 = run the model in this process)
+INDEXER_WORKERS = int(os.getenv("INDEXER_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# threads reading + decoding files ahead of inference
+INDEXER_IO_THREADS = int(os.getenv("INDEXER_IO_THREADS", "4"))
+# Face rows per bulk INSERT
+INDEXER_DB_CHUNK = int(os.getenv("INDEXER_DB_CHUNK", "256"))
+# write gallery thumbnails from the decode pass, so /images?size=thumb never has to
+INDEXER_THUMBNAILS = os.getenv("INDEXER_THUMBNAILS", "1") == "1"
+# group each event's faces into identities after every run (for /match/album)
+INDEXER_CLUSTERS = os.getenv("INDEXER_CLUSTERS", "1") == "1"
+# near-duplicate skipping: burst frames and re-exported copies run inference once per group
+# (0 also re-indexes the photos earlier runs linked, on the next run)
+INDEXER_DEDUP = os.getenv("INDEXER_DEDUP", "1") == "1"
+# a photo is linked to an earlier one only if identical in bytes, or if every check below agrees:
+# 64-bit dHash within this many bits (bursts: ~0-4, but unrelated photos with the same coarse
+# layout can be too, so it only nominates candidates) ...
+DEDUP_MAX_DISTANCE = int(os.getenv("DEDUP_MAX_DISTANCE", "6"))
+# ... 256-bit dHash within this many bits (re-encodes / resizes: ~0-10, a 1% shift: ~15-25,
+# different frames or photos: 30+) ...
+DEDUP_FINE_MAX_DISTANCE = int(os.getenv("DEDUP_FINE_MAX_DISTANCE", "16"))
+# ... the same aspect ratio (relative tolerance) ...
+DEDUP_ASPECT_TOLERANCE = float(os.getenv("DEDUP_ASPECT_TOLERANCE", "0.01"))
+# ... and EXIF capture times at most this many seconds apart (photos without one are never linked on looks alone)
+DEDUP_MAX_SECONDS = float(os.getenv("DEDUP_MAX_SECONDS", "10"))
+# burst frames sort next to each other: compare against this many preceding group leaders
+DEDUP_WINDOW = int(os.getenv("DEDUP_WINDOW", "8"))
+# long edge of the tiny decode the hash is computed from (JPEGs decode at 1/8 scale)
+DEDUP_DECODE_EDGE = int(os.getenv("DEDUP_DECODE_EDGE", "128"))
+# decoded images alive at once (bounds memory regardless of folder size)
+INDEXER_MAX_IN_FLIGHT = int(os.getenv("INDEXER_MAX_IN_FLIGHT", "0")) or max(4, 2 * max(1, INDEXER_WORKERS))
+# with INDEXER_DEDUP: files read (downloaded, for remote sources) and hashed ahead of inference
+INDEXER_PREFETCH = int(os.getenv("INDEXER_PREFETCH", "0")) or 2 * INDEXER_MAX_IN_FLIGHT
+
+INDEXER_RUNS = registry.counter("vision_indexer_runs_total", "Completed indexing runs.")
+INDEXER_IMAGES = registry.counter("vision_indexer_images_total", "Images embedded by the indexer.")
+INDEXER_FACES = registry.counter("vision_indexer_faces_total", "Faces added to event indexes.")
+INDEXER_SKIPPED = registry.counter("vision_indexer_files_skipped_total", "Files not embedded, by reason.", ("reason",))
+INDEXER_RETIRED = registry.counter("vision_indexer_retired_faces_total", "Faces tombstoned because their file changed or disappeared.")
+INDEXER_DUPLICATES = registry.counter("vision_indexer_duplicates_total", "Files linked to a near-duplicate instead of embedded, by 256-bit dHash distance (0 = identical bytes).", ("distance",))
+INDEXER_ERRORS = registry.counter("vision_indexer_errors_total", "Files that failed to read, decode or embed.")
+INDEXER_STAGE_SECONDS = registry.counter("vision_indexer_stage_seconds_total", "Indexer time per stage, summed over workers.", ("stage",))
+INDEXER_LAST_RUN = registry.gauge("vision_indexer_last_run", "Throughput of the most recent indexing run.", ("field",))
+
+class IndexStats:
+    """Counters and per-stage wall time for the throughput report."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.images = 0
+        self.faces = 0
+        self.skipped = 0
+        self.unchanged = 0
+        self.retired = 0
+        self.errors = 0
+        self.duplicates = 0
+        self.duplicate_distances = {} # 256-bit dHash distance -> files linked at it
+        self.stage_seconds = {"hash": 0.0, "read": 0.0, "decode": 0.0, "infer": 0.0, "db": 0.0}
+        self._published = {} # (metric name, labels) -> total already added to the process counters
+
+    def report(self) -> dict:
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        out = {
+            "images": self.images,
+            "faces": self.faces,
+            "skipped": self.skipped,
+            "unchanged": self.unchanged,
+            "duplicates": self.duplicates,
+            "duplicate_distances": {str(d): n for d, n in sorted(self.duplicate_distances.items())},
+            "retired": self.retired,
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 3),
+            "images_per_s": round(self.images / elapsed, 2),
+            "faces_per_s": round(self.faces / elapsed, 2),
+            "stage_seconds": {k: round(v, 3) for k, v in self.stage_seconds.items()},
+        }
+        print(f"[STATS] {out['images']} images, {out['faces']} faces in {out['elapsed_s']}s "
+              f"({out['images_per_s']} img/s, {out['faces_per_s']} faces/s); "
+              f"skipped {out['skipped']}, unchanged {out['unchanged']}, duplicates {out['duplicates']}, retired {out['retired']}, errors {out['errors']}")
+        if self.duplicate_distances:
+            print(f"[STATS] near-duplicates by 256-bit dHash distance (limit {DEDUP_FINE_MAX_DISTANCE}): " +
+                  ", ".join(f"{d}: {n}" for d, n in sorted(self.duplicate_distances.items())))
+        print("[STATS] stage time (summed over workers): " +
+              ", ".join(f"{k} {v}s" for k, v in out["stage_seconds"].items()))
+        self.publish()
+        INDEXER_RUNS.inc()
+        for field in ("elapsed_s", "images_per_s", "faces_per_s"):
+            INDEXER_LAST_RUN.set(out[field], field = field)
+        return out
+
+    def _totals(self) -> list:
+        totals = [
+            (INDEXER_IMAGES, {}, self.images),
+            (INDEXER_FACES, {}, self.faces),
+            (INDEXER_SKIPPED, {"reason": "no_face"}, self.skipped),
+            (INDEXER_SKIPPED, {"reason": "unchanged"}, self.unchanged),
+            (INDEXER_SKIPPED, {"reason": "duplicate"}, self.duplicates),
+            (INDEXER_RETIRED, {}, self.retired),
+            (INDEXER_ERRORS, {}, self.errors),
+        ]
+        totals += [(INDEXER_DUPLICATES, {"distance": d}, n) for d, n in self.duplicate_distances.items()]
+        return totals + [(INDEXER_STAGE_SECONDS, {"stage": name}, seconds) for name, seconds in self.stage_seconds.items()]
+
+    def publish(self):
+        """Adds what was counted since the last call to the process counters. Called at every
+        checkpoint, so throughput shows while a long run is going, and a killed run still counts."""
+        for metric, labels, total in self._totals():
+            key = (metric.name, tuple(sorted(labels.items())))
+            delta = total - self._published.get(key, 0)
+            if delta > 0:
+                metric.inc(delta, **labels)
+                self._published[key] = total
+
+def _read_and_decode(source, entry: SourceFile, known_sha1: str = None, prefetched = None): # type: ignore
+    # runs on an I/O thread; cv2 releases the GIL while decoding (straight from the bytes, which
+    # remote sources never write anywhere but their cache)
+    t0 = time.perf_counter()
+    data, st = prefetched if prefetched is not None else source.read(entry.path, entry)
+    info = {"size": st.size, "mtime_ns": st.mtime_ns, "sha1": hashlib.sha1(data).hexdigest()}
+    t1 = time.perf_counter()
+    if known_sha1 is not None and info["sha1"] == known_sha1:
+        # touched but identical content: nothing to decode or embed
+        return None, t1 - t0, 0.0, {**info, "unchanged": True}
+    # reduced-resolution JPEG decode, EXIF-upright; full resolution only if a small face needs it
+    img = decode_image(data)
+    if img is not None and INDEXER_THUMBNAILS:
+        try:
+            derivative_cache.store_from_decoded(st, img)
+        except OSError as e:
+            print(f"[WARNING] Thumbnail for {entry.path} not written: {e}")
+    t2 = time.perf_counter()
+    return img, t1 - t0, t2 - t1, info
+
+def _hash_file(source, entry: SourceFile, known_sha1: str = None): # type: ignore
+    # runs on an I/O thread: content hash, then perceptual hashes from a tiny decode and the
+    # header's size and capture time. The bytes are handed on to the decode stage, so a leader
+    # is read (or downloaded) only once
+    t0 = time.perf_counter()
+    data, st = source.read(entry.path, entry)
+    info = {"size": st.size, "mtime_ns": st.mtime_ns, "sha1": hashlib.sha1(data).hexdigest(), "hash": None}
+    if known_sha1 is not None and info["sha1"] == known_sha1:
+        return {**info, "unchanged": True}, time.perf_counter() - t0
+    dec = decode_image(data, long_edge = DEDUP_DECODE_EDGE)
+    if dec is not None:
+        photo = read_photo_info(data) or (dec.img.shape[1], dec.img.shape[0], None)
+        info["hash"] = ImageHash(perceptual_hash(dec.img), perceptual_hash(dec.img, size = 16),
+                                 photo[0] / float(max(photo[1], 1)), photo[2], info["sha1"])
+    info["read"] = (data, st)
+    return info, time.perf_counter() - t0
+
+def same_photo(h: ImageHash, leader: ImageHash):
+    """The 256-bit dHash distance if h is a near-duplicate of leader, else None. Identical bytes
+    always are (distance 0); anything else must pass every DEDUP_* check, so photos that merely
+    share a coarse layout are indexed on their own."""
+    if h.sha1 == leader.sha1:
+        return 0
+    if h.taken is None or leader.taken is None or abs(h.taken - leader.taken) > DEDUP_MAX_SECONDS:
+        return None
+    if abs(h.aspect - leader.aspect) > DEDUP_ASPECT_TOLERANCE * max(h.aspect, leader.aspect):
+        return None
+    if hash_distance(h.coarse, leader.coarse) > DEDUP_MAX_DISTANCE:
+        return None
+    distance = hash_distance(h.fine, leader.fine)
+    return distance if distance <= DEDUP_FINE_MAX_DISTANCE else None
+
+class NearDuplicateGrouper:
+    """Groups files fed in path order. A file is a duplicate of an earlier leader with identical
+    bytes or the same 64-bit hash (anywhere; seeds lists the (path, sha1, ImageHash or None) of
+    leaders from earlier runs), or of one among the last DEDUP_WINDOW leaders (burst frames sort
+    together); either way only if same_photo() confirms it."""
+
+    def __init__(self, seeds: list = None): # type: ignore
+        self.leaders = set()
+        self.by_sha1 = {}
+        self.by_coarse = {} # 64-bit hash -> [(ImageHash, path)]
+        self.recent = deque(maxlen = DEDUP_WINDOW)
+        for path, sha1, h in seeds or []:
+            self._index(path, sha1, h)
+
+    def _index(self, path: str, sha1: str, h):
+        if path in self.leaders:
+            return
+        self.leaders.add(path)
+        self.by_sha1.setdefault(sha1, path)
+        if h is not None:
+            self.by_coarse.setdefault(h.coarse, []).append((h, path))
+
+    def lead(self, path: str, sha1: str, h = None):
+        """Registers a file that keeps leading (indexed earlier, content unchanged). Files hashed
+        by older runs have no ImageHash and only catch identical copies."""
+        self._index(path, sha1, h)
+        if h is not None:
+            self.recent.append((h, path))
+
+    def add(self, path: str, h: ImageHash):
+        """(leader path, distance) if the file is a duplicate, or None when it leads (files without
+        a hash lead nothing)."""
+        if h is None:
+            return None
+        leader = self.by_sha1.get(h.sha1)
+        if leader is not None:
+            return leader, 0
+        for lh, lp in itertools.chain(self.by_coarse.get(h.coarse, ()), self.recent):
+            distance = same_photo(h, lh)
+            if distance is not None:
+                return lp, distance
+        self.lead(path, h.sha1, h)
+        return None
+
+def _init_infer_worker():
+    # load once per pool process up front (a no-op when forked from a parent that preloaded)
+    preload_models()
+
+def _infer(img):
+    # runs in an inference worker process; img is a DecodedImage
+    t0 = time.perf_counter()
+    faces = get_faces_from_decoded(img)
+    return faces, time.perf_counter() - t0
+
+def iter_faces(files, stats: IndexStats, workers: int = None, io_threads: int = None, max_in_flight: int = None, # type: ignore
+               known_hashes: dict = None, source = None, prefetched: dict = None): # type: ignore
+    """Staged pipeline: threaded read/decode -> inference pool -> (path, faces, file_info) in completion order.
+    files: SourceFile entries of source (any iterable; it is only advanced as capacity frees up).
+    faces is None when the file's content hash matches known_hashes[path] (no inference was run).
+    prefetched[path] = (bytes, SourceFile) skips the read of files the caller already has.
+    At most max_in_flight images are decoded or being inferred at any moment."""
+    known_hashes = known_hashes or {}
+    prefetched = prefetched if prefetched is not None else {}
+    source = source or source_for("")
+    workers = INDEXER_WORKERS if workers is None else workers
+    io_threads = io_threads or INDEXER_IO_THREADS
+    max_in_flight = max_in_flight or INDEXER_MAX_IN_FLIGHT
+
+    io_pool = ThreadPoolExecutor(max_workers = io_threads, thread_name_prefix = "indexer-io")
+    infer_pool = ProcessPoolExecutor(max_workers = workers, initializer = _init_infer_worker) if workers > 0 else None
+    pending = {} # future -> (stage, path)
+    todo = iter(files)
+    exhausted = False
+    try:
+        while True:
+            # keep the pipeline full, but never beyond max_in_flight images
+            while not exhausted and len(pending) < max_in_flight:
+                nxt = next(todo, None)
+                if nxt is None:
+                    exhausted = True
+                    break
+                fut = io_pool.submit(_read_and_decode, source, nxt, known_hashes.get(nxt.path), prefetched.pop(nxt.path, None))
+                pending[fut] = ("decode", nxt.path, None)
+            if not pending:
+                break
+
+            done, _ = wait(list(pending), return_when = FIRST_COMPLETED)
+            for fut in done:
+                stage, img_path, info = pending.pop(fut)
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    print(f"[WARNING] Skipping {img_path} due to {stage} error: {e}")
+                    stats.errors += 1
+                    continue
+
+                if stage == "decode":
+                    img, t_read, t_decode, info = result
+                    stats.stage_seconds["read"] += t_read
+                    stats.stage_seconds["decode"] += t_decode
+                    if info.get("unchanged"):
+                        yield img_path, None, info
+                        continue
+                    if img is None:
+                        print(f"[WARNING] Skipping {img_path}: could not decode image")
+                        stats.errors += 1
+                        continue
+                    if infer_pool is not None:
+                        pending[infer_pool.submit(_infer, img)] = ("infer", img_path, info)
+                    else:
+                        faces, t_infer = _infer(img)
+                        stats.stage_seconds["infer"] += t_infer
+                        yield img_path, faces, info
+                else:
+                    faces, t_infer = result
+                    stats.stage_seconds["infer"] += t_infer
+                    yield img_path, faces, info
+    finally:
+        for fut in pending:
+            fut.cancel()
+        io_pool.shutdown(wait = True)
+        if infer_pool is not None:
+            infer_pool.shutdown(wait = True)
+
+def bulk_insert_faces(db, rows: list) -> dict:
+    """Inserts Face rows in one statement and returns {face_uuid: id}.
+    Postgres gets a single multi-row INSERT ... RETURNING round trip."""
+    if not rows:
+        return {}
+    if db.bind.dialect.name == "postgresql":
+        res = db.execute(insert(Face).values(rows).returning(Face.id, Face.face_id))
+        ids = {face_uuid: int(fid) for fid, face_uuid in res}
+    else:
+        objs = [Face(**r) for r in rows]
+        db.add_all(objs)
+        db.flush()
+        ids = {o.face_id: int(o.id) for o in objs}
+    db.commit()
+    return ids
+
+def sync_duplicate_links(db, event_id: int, manifest: IndexManifest) -> int:
+    """Brings the event's DuplicateImage rows in line with the manifest's links (each pointing at
+    its leader's current Face ids); returns the number of rows written or deleted."""
+    want = {}
+    for path, entry in manifest.files.items():
+        leader = entry.get("dup_of")
+        if leader is not None:
+            leader_entry = manifest.get(leader)
+            face_ids = sorted(leader_entry["face_db_ids"]) if leader_entry else []
+            want[path] = (leader, face_ids, int(entry.get("dup_distance", 0)))
+    changed = 0
+    for row in db.query(DuplicateImage).filter(DuplicateImage.event_id == event_id).all():
+        link = want.pop(row.image_path, None)
+        if link is None:
+            db.delete(row)
+        elif (row.leader_path, list(row.face_ids or []), row.distance) != link:
+            row.leader_path, row.face_ids, row.distance = link
+        else:
+            continue
+        changed += 1
+    for path, (leader, face_ids, distance) in want.items():
+        db.add(DuplicateImage(event_id = event_id, image_path = path, leader_path = leader, face_ids = face_ids, distance = distance))
+        changed += 1
+    if changed:
+        db.commit()
+    return changed
+
+def index_local_folder(event_id: int, folder_path: str, workers: int = None, incremental: bool = True, progress = None): # type: ignore
+    """Indexes the event folder: a local path or any root app.sources understands (gdrive://...).
+    In incremental mode (default) only new or changed files are embedded, vectors of
+    deleted/changed files are retired, and progress is checkpointed after every bulk insert so a
+    crashed run resumes where it stopped. incremental=False rebuilds.
+    progress(files_done, files_total, faces), if given, is called after every checkpoint.
+    Raises ValueError for an unsupported folder, FileNotFoundError for a missing one and
+    LookupError for an unknown event, so a job worker records the run as failed."""
+    try:
+        source = source_for(folder_path)
+    except ValueError as e:
+        raise ValueError(f"{e}: {folder_path}") from None
+    if not source.exists(folder_path):
+        raise FileNotFoundError(f"Folder not found: {folder_path}")
     db = SessionLocal()
     ev = db.query(Event).filter(Event.id == event_id).first()
     if not ev:
-        print(f"[ERROR] Event id {event_id} not found. Create it first via /api/v1/studio/register")
         db.close()
-        return
+        raise LookupError(f"Event id {event_id} not found. Create it first via /api/v1/studio/register")
     
-    # ensure indices dir exists in backend/app/indices
-    backend_app_dir = BACKEND_ROOT / "app"
-    indices_dir = backend_app_dir / "indices"
+    # ensure indices dir exists (backend/app/indices unless INDEX_DIR is set)
+    indices_dir = default_index_dir()
     indices_dir.mkdir(parents = True, exist_ok = True)
 
-    # Collect image files
-    exts = ["*.jpg", "*.jpeg", "*.JPG", "*.png", "*.PNG"]
-    files = []
-    for e in exts:
-        files.extend(sorted(folder.glob(e)))
+    # Collect image files (one listing call per page for remote sources, no downloads)
+    files = source.list(folder_path)
+
+    stats = IndexStats()
+    manifest = IndexManifest.load(indices_dir, event_id)
+    index = EventFaissIndex(event_id, index_dir = str(indices_dir))
+    if not incremental or index.store.total_rows() == 0:
+        manifest.files = {}
+
+    # decide what needs work: unchanged stat -> skip without reading the file
+    on_disk = {f.path for f in files}
+    to_process = []
+    known_hashes = {}
+    for f in files:
+        if manifest.is_unchanged(f.path, f.size, f.mtime_ns):
+            stats.unchanged += 1
+            continue
+        entry = manifest.get(f.path)
+        if entry is not None:
+            known_hashes[f.path] = entry["sha1"]
+        to_process.append(f)
+    # a near-duplicate whose leader changed or went away needs faces again: regroup it. So does
+    # one that no longer passes the current checks (tightened DEDUP_*, links made by older
+    # rules), and, with dedup off, every one of them
+    changed = {f.path for f in to_process}
+    unlinked = 0
+    for f in files:
+        entry = manifest.get(f.path)
+        leader = entry.get("dup_of") if entry else None
+        if leader is None or f.path in changed:
+            continue
+        leader_entry = manifest.get(leader)
+        if leader in changed or leader not in on_disk or leader_entry is None or "dup_of" in leader_entry:
+            stats.unchanged -= 1
+            to_process.append(f)
+            continue
+        h, lh = manifest.image_hash(f.path), manifest.image_hash(leader)
+        if INDEXER_DEDUP and (entry["sha1"] == leader_entry["sha1"] or (h is not None and lh is not None and same_photo(h, lh) is not None)):
+            continue
+        stats.unchanged -= 1
+        to_process.append(f)
+        unlinked += 1
+    if unlinked:
+        print(f"[INFO] Event {event_id}: {unlinked} near-duplicate links no longer qualify; re-checking those photos")
+    to_process.sort()
+
+    # retire deleted files, plus anything a crashed run committed but never checkpointed
+    retired = set()
+    for gone in [p for p in manifest.files if p not in on_disk]:
+        retired.update(manifest.remove(gone))
+    live = manifest.face_ids()
+    retired.update(int(fid) for fid in index.id_map if int(fid) not in live)
+    retired.update(fid for (fid,) in db.query(Face.id).filter(Face.event_id == event_id) if fid not in live)
+
+    def checkpoint(vectors: list, meta: list):
+        # vectors first, manifest last: a crash in between is cleaned up by the orphan pass above
+        if vectors:
+            # appended as one new segment; stored pre-normalized so the API can mmap them as-is
+            index.add(np.stack(vectors, axis = 0), [m["face_db_id"] for m in meta], meta)
+        if retired:
+            index.remove(retired)
+            db.query(Face).filter(Face.id.in_(list(retired))).delete(synchronize_session = False)
+            db.commit()
+            stats.retired += len(retired)
+            retired.clear()
+        manifest.save()
 
     if not files:
-        print(f"[WARNING] No image files found in {folder}")
-        db.close()
-        return
-    
-    vectors = []
-    meta = []
+        print(f"[WARNING] No image files found in {folder_path}")
 
-    for img_path in files:
-        print('Indexing', img_path)
-        try:
-            emb = get_embedding_from_file(str(img_path))
-        except Exception as e:
-            print(f"[WARNING] Skipping {img_path} due to read error: {e}")
+    skipped_by_stat = stats.unchanged
+    files_total = len(to_process)
+    def report_progress():
+        stats.publish()
+        if progress is not None:
+            done = stats.images + stats.errors + stats.duplicates + stats.unchanged - skipped_by_stat
+            progress(done, files_total, stats.faces)
+
+    report_progress()
+
+    image_hashes = {}
+    prefetched = {} # path -> (bytes, SourceFile) read by the hash pass, for the decode stage
+
+    def hashed(pool):
+        # (entry, hash info or None on error) for to_process in order, at most INDEXER_PREFETCH ahead
+        todo = iter(to_process)
+        window = deque((f, pool.submit(_hash_file, source, f, known_hashes.get(f.path))) for f in itertools.islice(todo, INDEXER_PREFETCH))
+        while window:
+            f, fut = window.popleft()
+            nxt = next(todo, None)
+            if nxt is not None:
+                window.append((nxt, pool.submit(_hash_file, source, nxt, known_hashes.get(nxt.path))))
+            try:
+                info, t_hash = fut.result()
+            except Exception as e:
+                print(f"[WARNING] Skipping {f.path} due to hash error: {e}")
+                stats.errors += 1
+                yield f, None
+                continue
+            stats.stage_seconds["hash"] += t_hash
+            yield f, info
+
+    def leaders():
+        # hash pass, streamed in path order ahead of the pipeline (so downloads overlap inference):
+        # content-unchanged files are settled here, and near-duplicates are linked to a leader's
+        # faces instead of going through the detector and recognizer
+        regroup = {f.path for f in to_process}
+        seeds = []
+        for path in sorted(on_disk - regroup):
+            entry = manifest.get(path)
+            if entry is not None and "dup_of" not in entry:
+                seeds.append((path, entry["sha1"], manifest.image_hash(path)))
+        grouper = NearDuplicateGrouper(seeds)
+        linked = {}
+        with ThreadPoolExecutor(max_workers = INDEXER_IO_THREADS, thread_name_prefix = "indexer-hash") as pool:
+            results = hashed(pool)
+            for path in sorted(on_disk):
+                entry = manifest.get(path)
+                if path not in regroup:
+                    if entry is not None and "dup_of" not in entry:
+                        grouper.lead(path, entry["sha1"], manifest.image_hash(path))
+                    continue
+                f, info = next(results)
+                if info is None:
+                    continue
+                if info.get("unchanged"):
+                    # same bytes, new mtime: just refresh the stat in the manifest
+                    manifest.touch(path, info["size"], info["mtime_ns"])
+                    stats.unchanged += 1
+                    if "dup_of" not in manifest.get(path):
+                        grouper.lead(path, info["sha1"], manifest.image_hash(path))
+                    continue
+                found = grouper.add(path, info["hash"])
+                if found is not None:
+                    leader, distance = found
+                    retired.update(manifest.remove(path))
+                    manifest.set(path, info["size"], info["mtime_ns"], info["sha1"], [], image_hash = info["hash"],
+                                 dup_of = leader, dup_distance = distance)
+                    stats.duplicates += 1
+                    stats.duplicate_distances[distance] = stats.duplicate_distances.get(distance, 0) + 1
+                    linked[path] = leader
+                    continue
+                # a leader (or a file too odd to hash) goes through the pipeline
+                image_hashes[path] = info["hash"]
+                prefetched[path] = info["read"]
+                yield f
+        if linked:
+            print(f"[INFO] Event {event_id}: {len(linked)} near-duplicates linked to {len(set(linked.values()))} leaders "
+                  f"(max distance {max(stats.duplicate_distances)} of {DEDUP_FINE_MAX_DISTANCE}; listed in duplicate_images)")
+
+    # the hash pass already settled content-unchanged files
+    pipeline_files, pipeline_hashes = to_process, known_hashes
+    if INDEXER_DEDUP and to_process:
+        pipeline_files, pipeline_hashes = leaders(), {}
+
+    rows = [] # Face rows waiting for the next bulk insert
+    pending = [] # (embedding, meta) for those rows
+    pending_files = [] # (path, file_info, [face_uuid]) completed by the next flush
+
+    def flush():
+        t0 = time.perf_counter()
+        ids = bulk_insert_faces(db, rows)
+        new_vecs, new_meta = [], []
+        for vec, m in pending:
+            m["face_db_id"] = ids[m["face_uuid"]]
+            new_vecs.append(vec)
+            new_meta.append(m)
+        for img_path, info, uuids in pending_files:
+            manifest.set(str(img_path), info["size"], info["mtime_ns"], info["sha1"], [ids[u] for u in uuids],
+                         image_hash = image_hashes.get(str(img_path)))
+        checkpoint(new_vecs, new_meta)
+        rows.clear()
+        pending.clear()
+        pending_files.clear()
+        stats.stage_seconds["db"] += time.perf_counter() - t0
+        report_progress()
+
+    for img_path, faces, info in iter_faces(pipeline_files, stats, workers = workers, known_hashes = pipeline_hashes,
+                                            source = source, prefetched = prefetched):
+        if faces is None:
+            # same bytes, new mtime: just refresh the stat in the manifest
+            manifest.touch(str(img_path), info["size"], info["mtime_ns"])
+            stats.unchanged += 1
             continue
-        # create face DB record
-        f = Face(event_id = event_id, face_id = str(uuid.uuid4()), image_path = str(img_path))
-        db.add(f)
-        db.commit()
-        db.refresh(f)
-        
-        vectors.append(emb)
-        meta.append({"face_db_id": int(f.id), "face_uuid": f.face_id, "image_path": str(img_path)})
+        stats.images += 1
+        # a changed file replaces all of its previous faces
+        retired.update(manifest.remove(str(img_path)))
+        uuids = []
+        # one Face record (and one vector) per detected face
+        for face in faces:
+            face_uuid = str(uuid.uuid4())
+            uuids.append(face_uuid)
+            rows.append({"event_id": event_id, "face_id": face_uuid, "image_path": str(img_path), "bbox": face["bbox"]})
+            pending.append((face["embedding"], {
+                "face_db_id": None,
+                "face_uuid": face_uuid,
+                "image_path": str(img_path),
+                "bbox": face["bbox"],
+                "det_score": face["det_score"],
+            }))
+            stats.faces += 1
+        if not faces:
+            # remembered too, so faceless photos are not re-run on every pass
+            stats.skipped += 1
+        pending_files.append((img_path, info, uuids))
+        if len(rows) >= INDEXER_DB_CHUNK:
+            flush()
+    if rows or pending_files or retired:
+        flush()
+    elif to_process:
+        manifest.save()
+        report_progress()
 
-    if not vectors:
-        print("[WARNING] No vectors were created; nothing saved.")
-        db.close()
-        return
-    
-    # Save embeddings and meta
-    emb_arr = np.stack(vectors, axis = 0).astype("float32")
-    emb_file = indices_dir / f"event_{event_id}_embeddings.npy"
-    meta_file = indices_dir / f"event_{event_id}_meta.json"
+    # duplicate groups for the API (results list a leader's duplicates alongside it)
+    groups = {"groups": manifest.groups()}
+    dup_path = duplicates_path(event_id, str(indices_dir))
+    try:
+        with open(dup_path, "r", encoding = "utf-8") as fh:
+            current = json.load(fh)
+    except (OSError, ValueError):
+        current = None
+    if current != groups and (groups["groups"] or current is not None):
+        atomic_write_json(dup_path, groups)
+    # ... and the same links in the database, pointing at the leaders' Face rows
+    sync_duplicate_links(db, event_id, manifest)
+
+    # merge the small per-checkpoint segments (and build the ANN index if faiss is installed)
+    t0 = time.perf_counter()
+    if index.compact():
+        print(f"[INFO] Compacted event {event_id} index in {time.perf_counter() - t0:.2f}s")
 
-    np.save(str(emb_file), emb_arr)
-    with open(meta_file, "w", encoding = "utf-8") as fh:
-        json.dump(meta, fh, indent = 2)
+    if INDEXER_CLUSTERS:
+        # incremental: only faces added / retired by this run move
+        t0 = time.perf_counter()
+        res = index.clusters.update(index.store)
+        if res["added"] or res["removed"]:
+            print(f"[INFO] Event {event_id}: {res['clusters']} identities (+{res['added']} / -{res['removed']} faces, "
+                  f"{res['new_clusters']} new) in {time.perf_counter() - t0:.2f}s")
 
     # Mark event as indexed
     ev.indexed = True
@@ -91,8 +637,8 @@ def index_local_folder(event_id: int, folder_path: str):
     db.close()
 
     print("Indexing Complete.")
-    print("Embeddings saved to:", emb_file)
-    print("Meta saved to:", meta_file)
+    print(f"{index.store.live_rows()} vectors in", index.store.root)
+    return stats.report()
 
 if __name__ == "__main__":
     # For testing manually
@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+import multiprocessing as mp
+
+# indexer.py puts backend/ on sys.path and imports the app modules
+from indexer import index_local_folder
+from app.jobs import job_queue
+from app.metrics import start_http_server
+
+# job processes on this host (each one runs INDEXER_WORKERS inference processes of its own,
+# so JOB_WORKERS * INDEXER_WORKERS should be about the number of cores)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+# seconds between queue polls while idle
+JOB_POLL_S = float(os.getenv("JOB_POLL_S", "2"))
+# seconds between heartbeats of a running job (must stay well below JOB_STALE_S)
+JOB_HEARTBEAT_S = float(os.getenv("JOB_HEARTBEAT_S", "15"))
+# Prometheus endpoint (GET /metrics: vision_indexer_*) of the job process; with JOB_WORKERS > 1,
+# job process i listens on METRICS_PORT + i (0 = off)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9101"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+class _Shutdown(Exception):
+    pass
+
+def _on_signal(signum, frame):
+    raise _Shutdown()
+
+def _heartbeat(job_id: int, stop: threading.Event):
+    # keeps the job alive through long stretches without a checkpoint (decode of huge files, compaction)
+    while not stop.wait(JOB_HEARTBEAT_S):
+        try:
+            job_queue.progress(job_id)
+        except Exception as e:
+            print(f"[WARNING] Heartbeat for job {job_id} failed: {e}")
+
+def run_job(job: dict):
+    stop = threading.Event()
+    beat = threading.Thread(target = _heartbeat, args = (job["id"], stop), daemon = True)
+    beat.start()
+    try:
+        def progress(files_done, files_total, faces):
+            job_queue.progress(job["id"], files_done = files_done, files_total = files_total, faces = faces)
+        index_local_folder(job["event_id"], job["folder"], incremental = job["incremental"], progress = progress)
+    finally:
+        stop.set()
+
+def worker_loop(name: str, metrics_port: int = 0):
+    """Claims and runs jobs until SIGTERM / SIGINT. A job interrupted by a signal is put back
+    in the queue; one interrupted by a crash is requeued by requeue_stale() on another worker."""
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+    # the indexer's counters live in this process's registry, not the API's
+    if metrics_port and start_http_server(metrics_port, METRICS_HOST) is not None:
+        print(f"[INFO] {name}: metrics on http://{METRICS_HOST}:{metrics_port}/metrics")
+    job = None
+    try:
+        while True:
+            job_queue.requeue_stale()
+            job = job_queue.claim(name)
+            if job is None:
+                time.sleep(JOB_POLL_S)
+                continue
+            print(f"[INFO] {name}: job {job['id']} event {job['event_id']} ({job['folder']})")
+            try:
+                run_job(job)
+            except _Shutdown:
+                raise
+            except Exception as e:
+                print(f"[ERROR] {name}: job {job['id']} failed: {e}")
+                job_queue.finish(job["id"], error = str(e) or type(e).__name__)
+            else:
+                job_queue.finish(job["id"])
+            job = None
+    except _Shutdown:
+        if job is not None:
+            print(f"[INFO] {name}: releasing job {job['id']}")
+            job_queue.release(job["id"])
+
+def main():
+    host = socket.gethostname()
+    if JOB_WORKERS <= 1:
+        worker_loop(f"{host}:{os.getpid()}", METRICS_PORT)
+        return
+    # not daemonic: each job process starts its own inference pool
+    procs = [mp.Process(target = worker_loop, args = (f"{host}:job{i}", METRICS_PORT + i if METRICS_PORT else 0), name = f"job{i}")
+             for i in range(JOB_WORKERS)]
+    for p in procs:
+        p.start()
+
+    def forward(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                os.kill(p.pid, signal.SIGTERM) # type: ignore
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for p in procs:
+        p.join()
+
+if __name__ == "__main__":
+    sys.exit(main())
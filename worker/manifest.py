@@ -0,0 +1,95 @@
+import json
+from pathlib import Path
+from collections import namedtuple
+from app.faiss_index import atomic_write_json
+
+MANIFEST_FORMAT = 1
+
+# what near-duplicate grouping compares (worker/indexer.py): 64-bit and 256-bit dHash, upright
+# width / height, EXIF capture time in seconds (or None) and the content hash
+ImageHash = namedtuple("ImageHash", ["coarse", "fine", "aspect", "taken", "sha1"])
+
+class IndexManifest:
+    """Per-event record of what has been indexed: file path -> size, mtime, content hash
+    and the Face ids produced from it. Lives next to the index files as
+    event_{id}_manifest.json and is only rewritten atomically, after the matching
+    Face rows and vectors are committed, so it doubles as the resume checkpoint."""
+
+    def __init__(self, path: Path, files: dict = None): # type: ignore
+        self.path = Path(path)
+        self.files = files or {}
+
+    @classmethod
+    def load(cls, indices_dir: Path, event_id: int):
+        path = Path(indices_dir) / f"event_{int(event_id)}_manifest.json"
+        if not path.exists():
+            return cls(path)
+        try:
+            with open(path, "r", encoding = "utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError) as e:
+            print(f"[WARNING] Unreadable manifest {path} ({e}); starting a full rebuild.")
+            return cls(path)
+        if data.get("format") != MANIFEST_FORMAT:
+            return cls(path)
+        return cls(path, data.get("files", {}))
+
+    def save(self):
+        atomic_write_json(self.path, {"format": MANIFEST_FORMAT, "files": self.files})
+
+    def get(self, file_path: str):
+        return self.files.get(str(file_path))
+
+    def is_unchanged(self, file_path: str, size: int, mtime_ns: int) -> bool:
+        entry = self.get(file_path)
+        return entry is not None and entry["size"] == size and entry["mtime_ns"] == mtime_ns
+
+    def set(self, file_path: str, size: int, mtime_ns: int, sha1: str, face_db_ids: list,
+            image_hash: ImageHash = None, dup_of: str = None, dup_distance: int = None): # type: ignore
+        entry = {
+            "size": int(size),
+            "mtime_ns": int(mtime_ns),
+            "sha1": sha1,
+            "face_db_ids": [int(x) for x in face_db_ids],
+        }
+        if image_hash is not None:
+            entry["phash"] = f"{image_hash.coarse:016x}"
+            entry["fhash"] = f"{image_hash.fine:064x}"
+            entry["aspect"] = round(float(image_hash.aspect), 4)
+            if image_hash.taken is not None:
+                entry["taken"] = float(image_hash.taken)
+        if dup_of is not None:
+            # near-duplicate: no faces of its own, it is represented by dup_of's
+            entry["dup_of"] = str(dup_of)
+            entry["dup_distance"] = int(dup_distance or 0)
+        self.files[str(file_path)] = entry
+
+    def touch(self, file_path: str, size: int, mtime_ns: int):
+        """New stat for a file whose content did not change."""
+        entry = self.files[str(file_path)]
+        entry["size"], entry["mtime_ns"] = int(size), int(mtime_ns)
+
+    def image_hash(self, file_path: str):
+        """The file's ImageHash, or None if it was never hashed (or only by the 64-bit hash of
+        older runs, which is not enough to confirm a grouping)."""
+        entry = self.get(file_path)
+        if not entry or "fhash" not in entry:
+            return None
+        return ImageHash(int(entry["phash"], 16), int(entry["fhash"], 16), entry["aspect"], entry.get("taken"), entry["sha1"])
+
+    def remove(self, file_path: str) -> list:
+        """Drops a file and returns the Face ids that must be retired with it."""
+        entry = self.files.pop(str(file_path), None)
+        return list(entry["face_db_ids"]) if entry else []
+
+    def groups(self) -> dict:
+        """leader path -> [near-duplicate paths], sorted."""
+        out = {}
+        for path in sorted(self.files):
+            leader = self.files[path].get("dup_of")
+            if leader is not None:
+                out.setdefault(leader, []).append(path)
+        return out
+
+    def face_ids(self) -> set:
+        return {fid for entry in self.files.values() for fid in entry["face_db_ids"]}